@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class ChatappConfig(AppConfig):
     name = 'chatapp'
+
+    def ready(self):
+        from . import checks  # noqa: F401
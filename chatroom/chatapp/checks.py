@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+
+
+LOCAL_CACHE_BACKENDS = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    """
+    複数ワーカーで動かす設定なのに、キャッシュがプロセスごとの場合に警告する
+    メンバーを削除しても他のワーカーのキャッシュにはタイムアウトまで古い権限が残り、在室状況も共有されないため
+    """
+    if settings.CACHES.get("default", {}).get("BACKEND") not in LOCAL_CACHE_BACKENDS:
+        return []
+
+    channel_layer = settings.CHANNEL_LAYERS.get("default", {})
+    is_multi_worker = (
+        bool(getattr(settings, "DATABASE_REPLICAS", []))
+        or getattr(settings, "RATE_LIMIT_BACKEND", "local") == "cache"
+        or channel_layer.get("CONFIG", {}).get("broker", "common.channel_layers.brokers.LocalBroker") != "common.channel_layers.brokers.LocalBroker"
+    )
+    if not is_multi_worker:
+        return []
+
+    return [Warning(
+        "CACHESがプロセスごとのキャッシュのため、ルームのメンバーの変更と在室状況が他のワーカーに反映されません",
+        hint="設定ファイルのCACHESでMemcachedなどの共有キャッシュを指定してください",
+        id="chatapp.W001",
+    )]
@@ -0,0 +1,257 @@
+import json
+from typing import List, Optional
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+
+from chatapp.logic import chatroom_interactor as logic
+from chatapp.logic import message_history
+from chatapp.logic.message_writer import message_write_buffer
+from chatapp.logic.presence import presence_registry, user_room_group_name
+from chatapp.logic.room_events import RoomEventType, message_payload, room_event, room_events_group
+from chatapp.models import AbstractMessage
+from common.consumers.outbound_queue import OutboundQueue, OverflowPolicy
+from common.nodes.url_safe_encode_node import UrlSafeEncodeNode
+from common.ratelimit.token_bucket import rate_limiter
+from users.auth.auth import Auth
+from users.auth.scope_request import ScopeRequest
+
+
+ROOM_LOGICS = {
+    "public": (
+        logic.is_public_room_member,
+        logic.prepare_public_message,
+        lambda request, room_id, **kwargs: message_history.fetch_public_room_messages(room_id, **kwargs)
+    ),
+    "private": (logic.is_private_room_member, logic.prepare_private_message, message_history.fetch_private_room_messages),
+}
+
+# 送信が追いつかずに溢れた場合に切断するときのclose code
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+
+def room_group_name(room_kind: str, room_id) -> str:
+    """
+    ルームごとに1つ作成するchannel layerのgroup名
+    """
+    return "chatroom-%s-%s" % (room_kind, room_id)
+
+
+def connection_url(room_kind: str, room_id) -> str:
+    """
+    ChatroomConsumerへ接続するためのURL
+    """
+    return "/chatroom/%s/%s/" % (room_kind, room_id)
+
+
+def message_to_dict(message: AbstractMessage) -> dict:
+    return {
+        "id": message.id,
+        "text": message.text,
+        "sender": {
+            "id": UrlSafeEncodeNode.to_global_id("UserNameNode", message.sender_id),
+            "username": message.sender.username if message.sender else "",
+        },
+        "send_date": message.send_date.isoformat(),
+        "cursor": message_history.encode_cursor(message),
+    }
+
+
+def coalesce_frames(frames: List[dict]) -> List[dict]:
+    """
+    送信できずに溜まったメッセージを、読み飛ばした件数を知らせる1つのフレームにまとめて先頭に置く
+    ackとerrorは送信者への応答のため、まとめずに元の順番で残す
+    afterは送信時に、最後に送信できたメッセージのcursorを設定する
+    """
+    skipped = [frame for frame in frames if frame["type"] in ("message", "skipped")]
+    responses = [frame for frame in frames if frame["type"] not in ("message", "skipped")]
+    if not skipped:
+        return responses
+
+    counts = [frame["count"] if frame["type"] == "skipped" else 1 for frame in skipped]
+    # 再接続時の読み飛ばしは件数が分からない(None)ため、含まれていればまとめた件数も不明とする
+    count = None if None in counts else sum(counts)
+    return [{"type": "skipped", "count": count, "after": None}] + responses
+
+
+class DeliveredCursor:
+    """
+    クライアントへ送信できたメッセージのうち、(send_date, id)の順で最も後のメッセージのcursor
+    skippedのafterに使い、クライアントはそこから読み飛ばした分を取得する
+    """
+    def __init__(self, cursor: Optional[str]) -> None:
+        self.cursor = cursor
+
+
+    def advance(self, frame: dict) -> None:
+        """
+        ackは同じバッチで先にコミットされたメッセージの配信より先に届くことがあるため、cursorを進めない
+        メッセージもchannel layerを経由する間に前後することがあるため、前のcursorより後の場合だけ進める
+        """
+        if frame["type"] != "message":
+            return
+
+        cursor = frame["message"]["cursor"]
+        if self.cursor is None or self.__key(cursor) > self.__key(self.cursor):
+            self.cursor = cursor
+
+
+    def __key(self, cursor: str) -> tuple:
+        # 再接続時の?after=が不正なcursorだった場合は、どのメッセージよりも前とみなす
+        try:
+            send_date, id = message_history.decode_cursor(cursor)
+        except Exception:
+            return ()
+
+        return () if send_date is None else (send_date, id)
+
+
+class ChatroomConsumer(AsyncWebsocketConsumer):
+    """
+    メンバーになっているルームのメッセージを送受信する
+    1接続につきスレッドを占有しないよう、DBアクセスのみdatabase_sync_to_asyncで実行する
+
+    接続している間はPresenceRegistryに在室中として記録される
+    クライアントはCHAT_PRESENCE_TTLより短い間隔で{"type": "heartbeat"}を送信すること
+
+    送信は接続ごとにCHAT_OUTBOUND_QUEUE_SIZE件までためて、溢れた場合はCHAT_OUTBOUND_QUEUE_POLICYに従う
+    - drop_oldest: 古いメッセージを捨てる
+    - coalesce: 溜まったメッセージを{"type": "skipped", "count": 件数, "after": cursor}にまとめる
+      クライアントはroomMessages(after: cursor)で読み飛ばした分を取得する
+      ackとerrorはまとめずに送信する
+    - disconnect: SLOW_CONSUMER_CLOSE_CODEで切断する
+      クライアントは最後に受信したメッセージのcursorを?after=cursorに付けて再接続すると、続きから受信できる
+    """
+
+    async def connect(self):
+        self.__outbox = None
+        kwargs = self.scope["url_route"]["kwargs"]
+        self.__room_kind = kwargs["room_kind"]
+        self.__room_id = kwargs["room_id"]
+        self.__group_name = room_group_name(self.__room_kind, self.__room_id)
+        self.__is_member, self.__prepare_message, self.__fetch_messages = ROOM_LOGICS[self.__room_kind]
+        self.__request = ScopeRequest(self.scope)
+
+        try:
+            is_member = await database_sync_to_async(self.__is_member)(self.__request, self.__room_id)
+            self.__user = await database_sync_to_async(lambda: Auth(self.__request).current_user)()
+        except Exception:
+            is_member = False
+
+        if not is_member:
+            await self.close()
+            return
+
+        after = parse_qs(self.scope.get("query_string", b"").decode()).get("after")
+        # 読み飛ばしを知らせるafterが常に使えるよう、最初は接続時点の最新のメッセージを送信済みとみなす
+        # groupへ参加する前に取得するため、その間に届いたメッセージも読み飛ばした場合は取得し直せる
+        self.__delivered_cursor = DeliveredCursor(after[0] if after else await self.__latest_cursor())
+        self.__outbox = OutboundQueue(
+            self.__send_frame,
+            max_size=getattr(settings, "CHAT_OUTBOUND_QUEUE_SIZE", 256),
+            policy=OverflowPolicy(getattr(settings, "CHAT_OUTBOUND_QUEUE_POLICY", "coalesce")),
+            coalesce=coalesce_frames,
+            on_disconnect=lambda: self.close(SLOW_CONSUMER_CLOSE_CODE)
+        )
+        self.__user_group_name = user_room_group_name(self.__room_kind, self.__room_id, self.__user.pk)
+        await self.channel_layer.group_add(self.__group_name, self.channel_name)
+        await self.channel_layer.group_add(self.__user_group_name, self.channel_name)
+        await self.accept()
+        await self.__touch()
+
+        if after:
+            await self.__resume(after[0])
+
+
+    async def disconnect(self, code):
+        if self.__outbox is None:
+            return
+
+        self.__outbox.close()
+        await presence_registry.leave(self.channel_name)
+        await self.channel_layer.group_discard(self.__group_name, self.channel_name)
+        await self.channel_layer.group_discard(self.__user_group_name, self.channel_name)
+
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        送信者にはコミット完了後にackを返す
+        client_message_idを付けて送信すると、ackに同じ値が含まれる
+        """
+        try:
+            content = json.loads(text_data)
+            await self.__touch()
+            if content.get("type") == "heartbeat":
+                return
+
+            # 連投はDBへ問い合わせる前に拒否する
+            await rate_limiter.acheck("send_message", "user:%s:room:%s" % (self.__user.pk, self.__group_name))
+            message = await database_sync_to_async(self.__prepare_message)(self.__request, self.__room_id, content["text"])
+            saved = await message_write_buffer.write(message)
+            message = message_to_dict(saved)
+        except Exception as err:
+            self.__outbox.put({"type": "error", "message": str(err)})
+            return
+
+        self.__outbox.put({"type": "ack", "client_message_id": content.get("client_message_id"), "message": message})
+        await self.channel_layer.group_send(self.__group_name, {"type": "chat.message", "message": message})
+        events_group = room_events_group(self.__room_kind, self.__room_id)
+        await self.channel_layer.group_send(
+            events_group,
+            room_event(events_group, RoomEventType.MESSAGE, self.__room_kind, self.__room_id, message=message_payload(saved))
+        )
+
+
+    async def chat_message(self, event):
+        self.__outbox.put({"type": "message", "message": event["message"]})
+
+
+    async def room_exit(self, event):
+        """
+        ExitChatroomで退室したときに接続を切断する
+        """
+        await self.close()
+
+
+    async def __resume(self, cursor: str) -> None:
+        """
+        cursorより後のメッセージを送信する。再接続までの間に届いたメッセージと重複する場合があるため、
+        クライアントはidで重複を取り除くこと
+        """
+        try:
+            page = await database_sync_to_async(self.__fetch_messages)(
+                self.__request, self.__room_id, after=cursor, first=message_history.MAX_PAGE_SIZE
+            )
+            messages = await database_sync_to_async(lambda: [message_to_dict(message) for message in page.messages])()
+        except Exception as err:
+            self.__outbox.put({"type": "error", "message": str(err)})
+            return
+
+        for message in messages:
+            self.__outbox.put({"type": "message", "message": message})
+
+        if page.has_next_page:
+            self.__outbox.put({"type": "skipped", "count": None, "after": None})
+
+
+    async def __latest_cursor(self) -> Optional[str]:
+        """
+        メッセージが無いルームではNone。roomMessagesのafterを省略すると最初から取得できる
+        """
+        page = await database_sync_to_async(self.__fetch_messages)(self.__request, self.__room_id, last=1)
+        return message_history.encode_cursor(page.messages[0]) if page.messages else None
+
+
+    async def __send_frame(self, frame: dict) -> None:
+        if frame["type"] == "skipped":
+            frame = {**frame, "after": self.__delivered_cursor.cursor}
+
+        await self.send(json.dumps(frame))
+        self.__delivered_cursor.advance(frame)
+
+
+    async def __touch(self) -> None:
+        await presence_registry.touch(self.__room_kind, self.__room_id, self.__user.pk, self.channel_name)
+
@@ -0,0 +1,166 @@
+from typing import Dict, List, Tuple
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+from graphene_django.settings import graphene_settings
+from graphql.error import format_error
+from graphql.execution import ExecutionResult
+from promise import Promise
+from rx import Observable
+
+from common.consumers.outbound_queue import OutboundQueue, OverflowPolicy
+from common.graphql.document_cache import LRUCachedBackend
+from common.graphql.query_cost import QueryCostAnalyzer, QueryCostLimit
+from common.graphql.subscription_streams import SubscriptionStreams
+from users.auth.scope_request import ScopeRequest
+
+
+GRAPHQL_WS_PROTOCOL = "graphql-ws"
+
+backend = LRUCachedBackend(getattr(settings, "GRAPHQL_DOCUMENT_CACHE_SIZE", 256))
+
+
+class GraphQLSubscriptionConsumer(AsyncJsonWebsocketConsumer):
+    """
+    subscriptions-transport-wsのgraphql-wsプロトコルでGraphQLのsubscriptionを配信する
+
+    subscriptionのresolverはchannel layerのgroupを購読し、groupに届いたイベントごとに
+    選択されたフィールドを解決してdataとして送信する。queryとmutationは1回だけ結果を送信して完了する
+
+    送信はChatroomConsumerと同じくCHAT_OUTBOUND_QUEUE_SIZE件までためる
+    graphql-wsには読み飛ばしを知らせるメッセージが無いため、coalesceの場合も古いものから捨てる
+    """
+
+    async def connect(self):
+        self.__request = ScopeRequest(self.scope)
+        self.__operations: Dict[str, Tuple[SubscriptionStreams, object]] = {}
+        self.__group_counts: Dict[str, int] = {}
+        self.__pending: List[Tuple[str, ExecutionResult]] = []
+        self.__outbox = OutboundQueue(
+            self.send_json,
+            max_size=getattr(settings, "CHAT_OUTBOUND_QUEUE_SIZE", 256),
+            policy=OverflowPolicy(getattr(settings, "CHAT_OUTBOUND_QUEUE_POLICY", "coalesce")),
+            on_disconnect=self.close
+        )
+        subprotocol = GRAPHQL_WS_PROTOCOL if GRAPHQL_WS_PROTOCOL in self.scope.get("subprotocols", []) else None
+        await self.accept(subprotocol)
+
+
+    async def disconnect(self, code):
+        self.__outbox.close()
+        for id in list(self.__operations):
+            await self.__stop(id)
+
+
+    async def receive_json(self, content, **kwargs):
+        message_type = content.get("type")
+        id = content.get("id")
+        if message_type == "connection_init":
+            self.__outbox.put({"type": "connection_ack"})
+        elif message_type == "start":
+            await self.__start(id, content.get("payload") or {})
+        elif message_type == "stop":
+            await self.__stop(id)
+            self.__outbox.put({"type": "complete", "id": id})
+        elif message_type == "connection_terminate":
+            await self.close()
+        else:
+            self.__outbox.put({"type": "error", "id": id, "payload": {"message": f"{message_type}には対応していません"}})
+
+
+    async def graphql_event(self, event):
+        """
+        room_events.notify_room_eventなどでgroupに送信されたイベントを、購読中のsubscriptionへ流す
+        """
+        await database_sync_to_async(self.__publish)(event["group"], event["event"])
+        self.__flush()
+
+
+    async def __start(self, id: str, payload: dict) -> None:
+        if id in self.__operations:
+            await self.__stop(id)
+
+        streams = SubscriptionStreams()
+        result = await database_sync_to_async(self.__execute)(streams, payload)
+        if not isinstance(result, Observable):
+            self.__outbox.put({"type": "data", "id": id, "payload": self.__format(result)})
+            self.__outbox.put({"type": "complete", "id": id})
+            return
+
+        # on_nextはgraphql_eventから別スレッドで呼び出される
+        disposable = result.subscribe(on_next=lambda result: self.__pending.append((id, self.__resolve(result))))
+        self.__operations[id] = (streams, disposable)
+        for group in streams.groups():
+            self.__group_counts[group] = self.__group_counts.get(group, 0) + 1
+            if self.__group_counts[group] == 1:
+                await self.channel_layer.group_add(group, self.channel_name)
+
+
+    async def __stop(self, id: str) -> None:
+        streams, disposable = self.__operations.pop(id, (None, None))
+        if streams is None:
+            return
+
+        disposable.dispose()
+        for group in streams.groups():
+            self.__group_counts[group] -= 1
+            if self.__group_counts[group] == 0:
+                del self.__group_counts[group]
+                await self.channel_layer.group_discard(group, self.channel_name)
+
+        streams.complete()
+
+
+    def __execute(self, streams: SubscriptionStreams, payload: dict):
+        query = payload.get("query")
+        variables = payload.get("variables")
+        operation_name = payload.get("operationName")
+        schema = graphene_settings.SCHEMA
+        try:
+            document = backend.document_from_string(schema, query)
+        except Exception as e:
+            return ExecutionResult(errors=[e], invalid=True)
+
+        errors = QueryCostAnalyzer(schema, QueryCostLimit.from_settings()).check(document.document_ast, variables, operation_name)
+        if errors:
+            return ExecutionResult(errors=errors, invalid=True)
+
+        self.__request.subscription_streams = streams
+        return document.execute(
+            context_value=self.__request,
+            variable_values=variables,
+            operation_name=operation_name,
+            allow_subscriptions=True
+        )
+
+
+    def __publish(self, group: str, event: dict) -> None:
+        # DataLoaderのキャッシュはイベントごとに破棄し、名前の変更などを反映する
+        self.__request._dataloaders = {}
+        for streams, _ in self.__operations.values():
+            streams.publish(group, event)
+
+
+    def __resolve(self, result: ExecutionResult) -> ExecutionResult:
+        """
+        DataLoaderを使うフィールドはPromiseのまま渡されるため、送信する前に解決しておく
+        """
+        if result.data is None:
+            return result
+
+        return ExecutionResult(data=Promise.for_dict(result.data).get(), errors=result.errors)
+
+
+    def __flush(self) -> None:
+        pending, self.__pending = self.__pending, []
+        for id, result in pending:
+            self.__outbox.put({"type": "data", "id": id, "payload": self.__format(result)})
+
+
+    def __format(self, result: ExecutionResult) -> dict:
+        payload = {"data": result.data}
+        if result.errors:
+            payload["errors"] = [format_error(error) for error in result.errors]
+
+        return payload
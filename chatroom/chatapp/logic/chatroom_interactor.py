@@ -1,10 +1,19 @@
+from dataclasses import dataclass
+from enum import Enum
 from typing import List, Type
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from django.http.request import HttpRequest
 
 from chatapp.models import AbstractChatroomMember, PrivateChatroom, PrivateChatroomMember, Chatroom, ChatroomMember, MemberRoles, AbstractChatroom
+from chatapp.models import AbstractMessage, ChatMessage, PrivateChatMessage
 from users.auth.auth import Auth
 from users.auth.decorator import require_sign_in
 from users.models import UserName
+from .membership_cache import get_room_membership, invalidate_room_membership
+from .presence import presence_registry
+from . import room_counters
+from .room_events import RoomEventType, notify_invitation, notify_room_event
 
 
 @require_sign_in
@@ -17,45 +26,103 @@ def create_private_chatroom(request: HttpRequest, name: str) -> PrivateChatroom:
     return PrivateChatroom.create(name=name, create_user= Auth(request).current_user)
 
 
-@require_sign_in
-def invitation(request: HttpRequest, room_id: str, user_ids: List[str]):
-    auth = Auth(request)
+def __get_member(request: HttpRequest, room_id, member_type: Type[AbstractChatroomMember]) -> AbstractChatroomMember:
+    """
+    キャッシュしたroleからメンバーを組み立てるため、DBへの問い合わせは発生しない(キャッシュが無い場合を除く)
+    ルームが存在しない場合はルームのDoesNotExistを、メンバーでない場合はmember_type.DoesNotExistを送出する
+    """
+    user = Auth(request).current_user
+    role = get_room_membership(member_type, room_id).role_of(user.pk)
+    if role is None:
+        raise member_type.DoesNotExist("%s matching query does not exist." % member_type._meta.object_name)
+
+    return member_type(user=user, room_id=room_id, role=role)
+
+
+class InvitationStatus(Enum):
+    INVITED = "invited"
+    ALREADY_MEMBER = "already_member"
+    NOT_FOUND = "not_found"
+
 
-    private_room = PrivateChatroom.objects.get(pk=room_id)
-    query = PrivateChatroomMember.objects.filter(user=auth.current_user, room=private_room)
-    if len(query) == 0 :
+@dataclass
+class InvitationResult:
+    user_id: str
+    status: InvitationStatus
+
+
+@require_sign_in
+def invitation(request: HttpRequest, room_id: str, user_ids: List[str]) -> List[InvitationResult]:
+    """
+    ユーザーの取得、既存メンバーの確認、追加をそれぞれ1回のクエリで行い、1トランザクションで招待する
+    既存メンバーを確認してから追加するまでに他の招待と競合しないよう、最初にルームの書き込みのロックを取る
+    結果はuser_idsの順番(重複は除く)に返す
+    """
+    try:
+        member: PrivateChatroomMember = __get_member(request, room_id, PrivateChatroomMember)
+    except (PrivateChatroom.DoesNotExist, PrivateChatroomMember.DoesNotExist) as err:
         # 招待を送ろうとしたユーザー自体がprivate roomに招待されていないということだが
         # その場合はルームの存在自体を知らせたくないため、「ルームが存在しない」旨のエラーをリターンする
-        Exception("指定のルームは存在しません")
+        raise Exception("指定のルームは存在しません") from err
 
-    member: PrivateChatroomMember = query[0]
     if not member.allow_update_room():
         raise Exception("権限がありません")
 
-    for user_id in user_ids:
-        user: UserName = UserName.objects.get(pk=user_id)
-        PrivateChatroomMember(user=user, room=private_room, role=MemberRoles.GUEST).save()
+    user_ids = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+    primary_ids = {user_id: int(user_id) for user_id in user_ids if user_id.isdecimal()}
+    with transaction.atomic():
+        room_counters.lock_room(PrivateChatroom, room_id)
+        found = set(UserName.objects.filter(pk__in=primary_ids.values()).values_list("pk", flat=True))
+        members = set(
+            PrivateChatroomMember.objects
+                .filter(room__pk=room_id, user__pk__in=found)
+                .values_list("user_id", flat=True)
+        )
+        PrivateChatroomMember.objects.bulk_create(
+            [PrivateChatroomMember(user_id=pk, room_id=room_id, role=MemberRoles.GUEST) for pk in found - members],
+            ignore_conflicts=True
+        )
+        room_counters.recount_members(PrivateChatroom, PrivateChatroomMember, room_id)
+        invited = found - members
+        if invited:
+            room_name = PrivateChatroom.objects.filter(pk=room_id).values_list("room_name", flat=True).first()
+            notify_invitation(room_id, room_name, sorted(invited))
+
+    invalidate_room_membership(PrivateChatroomMember, room_id)
+
+    def status(user_id: str) -> InvitationStatus:
+        pk = primary_ids.get(user_id)
+        if pk not in found:
+            return InvitationStatus.NOT_FOUND
+
+        return InvitationStatus.ALREADY_MEMBER if pk in members else InvitationStatus.INVITED
+
+    return [InvitationResult(user_id=user_id, status=status(user_id)) for user_id in user_ids]
 
 
 @require_sign_in
-def __disable_room(request: HttpRequest, room_id, room_type: Type[AbstractChatroom], member_type: Type[AbstractChatroomMember]) -> None:
-    auth = Auth(request)
-
-    room: room_type = room_type.objects.get(pk=room_id)
-    member: member_type = member_type.objects.get(user=auth.current_user, room=room)
+def __disable_room(
+    request: HttpRequest,
+    room_id,
+    room_kind: str,
+    room_type: Type[AbstractChatroom],
+    member_type: Type[AbstractChatroomMember]
+    ) -> None:
+    member: member_type = __get_member(request, room_id, member_type)
     if not member.allow_delete_room():
         raise Exception("権限がありません")
 
-    room.is_active = False
-    room.save()
+    room_type.objects.filter(pk=room_id).update(is_active=False)
+    invalidate_room_membership(member_type, room_id)
+    notify_room_event(RoomEventType.DELETED, room_kind, room_id)
 
 
 def disable_public_room(request: HttpRequest, room_id) -> None:
-    __disable_room(request, room_id, Chatroom, ChatroomMember)
+    __disable_room(request, room_id, "public", Chatroom, ChatroomMember)
 
 
 def disable_private_room(request: HttpRequest, room_id) -> None:
-    __disable_room(request, room_id, PrivateChatroom, PrivateChatroomMember)
+    __disable_room(request, room_id, "private", PrivateChatroom, PrivateChatroomMember)
 
 
 @require_sign_in
@@ -63,25 +130,26 @@ def __rename_room(
     request: HttpRequest,
     room_id,
     new_name: str,
+    room_kind: str,
     cls: Type[AbstractChatroom],
     member: Type[AbstractChatroomMember]
     )->AbstractChatroom:
 
-    auth = Auth(request)
-
-    room: AbstractChatroom = cls.objects.get(pk=room_id)
-    member: AbstractChatroomMember = member.objects.get(user=auth.current_user, room=room)
+    member: AbstractChatroomMember = __get_member(request, room_id, member)
     if not member.allow_update_room():
         raise Exception("権限がありません")
 
+    room: AbstractChatroom = cls.objects.get(pk=room_id)
+
     room.room_name = new_name
     room.save()
+    notify_room_event(RoomEventType.RENAMED, room_kind, room_id, room_name=new_name)
 
     return room
 
 
 def rename_public_room(request: HttpRequest, room_id: str, new_name: str) -> Chatroom:
-    return __rename_room(request, room_id, new_name, Chatroom, ChatroomMember)
+    return __rename_room(request, room_id, new_name, "public", Chatroom, ChatroomMember)
 
 
 def rename_private_room(request: HttpRequest, room_id: str, new_name: str) -> PrivateChatroom:
@@ -90,24 +158,29 @@ def rename_private_room(request: HttpRequest, room_id: str, new_name: str) -> Pr
     ルームの存在自体を知らせたくないため、「指定のルームは存在しません」というエラーを返す
     """
     try:
-        return __rename_room(request, room_id, new_name, PrivateChatroom, PrivateChatroomMember)
+        return __rename_room(request, room_id, new_name, "private", PrivateChatroom, PrivateChatroomMember)
     except PrivateChatroomMember.DoesNotExist:
         pass
 
     raise Exception("指定のルームは存在しません")
 
 
-#todo ここでwebsocket通信を確立する
 @require_sign_in
 def __enter_room(request: HttpRequest, room_id: str, room_type: Type[AbstractChatroom], member_type: Type[AbstractChatroomMember]) -> None:
-    room = room_type.objects.get(pk=room_id)
+    """
+    メンバーでなければ追加する
+    在室状況はWebSocketの接続をPresenceRegistryが記録するため、ここではis_enterを更新しない
+    """
     user = Auth(request).current_user
-    member_query = member_type.objects.filter(user=user, room=room)
-    if len(member_query) == 0:
-        member_type.objects.create(user=user, is_enter=True, role=MemberRoles.GUEST, room=room)
-    else:
-        member_query[0].is_enter = True
-        member_query[0].save()
+    if get_room_membership(member_type, room_id).role_of(user.pk) is not None:
+        return
+
+    with transaction.atomic():
+        _, created = member_type.objects.get_or_create(user=user, room_id=room_id, defaults={"role": MemberRoles.GUEST})
+        if created:
+            room_counters.add_member(room_type, room_id)
+
+    invalidate_room_membership(member_type, room_id)
 
 
 def enter_public_room(request: HttpRequest, room_id: str):
@@ -119,20 +192,84 @@ def enter_private_room(request: HttpRequest, room_id: str):
 
 
 @require_sign_in
-def __exit_room(request: HttpRequest, room_id: str, room_type: Type[AbstractChatroom], member_type: Type[AbstractChatroomMember]) -> None:
-    room = room_type.objects.get(pk=room_id)
+def __exit_room(request: HttpRequest, room_id: str, room_kind: str, member_type: Type[AbstractChatroomMember]) -> None:
+    """
+    ルームに開いている接続を切断する
+    """
     user = Auth(request).current_user
-    member_query = member_type.objects.filter(user=user, room=room)
-
-    if len(member_query) > 0:
-        member_query[0].is_enter =  False
-        member_query[0].save()
+    if get_room_membership(member_type, room_id).role_of(user.pk) is not None:
+        presence_registry.disconnect_user(room_kind, room_id, user.pk)
 
 
 def exit_public_room(request: HttpRequest, room_id: str):
-    __exit_room(request, room_id, Chatroom, ChatroomMember)
+    __exit_room(request, room_id, "public", ChatroomMember)
 
 
 def exit_private_room(request: HttpRequest, room_id: str):
-    __exit_room(request, room_id, PrivateChatroom, PrivateChatroomMember)
+    __exit_room(request, room_id, "private", PrivateChatroomMember)
+
+
+@require_sign_in
+def __is_room_member(request: HttpRequest, room_id: str, member_type: Type[AbstractChatroomMember]) -> bool:
+    """
+    ルームが有効で、メンバーになっているかどうかをキャッシュから確認する
+    """
+    user = Auth(request).current_user
+    try:
+        membership = get_room_membership(member_type, room_id)
+    except ObjectDoesNotExist:
+        return False
+
+    return membership.is_active and membership.role_of(user.pk) is not None
+
+
+def is_public_room_member(request: HttpRequest, room_id: str) -> bool:
+    return __is_room_member(request, room_id, ChatroomMember)
+
+
+def is_private_room_member(request: HttpRequest, room_id: str) -> bool:
+    return __is_room_member(request, room_id, PrivateChatroomMember)
+
+
+def public_room_presence(room_id: str) -> List[int]:
+    """
+    WebSocketで接続中のユーザーのidを返す
+    """
+    return presence_registry.users_in("public", room_id)
+
+
+@require_sign_in
+def private_room_presence(request: HttpRequest, room_id: str) -> List[int]:
+    if not __is_room_member(request, room_id, PrivateChatroomMember):
+        raise Exception("指定のルームは存在しません")
+
+    return presence_registry.users_in("private", room_id)
+
+
+@require_sign_in
+def __prepare_message(
+    request: HttpRequest,
+    room_id: str,
+    text: str,
+    member_type: Type[AbstractChatroomMember],
+    message_type: Type[AbstractMessage]
+    ) -> AbstractMessage:
+    """
+    メンバーになっているルームへ送信するメッセージを検証して返す
+    保存はMessageWriteBufferでまとめて行うため、ここではsaveしない
+    """
+    if not __is_room_member(request, room_id, member_type):
+        raise Exception("ルームに入室していません")
+
+    message = message_type(sender=Auth(request).current_user, room_id=room_id, text=text)
+    message.full_clean(exclude=["sender", "room"])
+
+    return message
+
+
+def prepare_public_message(request: HttpRequest, room_id: str, text: str) -> ChatMessage:
+    return __prepare_message(request, room_id, text, ChatroomMember, ChatMessage)
+
 
+def prepare_private_message(request: HttpRequest, room_id: str, text: str) -> PrivateChatMessage:
+    return __prepare_message(request, room_id, text, PrivateChatroomMember, PrivateChatMessage)
@@ -0,0 +1,60 @@
+from dataclasses import dataclass
+from typing import Dict, Final, Optional, Type
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+
+
+MEMBERSHIP_CACHE_TIMEOUT: Final[int] = getattr(settings, "CHAT_MEMBERSHIP_CACHE_TIMEOUT", 300)
+
+
+@dataclass(frozen=True)
+class RoomMembership:
+    """
+    権限の確認に必要なルームの情報と、メンバーのuser_idからroleへの対応
+    """
+    create_user_id: Optional[int]
+    is_active: bool
+    roles: Dict[int, str]
+
+    def role_of(self, user_id: int) -> Optional[str]:
+        return self.roles.get(user_id)
+
+
+def __cache_key(member_type: Type[models.Model], room_id) -> str:
+    return "chatroom-membership-%s-%s" % (member_type._meta.label_lower, room_id)
+
+
+def get_room_membership(member_type: Type[models.Model], room_id) -> RoomMembership:
+    """
+    キャッシュに無い場合だけ、ルームとメンバーを1回ずつ問い合わせてキャッシュする
+    ルームが存在しない場合はroomのモデルのDoesNotExistを送出する
+
+    キャッシュは全てのリクエストで共有するため、use_replicaの中でも必ずdefaultから読み込む
+    遅延しているレプリカから読むと、古いメンバーがタイムアウトまでキャッシュに残り続けるため
+    """
+    key = __cache_key(member_type, room_id)
+    membership = cache.get(key)
+    if membership is not None:
+        return membership
+
+    room_type = member_type._meta.get_field("room").related_model
+    room = room_type.objects.using("default").filter(pk=room_id).values("create_user_id", "is_active").first()
+    if room is None:
+        raise room_type.DoesNotExist("%s matching query does not exist." % room_type._meta.object_name)
+
+    membership = RoomMembership(
+        create_user_id=room["create_user_id"],
+        is_active=room["is_active"],
+        roles=dict(member_type.objects.using("default").filter(room__pk=room_id).values_list("user_id", "role"))
+    )
+    cache.set(key, membership, MEMBERSHIP_CACHE_TIMEOUT)
+    return membership
+
+
+def invalidate_room_membership(member_type: Type[models.Model], room_id) -> None:
+    """
+    メンバーの追加・削除、roleやルームの状態を変更したときに呼び出す
+    """
+    cache.delete(__cache_key(member_type, room_id))
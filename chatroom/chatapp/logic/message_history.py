@@ -0,0 +1,104 @@
+import base64
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Final, List, Optional, Tuple, Type
+
+from django.http.request import HttpRequest
+from django.utils.dateparse import parse_datetime
+
+from chatapp.models import AbstractMessage, ChatMessage, PrivateChatMessage, PrivateChatroom, PrivateChatroomMember
+from users.auth.auth import Auth
+from users.auth.decorator import require_sign_in
+from .membership_cache import get_room_membership
+
+
+DEFAULT_PAGE_SIZE: Final[int] = 50
+MAX_PAGE_SIZE: Final[int] = 100
+
+
+@dataclass
+class MessagePage:
+    messages: List[AbstractMessage]
+    has_previous_page: bool
+    has_next_page: bool
+
+
+def encode_cursor(message: AbstractMessage) -> str:
+    """
+    (send_date, id)をcursorにする。索引(room, send_date, id)の並びと一致させること
+    """
+    return base64.urlsafe_b64encode(f"{message.send_date.isoformat()}|{message.id}".encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        send_date, id = base64.urlsafe_b64decode(cursor).decode("utf-8").split("|")
+        return parse_datetime(send_date), int(id)
+    except (ValueError, UnicodeDecodeError) as err:
+        raise Exception(f"cursor「{cursor}」が不正です") from err
+
+
+def __fetch_messages(
+    room_id: str,
+    message_type: Type[AbstractMessage],
+    before: Optional[str],
+    after: Optional[str],
+    first: Optional[int],
+    last: Optional[int]
+    ) -> MessagePage:
+    """
+    OFFSETを使わず、cursorの位置から索引を辿って必要な件数だけ取得する
+    first/lastのどちらも指定されていない場合は最新のDEFAULT_PAGE_SIZE件を返す
+    """
+    if first is not None and last is not None:
+        raise Exception("firstとlastは同時に指定できません")
+
+    for size in (first, last):
+        if size is not None and not 0 <= size <= MAX_PAGE_SIZE:
+            raise Exception(f"取得件数は0以上{MAX_PAGE_SIZE}以下で指定してください")
+
+    query = message_type.objects.filter(room__pk=room_id)
+    # (send_date, id) > (d, i) を、send_dateの範囲検索で索引を使える形に展開している
+    if after is not None:
+        send_date, id = decode_cursor(after)
+        query = query.filter(send_date__gte=send_date).exclude(send_date=send_date, id__lte=id)
+
+    if before is not None:
+        send_date, id = decode_cursor(before)
+        query = query.filter(send_date__lte=send_date).exclude(send_date=send_date, id__gte=id)
+
+    if first is not None:
+        messages = list(query.order_by("send_date", "id")[:first + 1])
+        return MessagePage(
+            messages=messages[:first],
+            has_previous_page=after is not None,
+            has_next_page=len(messages) > first
+        )
+
+    last = DEFAULT_PAGE_SIZE if last is None else last
+    messages = list(query.order_by("-send_date", "-id")[:last + 1])
+    return MessagePage(
+        messages=list(reversed(messages[:last])),
+        has_previous_page=len(messages) > last,
+        has_next_page=before is not None
+    )
+
+
+def fetch_public_room_messages(room_id: str, before=None, after=None, first=None, last=None) -> MessagePage:
+    return __fetch_messages(room_id, ChatMessage, before, after, first, last)
+
+
+@require_sign_in
+def fetch_private_room_messages(request: HttpRequest, room_id: str, before=None, after=None, first=None, last=None) -> MessagePage:
+    """
+    privateルームの存在自体を知らせないため、招待されていない場合は「指定のルームは存在しません」を返す
+    """
+    try:
+        is_member = get_room_membership(PrivateChatroomMember, room_id).role_of(Auth(request).current_user.pk) is not None
+    except PrivateChatroom.DoesNotExist:
+        is_member = False
+
+    if not is_member:
+        raise Exception("指定のルームは存在しません")
+
+    return __fetch_messages(room_id, PrivateChatMessage, before, after, first, last)
@@ -0,0 +1,122 @@
+import asyncio
+from typing import Dict, Final, List, Tuple, Type
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+
+from chatapp.models import AbstractMessage
+from chatapp.logic import room_counters
+
+
+PendingMessage = Tuple[AbstractMessage, asyncio.Future]
+
+# SQLiteで他のプロセスが書き込み中のためにロックを取れなかった場合に、書き込みを再試行する回数と最初の待ち時間(秒)
+LOCKED_RETRIES: Final[int] = 5
+LOCKED_BACKOFF: Final[float] = 0.05
+
+
+def is_database_locked(err: Exception) -> bool:
+    """
+    SQLiteのbusy_timeoutを過ぎても書き込みのロックを取れなかった場合のエラーかどうか
+    """
+    return isinstance(err, OperationalError) and "locked" in str(err)
+
+
+def bulk_insert_messages(message_type: Type[AbstractMessage], messages: List[AbstractMessage]) -> None:
+    """
+    1トランザクションでメッセージをまとめて保存し、ルームごとのメッセージ数と最終投稿日時も更新する
+    messagesはすべて同じルームのメッセージであること
+    """
+    with transaction.atomic():
+        message_type.objects.bulk_create(messages)
+
+        if not connection.features.can_return_rows_from_bulk_insert and connection.vendor == "sqlite":
+            # SQLiteはbulk_createで主キーを返さないが、書き込みロックを保持している間は
+            # 直前に挿入した行が末尾の連番になるため、そこから主キーを補完する
+            ids = message_type.objects.order_by("-id").values_list("id", flat=True)[:len(messages)]
+            for message, id in zip(messages, reversed(list(ids))):
+                message.id = id
+
+        room_counters.add_messages(
+            message_type._meta.get_field("room").related_model,
+            messages[0].room_id,
+            len(messages),
+            max(message.send_date for message in messages)
+        )
+
+
+class MessageWriteBuffer:
+    """
+    メッセージをルームごとに溜めて、件数(max_batch_size)か待ち時間(max_delay)のしきい値で
+    bulk_createする書き込みバッファ
+
+    同じルームのバッファは順番に書き込むので、ルーム内の送信順は保存後も保たれる
+    writeはコミットが完了してから返るため、呼び出し元はその後に送信者へ完了を通知すればよい
+    SQLiteのロックを取れずに失敗した場合は、同じルームの次のバッチを待たせたまま間隔を倍にしながら再試行する
+    """
+    def __init__(self, max_batch_size: int = 100, max_delay: float = 0.05) -> None:
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.__pending: Dict[tuple, List[PendingMessage]] = {}
+        self.__timers: Dict[tuple, asyncio.TimerHandle] = {}
+        self.__locks: Dict[tuple, asyncio.Lock] = {}
+
+
+    async def write(self, message: AbstractMessage) -> AbstractMessage:
+        key = (type(message), message.room_id)
+        future = asyncio.get_running_loop().create_future()
+        pending = self.__pending.setdefault(key, [])
+        pending.append((message, future))
+
+        if len(pending) >= self.max_batch_size:
+            asyncio.ensure_future(self.__flush(key))
+        elif key not in self.__timers:
+            self.__timers[key] = asyncio.get_running_loop().call_later(
+                self.max_delay,
+                lambda: asyncio.ensure_future(self.__flush(key))
+            )
+
+        return await future
+
+
+    async def __flush(self, key: tuple) -> None:
+        timer = self.__timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+        batch = self.__pending.pop(key, [])
+        if not batch:
+            return
+
+        # 先に取り出したバッチの書き込みが終わるまで、同じルームの次のバッチは待たせる
+        async with self.__locks.setdefault(key, asyncio.Lock()):
+            try:
+                await self.__insert(key[0], [message for message, _ in batch])
+            except Exception as err:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(err)
+                return
+
+        for message, future in batch:
+            if not future.done():
+                future.set_result(message)
+
+
+    async def __insert(self, message_type: Type[AbstractMessage], messages: List[AbstractMessage]) -> None:
+        for attempt in range(LOCKED_RETRIES + 1):
+            try:
+                await database_sync_to_async(bulk_insert_messages)(message_type, messages)
+                return
+            except OperationalError as err:
+                if not is_database_locked(err) or attempt == LOCKED_RETRIES:
+                    raise
+
+            await asyncio.sleep(LOCKED_BACKOFF * 2 ** attempt)
+
+
+message_write_buffer = MessageWriteBuffer(
+    max_batch_size=getattr(settings, "CHAT_MESSAGE_BATCH_SIZE", 100),
+    max_delay=getattr(settings, "CHAT_MESSAGE_BATCH_DELAY", 0.05),
+)
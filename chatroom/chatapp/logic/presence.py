@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import math
+import time
+from typing import Dict, Final, List, Optional, Set, Tuple
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from chatapp.models import ChatroomMember, PrivateChatroomMember
+from common.cache import versioned_value
+
+
+logger = logging.getLogger(__name__)
+
+ROOM_MEMBER_TYPES: Final = {"public": ChatroomMember, "private": PrivateChatroomMember}
+
+# (room_kind, room_id)
+RoomKey = Tuple[str, str]
+# channel名 -> (room_idまたはuser_id, 期限のUNIX時刻)
+Entries = Dict[str, Tuple[object, float]]
+
+
+def user_room_group_name(room_kind: str, room_id, user_id: int) -> str:
+    """
+    ユーザーがルームで開いている接続が参加するchannel layerのgroup名
+    どのワーカーの接続でも、ExitChatroomで切断できるようにするため
+    """
+    return "chatroom-%s-%s-user-%s" % (room_kind, room_id, user_id)
+
+
+def write_room_presence(room_kind: str, room_id, user_ids: Set[int]) -> None:
+    """
+    ルームのメンバーのis_enterを、user_idsに含まれるかどうかで更新する
+    """
+    members = ROOM_MEMBER_TYPES[room_kind].objects.filter(room__pk=room_id)
+    members.filter(user__pk__in=user_ids, is_enter=False).update(is_enter=True)
+    members.exclude(user__pk__in=user_ids).filter(is_enter=True).update(is_enter=False)
+
+
+def _room_key(room_kind: str, room_id) -> str:
+    return "chat-presence-room-%s-%s" % (room_kind, room_id)
+
+
+def _user_key(room_kind: str, user_id: int) -> str:
+    return "chat-presence-user-%s-%s" % (room_kind, user_id)
+
+
+def _update(key: str, ttl: float, add: Optional[Entries] = None, remove: Set[str] = frozenset()) -> None:
+    """
+    キーの記録に追加・削除し、期限切れの接続を取り除いて書き戻す
+    """
+    def apply(entries: Optional[Entries]) -> Entries:
+        now = time.time()
+        entries = {**(entries or {}), **(add or {})}
+        return {channel_name: entry for channel_name, entry in entries.items() if channel_name not in remove and entry[1] > now}
+
+    versioned_value.update(key, apply, math.ceil(ttl))
+
+
+def _alive(key: str) -> Entries:
+    now = time.time()
+    return {channel_name: entry for channel_name, entry in versioned_value.get(key, {}).items() if entry[1] > now}
+
+
+class PresenceRegistry:
+    """
+    WebSocketで接続中のユーザーを、接続(channel名)ごとにCACHESへ記録して全てのワーカーで共有する
+    接続はtouchされるたびにttl秒延長され、期限が切れた接続は切断されたものとみなす
+    ルームごとのキーとユーザーごとのキーに記録し、ロックを取らずにversioned_valueで更新する
+    キャッシュへの問い合わせはdatabase_sync_to_asyncと共有するスレッドを使わずに実行し、DBの問い合わせを待たせない
+
+    入退室のたびにDBへ書き込まないよう、is_enterへはcheckpoint_interval秒ごとに書き込む
+    書き込むのはこのワーカーの接続があるルームだけで、値はワーカーごとの差分ではなく共有している在室状況から決める
+    他のワーカーが書き込んだis_enterを上書きしないようにするため
+    """
+    def __init__(self, ttl: float = 60, checkpoint_interval: float = 30) -> None:
+        self.ttl = ttl
+        self.checkpoint_interval = checkpoint_interval
+        # このワーカーの接続。channel名 -> (ルーム, user_id)
+        self.__connections: Dict[str, Tuple[RoomKey, int]] = {}
+        # 前回のcheckpointで書き込んだルームごとの在室中のuser_id
+        self.__checkpointed: Dict[RoomKey, Set[int]] = {}
+        self.__checkpoint_task: Optional[asyncio.Task] = None
+
+
+    async def touch(self, room_kind: str, room_id, user_id: int, channel_name: str) -> None:
+        """
+        接続時とheartbeatを受け取ったときに呼び出す
+        """
+        room = (room_kind, str(room_id))
+        self.__connections[channel_name] = (room, user_id)
+        await sync_to_async(self.__touch, thread_sensitive=False)(room, user_id, channel_name)
+        self.__start_checkpoint()
+
+
+    async def leave(self, channel_name: str) -> None:
+        entry = self.__connections.pop(channel_name, None)
+        if entry is not None:
+            (room_kind, room_id), user_id = entry
+            await sync_to_async(self.__remove, thread_sensitive=False)(room_kind, room_id, {channel_name: user_id})
+
+
+    def disconnect_user(self, room_kind: str, room_id, user_id: int) -> None:
+        """
+        ユーザーがルームで開いている接続を、どのワーカーの接続かに関わらずすべて切断する
+        接続が切断されるのを待たずに、在室中の記録からも取り除く
+        """
+        channels = {
+            channel_name: id
+            for channel_name, (id, _) in _alive(_room_key(room_kind, room_id)).items()
+            if id == user_id
+        }
+        self.__remove(room_kind, str(room_id), channels)
+        async_to_sync(get_channel_layer().group_send)(user_room_group_name(room_kind, room_id, user_id), {"type": "room.exit"})
+
+
+    def users_in(self, room_kind: str, room_id) -> List[int]:
+        return list(dict.fromkeys(user_id for user_id, _ in _alive(_room_key(room_kind, room_id)).values()))
+
+
+    def rooms_of(self, room_kind: str, user_id: int) -> List[str]:
+        return list(dict.fromkeys(room_id for room_id, _ in _alive(_user_key(room_kind, user_id)).values()))
+
+
+    async def checkpoint(self) -> None:
+        active = {room for room, _ in self.__connections.values()}
+        await database_sync_to_async(self.__checkpoint)(set(self.__checkpointed) | active, active)
+
+
+    def __checkpoint(self, rooms: Set[RoomKey], active: Set[RoomKey]) -> None:
+        for room in rooms:
+            present = set(self.users_in(*room))
+            if present != self.__checkpointed.get(room):
+                write_room_presence(*room, present)
+
+            # 接続が無くなったルームは、退室を書き込んだ後は他のワーカーに任せる
+            if room in active:
+                self.__checkpointed[room] = present
+            else:
+                self.__checkpointed.pop(room, None)
+
+
+    def __touch(self, room: RoomKey, user_id: int, channel_name: str) -> None:
+        expires = time.time() + self.ttl
+        _update(_room_key(*room), self.ttl, add={channel_name: (user_id, expires)})
+        _update(_user_key(room[0], user_id), self.ttl, add={channel_name: (room[1], expires)})
+
+
+    def __remove(self, room_kind: str, room_id: str, channels: Dict[str, int]) -> None:
+        """
+        channelsは channel名 -> user_id
+        """
+        if not channels:
+            return
+
+        _update(_room_key(room_kind, room_id), self.ttl, remove=set(channels))
+        for user_id in set(channels.values()):
+            _update(_user_key(room_kind, user_id), self.ttl, remove=set(channels))
+
+
+    def __start_checkpoint(self) -> None:
+        loop = asyncio.get_running_loop()
+        task = self.__checkpoint_task
+        if task is not None and not task.done() and task.get_loop() is loop:
+            return
+
+        self.__checkpoint_task = loop.create_task(self.__run_checkpoint())
+
+
+    async def __run_checkpoint(self) -> None:
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                await self.checkpoint()
+            except Exception:
+                logger.exception("在室状況をDBへ書き込めませんでした")
+
+
+presence_registry = PresenceRegistry(
+    ttl=getattr(settings, "CHAT_PRESENCE_TTL", 60),
+    checkpoint_interval=getattr(settings, "CHAT_PRESENCE_CHECKPOINT_INTERVAL", 30),
+)
@@ -0,0 +1,65 @@
+from datetime import datetime
+from typing import Optional, Type
+
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+from chatapp.models import AbstractChatroom, AbstractChatroomMember, AbstractMessage
+
+
+def add_messages(room_type: Type[AbstractChatroom], room_id, count: int, last_message_at: datetime) -> None:
+    """
+    メッセージを保存したトランザクションの中で呼び出す
+    """
+    room_type.objects.filter(pk=room_id).update(
+        message_count=F("message_count") + count,
+        last_message_at=Greatest(Coalesce("last_message_at", last_message_at), last_message_at)
+    )
+
+
+def lock_room(room_type: Type[AbstractChatroom], room_id) -> None:
+    """
+    読み込んだ結果から書き込むトランザクションの最初に呼び出し、ルームの行を更新して書き込みのロックを取る
+    SQLiteは読み込みから始めたトランザクションが書き込もうとした時に他の書き込みと競合すると、
+    busy_timeoutを待たずに「database is locked」で失敗するため
+    PostgreSQLでは同じルームへのトランザクションが行のロックで順番に実行される
+    """
+    room_type.objects.filter(pk=room_id).update(member_count=F("member_count"))
+
+
+def add_member(room_type: Type[AbstractChatroom], room_id) -> None:
+    room_type.objects.filter(pk=room_id).update(member_count=F("member_count") + 1)
+
+
+def recount_members(room_type: Type[AbstractChatroom], member_type: Type[AbstractChatroomMember], room_id) -> None:
+    """
+    まとめて追加した件数が分からない場合(bulk_createのignore_conflictsなど)はメンバー数を数え直す
+    """
+    room_type.objects.filter(pk=room_id).update(member_count=__member_count(member_type))
+
+
+def rebuild_counters(
+    room_type: Type[AbstractChatroom],
+    member_type: Type[AbstractChatroomMember],
+    message_type: Type[AbstractMessage],
+    room_id: Optional[int] = None
+    ) -> int:
+    """
+    メンバーとメッセージの集計値をすべて数え直して、更新したルームの数を返す
+    """
+    rooms = room_type.objects.all() if room_id is None else room_type.objects.filter(pk=room_id)
+    messages = message_type.objects.filter(room=OuterRef("pk"))
+    return rooms.update(
+        member_count=__member_count(member_type),
+        message_count=Coalesce(
+            Subquery(messages.values("room").annotate(count=Count("id")).values("count")),
+            0
+        ),
+        last_message_at=Subquery(messages.order_by("-send_date").values("send_date")[:1])
+    )
+
+
+def __member_count(member_type: Type[AbstractChatroomMember]):
+    # 退会したユーザー(userがNULL)はメンバーとして数えない
+    members = member_type.objects.filter(room=OuterRef("pk"), user__isnull=False)
+    return Coalesce(Subquery(members.values("room").annotate(count=Count("id")).values("count")), 0)
@@ -0,0 +1,87 @@
+import logging
+from enum import Enum
+from typing import Iterable
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from chatapp.models import AbstractMessage
+
+
+logger = logging.getLogger(__name__)
+
+
+class RoomEventType(Enum):
+    RENAMED = "renamed"
+    DELETED = "deleted"
+    INVITED = "invited"
+    MESSAGE = "message"
+
+
+def room_events_group(room_kind: str, room_id) -> str:
+    """
+    roomEventsを購読している接続が所属するchannel layerのgroup名
+    """
+    return "room-events-%s-%s" % (room_kind, room_id)
+
+
+def user_events_group(user_id) -> str:
+    """
+    invitedRoomsを購読している接続が所属するchannel layerのgroup名
+    """
+    return "user-events-%s" % user_id
+
+
+def room_event(group: str, event_type: RoomEventType, room_kind: str, room_id, **payload) -> dict:
+    """
+    channel layerで送るメッセージ。JSONに変換できる値だけを含める
+    """
+    return {
+        "type": "graphql.event",
+        "group": group,
+        "event": {"event_type": event_type.value, "room_kind": room_kind, "room_id": str(room_id), **payload},
+    }
+
+
+def message_payload(message: AbstractMessage) -> dict:
+    return {
+        "id": message.id,
+        "text": message.text,
+        "sender_id": message.sender_id,
+        "send_date": message.send_date.isoformat(),
+    }
+
+
+def __group_send_on_commit(messages: Iterable[dict]) -> None:
+    """
+    ロールバックされた変更を通知しないよう、コミットしてから送信する
+    通知に失敗しても、変更自体は成功しているため例外は送出しない
+    """
+    messages = list(messages)
+
+    def send():
+        channel_layer = get_channel_layer()
+        for message in messages:
+            try:
+                async_to_sync(channel_layer.group_send)(message["group"], message)
+            except Exception:
+                logger.exception("ルームのイベントを通知できませんでした")
+
+    transaction.on_commit(send)
+
+
+def notify_room_event(event_type: RoomEventType, room_kind: str, room_id, **payload) -> None:
+    __group_send_on_commit([room_event(room_events_group(room_kind, room_id), event_type, room_kind, room_id, **payload)])
+
+
+def notify_invitation(room_id, room_name: str, user_ids: Iterable[int]) -> None:
+    """
+    ルームのメンバーと、招待されたユーザーそれぞれに通知する
+    """
+    user_ids = list(user_ids)
+    payload = {"room_name": room_name, "user_ids": user_ids}
+    __group_send_on_commit(
+        [room_event(room_events_group("private", room_id), RoomEventType.INVITED, "private", room_id, **payload)] +
+        [room_event(user_events_group(user_id), RoomEventType.INVITED, "private", room_id, **payload) for user_id in user_ids]
+    )
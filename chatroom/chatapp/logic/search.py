@@ -0,0 +1,189 @@
+import functools
+from dataclasses import dataclass
+from typing import Final, List, Optional, Type
+
+from django.db import connections, router
+from django.http.request import HttpRequest
+
+from chatapp.models import AbstractChatroom, AbstractMessage, Chatroom, ChatMessage, PrivateChatroom, PrivateChatMessage, PrivateChatroomMember
+from users.auth.auth import Auth
+from users.models import UserName
+
+
+DEFAULT_SEARCH_SIZE: Final[int] = 20
+MAX_SEARCH_SIZE: Final[int] = 100
+# trigramは3文字未満の文字列を検索できないため、それより短い場合はicontainsで検索する
+MIN_FTS_QUERY_LENGTH: Final[int] = 3
+
+
+@dataclass
+class RoomSearchResult:
+    public_rooms: List[Chatroom]
+    private_rooms: List[PrivateChatroom]
+
+
+def __validate(query: str, size: Optional[int]) -> int:
+    if not query:
+        raise Exception("検索する文字列を指定してください")
+
+    size = DEFAULT_SEARCH_SIZE if size is None else size
+    if not 0 <= size <= MAX_SEARCH_SIZE:
+        raise Exception(f"取得件数は0以上{MAX_SEARCH_SIZE}以下で指定してください")
+
+    return size
+
+
+@functools.lru_cache(maxsize=None)
+def __has_search_index(alias: str, table: str) -> bool:
+    return table in connections[alias].introspection.table_names()
+
+
+def __fts_database(model, query: str) -> Optional[str]:
+    """
+    modelをFTS5で検索できる場合は、読み込み先のDBのaliasを返す
+    FTS5の仮想テーブル(migration 0006_search_index)は、SQLiteがtrigramに対応している(3.34.0以降)場合だけ作成している
+    """
+    if len(query) < MIN_FTS_QUERY_LENGTH:
+        return None
+
+    alias = router.db_for_read(model)
+    if connections[alias].vendor != "sqlite" or not __has_search_index(alias, f"{model._meta.db_table}_fts"):
+        return None
+
+    return alias
+
+
+def __match_phrase(query: str) -> str:
+    # FTS5の演算子として解釈されないよう、全体を1つのフレーズとして検索する
+    return '"%s"' % query.replace('"', '""')
+
+
+def __fetch_in_order(model, ids: List[int]) -> list:
+    objects = model.objects.in_bulk(ids)
+    return [objects[id] for id in ids if id in objects]
+
+
+def __search_room_ids(alias: str, room_type: Type[AbstractChatroom], query: str, size: int, member: Optional[UserName]) -> List[int]:
+    """
+    memberを指定した場合は、そのユーザーがメンバーになっているルームだけを返す
+    """
+    room_table = room_type._meta.db_table
+    member_join, params = "", []
+    if member is not None:
+        member_join = f"JOIN {PrivateChatroomMember._meta.db_table} m ON m.room_id = r.id AND m.user_id = %s"
+        params.append(member.pk)
+
+    with connections[alias].cursor() as cursor:
+        cursor.execute(
+            f"SELECT r.id FROM {room_table}_fts f JOIN {room_table} r ON r.id = f.rowid {member_join} "
+            f"WHERE f.{room_table}_fts MATCH %s AND r.is_active ORDER BY f.rank LIMIT %s",
+            params + [__match_phrase(query), size]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def __search_message_ids(
+    alias: str,
+    message_type: Type[AbstractMessage],
+    query: str,
+    size: int,
+    room_id: Optional[str],
+    member: Optional[UserName]
+    ) -> List[int]:
+    """
+    新しいメッセージから順にsize件を返す
+    """
+    message_table = message_type._meta.db_table
+    room_table = message_type._meta.get_field("room").related_model._meta.db_table
+    joins, conditions, params = "", "", []
+    if member is not None:
+        joins = f"JOIN {PrivateChatroomMember._meta.db_table} m ON m.room_id = msg.room_id AND m.user_id = %s"
+        params.append(member.pk)
+
+    params.append(__match_phrase(query))
+    if room_id is not None:
+        conditions = "AND msg.room_id = %s"
+        params.append(room_id)
+
+    with connections[alias].cursor() as cursor:
+        cursor.execute(
+            f"SELECT msg.id FROM {message_table}_fts f JOIN {message_table} msg ON msg.id = f.rowid "
+            f"JOIN {room_table} r ON r.id = msg.room_id {joins} "
+            f"WHERE f.{message_table}_fts MATCH %s AND r.is_active {conditions} ORDER BY f.rowid DESC LIMIT %s",
+            params + [size]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search_rooms(request: HttpRequest, query: str, size: Optional[int] = None) -> RoomSearchResult:
+    """
+    ルーム名を部分一致で検索する
+    privateルームはPrivateChatroomNode.get_querysetと同様に、メンバーになっているルームだけを返す
+    """
+    size = __validate(query, size)
+    user = Auth(request).current_user
+    return RoomSearchResult(
+        public_rooms=__search_rooms(Chatroom, query, size, None),
+        private_rooms=[] if user is None else __search_rooms(PrivateChatroom, query, size, user)
+    )
+
+
+def __search_rooms(room_type: Type[AbstractChatroom], query: str, size: int, member: Optional[UserName]) -> List[AbstractChatroom]:
+    alias = __fts_database(room_type, query)
+    if alias is not None:
+        return __fetch_in_order(room_type, __search_room_ids(alias, room_type, query, size, member))
+
+    rooms = room_type.objects.filter(is_active=True, room_name__icontains=query)
+    if member is not None:
+        rooms = rooms.filter(privatechatroommember__user=member)
+
+    return list(rooms.order_by("-id")[:size])
+
+
+def __search_messages(
+    message_type: Type[AbstractMessage],
+    query: str,
+    size: int,
+    room_id: Optional[str],
+    member: Optional[UserName]
+    ) -> List[AbstractMessage]:
+    alias = __fts_database(message_type, query)
+    if alias is not None:
+        return __fetch_in_order(message_type, __search_message_ids(alias, message_type, query, size, room_id, member))
+
+    messages = message_type.objects.filter(text__icontains=query, room__is_active=True)
+    if room_id is not None:
+        messages = messages.filter(room__pk=room_id)
+
+    if member is not None:
+        messages = messages.filter(room__privatechatroommember__user=member)
+
+    return list(messages.order_by("-id")[:size])
+
+
+def search_public_messages(query: str, room_id: Optional[str] = None, size: Optional[int] = None) -> List[ChatMessage]:
+    """
+    新しいメッセージから順に返す。room_idを指定した場合はそのルームのメッセージだけを検索する
+    """
+    return __search_messages(ChatMessage, query, __validate(query, size), room_id, None)
+
+
+def search_private_messages(request: HttpRequest, query: str, room_id: Optional[str] = None, size: Optional[int] = None) -> List[PrivateChatMessage]:
+    """
+    メンバーになっているprivateルームのメッセージだけを検索する
+    """
+    size = __validate(query, size)
+    user = Auth(request).current_user
+    if user is None:
+        return []
+
+    return __search_messages(PrivateChatMessage, query, size, room_id, user)
+
+
+def search_messages(request: HttpRequest, query: str, size: Optional[int] = None) -> List[AbstractMessage]:
+    """
+    publicルームとメンバーになっているprivateルームのメッセージを、新しい順にまとめて返す
+    """
+    size = __validate(query, size)
+    messages = search_public_messages(query, size=size) + search_private_messages(request, query, size=size)
+    return sorted(messages, key=lambda message: (message.send_date, message.id), reverse=True)[:size]
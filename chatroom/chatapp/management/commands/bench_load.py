@@ -0,0 +1,256 @@
+import asyncio
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Tuple
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+
+from chatapp.models import Chatroom, ChatMessage, PrivateChatroom
+from common.nodes.url_safe_encode_node import UrlSafeEncodeNode
+from common.ratelimit.token_bucket import rate_limiter
+from common.testing.load import LoadRecorder, OperationStats, QueryTally, find_regressions, load_baseline, save_baseline
+from users.models import UserName, UserOnMyApp, UserProfile
+
+
+# (操作名, クエリ, 変数を作る関数(client番号, Seed, clientごとの乱数) -> dict)
+Operation = Tuple[str, str, Callable[[int, "Seed", random.Random], dict]]
+
+
+class Seed:
+    def __init__(self, users: List[UserOnMyApp], user_ids: List[str], rooms: List[str], private_rooms: List[str]) -> None:
+        self.users = users
+        self.user_ids = user_ids
+        self.rooms = rooms
+        self.private_rooms = private_rooms
+
+
+OPERATIONS: List[Operation] = [
+    (
+        "allChatrooms",
+        '{ allChatrooms(first: 20, orderBy: "-last_message_at") { edges { node { roomName memberCount createUser { username } } } } }',
+        lambda client, seed, rng: {}
+    ),
+    (
+        "allProfiles",
+        "{ allProfiles(first: 20) { edges { node { selfIntroduction icon user { username } } } } }",
+        lambda client, seed, rng: {}
+    ),
+    (
+        "roomMessages",
+        "query($room: ID!) { roomMessages(roomId: $room, last: 20) { edges { node { text sendDate sender { username } } } } }",
+        lambda client, seed, rng: {"room": rng.choice(seed.rooms)}
+    ),
+    (
+        "searchRooms",
+        '{ searchRooms(query: "room-1") { publicRooms { roomName } } }',
+        lambda client, seed, rng: {}
+    ),
+    (
+        "createPublicChatroom",
+        'mutation($name: String) { createPublicChatroom(name: $name, description: "") { ok } }',
+        lambda client, seed, rng: {"name": "bench-%s" % uuid.uuid4().hex[:12]}
+    ),
+    (
+        "invitationUser",
+        "mutation($room: ID, $users: [ID]) { invitationUser(room: $room, users: $users) { ok } }",
+        lambda client, seed, rng: {"room": seed.private_rooms[client], "users": rng.sample(seed.user_ids, 3)}
+    ),
+]
+
+
+class Command(BaseCommand):
+    help = "一時的なDBにデータを作成し、GraphQLとWebSocketへ同時に負荷をかけて操作ごとのレイテンシ・スループット・SQLの件数を計測する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=8, help="同時に実行するGraphQLのクライアント数")
+        parser.add_argument("--requests", type=int, default=60, help="GraphQLのクライアント1つあたりのリクエスト数")
+        parser.add_argument("--ws-clients", type=int, default=20, help="同時に接続するWebSocketのクライアント数")
+        parser.add_argument("--ws-messages", type=int, default=20, help="WebSocketのクライアント1つあたりの送信数")
+        parser.add_argument("--users", type=int, default=200, help="作成するユーザー数")
+        parser.add_argument("--rooms", type=int, default=200, help="作成するpublicルーム数")
+        parser.add_argument("--messages", type=int, default=20, help="publicルーム1つあたりに作成するメッセージ数")
+        parser.add_argument("--seed", type=int, default=0, help="乱数のseed")
+        parser.add_argument("--save-baseline", metavar="PATH", help="計測結果をベースラインとしてJSONに保存する")
+        parser.add_argument("--compare", metavar="PATH", help="ベースラインと比較し、悪化していれば失敗する")
+        parser.add_argument("--tolerance", type=float, default=0.5, help="p95の悪化を許容する割合")
+        parser.add_argument("--with-rate-limit", action="store_true", help="RATE_LIMITSを適用したまま計測する")
+
+    def handle(self, *args, **options):
+        if options["clients"] > options["users"]:
+            raise CommandError("--usersは--clients以上にしてください")
+
+        rates = rate_limiter.rates
+        if not options["with_rate_limit"]:
+            rate_limiter.rates = {}
+
+        with tempfile.TemporaryDirectory() as tmp:
+            old_name = self.create_database(tmp)
+            try:
+                # ユーザーの作成とサインインを速くするため、計測中は軽いハッシュを使う
+                with override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"]):
+                    seed = self.seed(options)
+                    stats = self.run(seed, options)
+            finally:
+                rate_limiter.rates = rates
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.report(stats)
+        if options["save_baseline"]:
+            save_baseline(options["save_baseline"], stats)
+            self.stdout.write(f"ベースラインを{options['save_baseline']}に保存しました")
+
+        if options["compare"]:
+            regressions = find_regressions(stats, load_baseline(options["compare"]), options["tolerance"])
+            if regressions:
+                raise CommandError("\n".join(["ベースラインより悪化しました"] + regressions))
+
+            self.stdout.write("ベースラインからの悪化はありません")
+
+    def create_database(self, tmp: str) -> str:
+        """
+        defaultの接続先をテスト用のDBに切り替える。SQLiteの場合は複数スレッドから使えるようファイルに作成する
+        計測結果は設定ファイルのDATABASEのPROFILE(sqlite、sqlite-wal、postgres)に依存する
+        """
+        old_name = connection.settings_dict["NAME"]
+        if connection.vendor == "sqlite":
+            connection.settings_dict.setdefault("TEST", {})["NAME"] = os.path.join(tmp, "bench.sqlite3")
+            # 同時の書き込みが即座にdatabase is lockedにならないよう、sqlite-walのPROFILEと同じくロックを待つ
+            connection.settings_dict.setdefault("OPTIONS", {}).setdefault("timeout", 5)
+
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        return old_name
+
+    def seed(self, options) -> Seed:
+        users = [
+            UserOnMyApp.objects.create_user(username=f"bench-{i}", email=f"bench-{i}@example.com", password="bench")
+            for i in range(options["clients"])
+        ]
+        UserName.objects.bulk_create([UserName(username=f"member-{i}") for i in range(options["users"] - len(users))])
+        names = list(UserName.objects.all())
+        UserProfile.objects.bulk_create([UserProfile(user=name, self_introduction=f"{name.username}です") for name in names])
+
+        rooms = [Chatroom.create(f"room-{i}", names[i % len(names)]) for i in range(options["rooms"])]
+        ChatMessage.objects.bulk_create([
+            ChatMessage(room=room, sender=names[(room.pk + i) % len(names)], text=f"message {i}")
+            for room in rooms
+            for i in range(options["messages"])
+        ])
+        private_rooms = [PrivateChatroom.create(name=f"private-{i}", create_user=user.username) for i, user in enumerate(users)]
+
+        return Seed(
+            users=users,
+            user_ids=[UrlSafeEncodeNode.to_global_id("UserNameNode", name.pk) for name in names],
+            rooms=[UrlSafeEncodeNode.to_global_id("ChatroomNode", room.pk) for room in rooms],
+            private_rooms=[UrlSafeEncodeNode.to_global_id("PrivateChatroomNode", room.pk) for room in private_rooms],
+        )
+
+    def run(self, seed: Seed, options) -> Dict[str, OperationStats]:
+        recorder = LoadRecorder()
+        tally = QueryTally()
+        # 負荷をかける前にサインインしておき、セッションの作成を計測に含めない
+        clients = []
+        for user in seed.users:
+            client = Client(HTTP_HOST="django")
+            client.force_login(user)
+            clients.append(client)
+
+        # ChatroomConsumerはメンバーだけが接続できるため、WebSocketのクライアントは先に入室しておく
+        room_ids = [UrlSafeEncodeNode.from_global_id(room)[1] for room in seed.rooms[:max(1, options["ws_clients"] // 5)]]
+        for index in range(options["ws_clients"]):
+            self.enter_room(clients[index % len(clients)], room_ids[index % len(room_ids)])
+
+        graphql_threads = [
+            threading.Thread(target=self.run_graphql_client, args=(index, client, seed, recorder, tally, options))
+            for index, client in enumerate(clients)
+        ]
+        tally.install()
+        try:
+            start = time.perf_counter()
+            for thread in graphql_threads:
+                thread.start()
+
+            asyncio.run(self.run_websocket_clients(clients, room_ids, recorder, options))
+            for thread in graphql_threads:
+                thread.join()
+
+            elapsed = time.perf_counter() - start
+            # WebSocketのDBアクセスはasgirefのスレッドで行われるため、GraphQLのスレッド以外の件数をまとめて数える(接続時の分も含む)
+            recorder.add_queries("ws.send", tally.total(exclude=[thread.ident for thread in graphql_threads]))
+        finally:
+            tally.uninstall()
+
+        return recorder.summarize(elapsed)
+
+    def run_graphql_client(self, index: int, client: Client, seed: Seed, recorder: LoadRecorder, tally: QueryTally, options) -> None:
+        # 実行の順序に依らずSQLの件数が変わらないよう、clientごとに乱数を分ける
+        rng = random.Random(options["seed"] + index)
+        try:
+            for i in range(options["requests"]):
+                name, query, variables = OPERATIONS[(index + i) % len(OPERATIONS)]
+                body = json.dumps({"query": query, "variables": variables(index, seed, rng)})
+                before = tally.count()
+                start = time.perf_counter()
+                response = client.post("/graphql", body, content_type="application/json")
+                elapsed = time.perf_counter() - start
+                error = response.status_code != 200 or "errors" in json.loads(response.content)
+                recorder.record(name, elapsed, tally.count() - before, error=error)
+        finally:
+            connection.close()
+
+    async def run_websocket_clients(self, clients: List[Client], room_ids: List[str], recorder: LoadRecorder, options) -> None:
+        """
+        WebSocketのクライアントを少数のルームに集めて接続し、送信してからackが届くまでの時間を計測する
+        同じルームの他のクライアントへのmessageも受信し続ける
+        """
+        from chatroom.asgi import application
+
+        async def run_client(index: int):
+            client = clients[index % len(clients)]
+            communicator = WebsocketCommunicator(
+                application,
+                f"/chatroom/public/{room_ids[index % len(room_ids)]}/",
+                headers=[(b"host", b"django"), (b"cookie", f"{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}".encode())]
+            )
+            start = time.perf_counter()
+            connected, _ = await communicator.connect(timeout=10)
+            recorder.record("ws.connect", time.perf_counter() - start, error=not connected)
+            if not connected:
+                return
+
+            try:
+                for i in range(options["ws_messages"]):
+                    client_message_id = f"{index}-{i}"
+                    start = time.perf_counter()
+                    await communicator.send_json_to({"text": f"bench {client_message_id}", "client_message_id": client_message_id})
+                    while True:
+                        frame = await communicator.receive_json_from(timeout=10)
+                        if frame["type"] == "error" or frame["type"] == "ack" and frame["client_message_id"] == client_message_id:
+                            break
+
+                    recorder.record("ws.send", time.perf_counter() - start, error=frame["type"] == "error")
+            finally:
+                await communicator.disconnect()
+
+        await asyncio.gather(*[run_client(index) for index in range(options["ws_clients"])])
+
+    def enter_room(self, client: Client, room_id: str) -> None:
+        query = "mutation($room: ID) { enterPublicChatroom(roomId: $room) { ok } }"
+        room = UrlSafeEncodeNode.to_global_id("ChatroomNode", room_id)
+        client.post("/graphql", json.dumps({"query": query, "variables": {"room": room}}), content_type="application/json")
+
+    def report(self, stats: Dict[str, OperationStats]) -> None:
+        self.stdout.write(f"{'operation':<22}{'count':>7}{'errors':>7}{'p50ms':>9}{'p95ms':>9}{'p99ms':>9}{'ops/s':>9}{'sql/op':>8}")
+        for operation, s in stats.items():
+            self.stdout.write(
+                f"{operation:<22}{s.count:>7}{s.errors:>7}{s.p50:>9.1f}{s.p95:>9.1f}{s.p99:>9.1f}{s.ops_per_sec:>9.1f}{s.queries_per_op:>8.1f}"
+            )
@@ -0,0 +1,112 @@
+import os
+import tempfile
+import threading
+import time
+from typing import Tuple
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections, transaction
+
+from chatapp.models import Chatroom, ChatMessage
+from common.db.profiles import database_settings
+from users.models import UserName
+
+
+class Command(BaseCommand):
+    help = "DATABASEのPROFILEごとに、一時的なDBへメッセージを書き込んでスループットを比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--profile",
+            action="append",
+            choices=["sqlite", "sqlite-wal", "postgres"],
+            help="比較するPROFILE。複数指定できる(既定はsqliteとsqlite-wal)"
+        )
+        parser.add_argument("--messages", type=int, default=2000, help="書き込むメッセージの件数")
+        parser.add_argument("--writers", type=int, default=4, help="同時に書き込むスレッドの数")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=getattr(settings, "CHAT_MESSAGE_BATCH_SIZE", 100),
+            help="batchモードで1トランザクションにまとめる件数"
+        )
+
+    def handle(self, *args, **options):
+        profiles = options["profile"] or ["sqlite", "sqlite-wal"]
+        total = options["messages"] // options["writers"] * options["writers"]
+        self.stdout.write(f"{'profile':<12}{'mode':<8}{'messages':>10}{'failed':>8}{'seconds':>10}{'msg/s':>10}")
+        for profile in profiles:
+            with tempfile.TemporaryDirectory() as tmp:
+                alias = self.create_database(profile, tmp)
+                try:
+                    for mode in ("single", "batch"):
+                        elapsed, failed = self.run(alias, mode, options)
+                        written = total - failed
+                        self.stdout.write(f"{profile:<12}{mode:<8}{written:>10}{failed:>8}{elapsed:>10.3f}{written / elapsed:>10.0f}")
+                finally:
+                    self.destroy_database(alias)
+
+    def create_database(self, profile: str, tmp: str) -> str:
+        """
+        postgresの場合は設定ファイルのDATABASEの接続先に、sqliteの場合は一時ディレクトリにテスト用のDBを作成する
+        """
+        config = {**getattr(settings, "DATABASE_CONFIG", {}), "PROFILE": profile}
+        if profile == "postgres" and config.get("POOLER") == "pgbouncer":
+            raise CommandError("pgbouncerを経由するとテスト用のDBを作成できないため、PostgreSQLへ直接接続する設定で実行してください")
+
+        database = database_settings(config, settings.BASE_DIR)
+        if profile != "postgres":
+            database["TEST"] = {"NAME": os.path.join(tmp, "bench.sqlite3")}
+
+        alias = f"bench_{profile}"
+        connections.databases[alias] = database
+        connections[alias].creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        return alias
+
+    def destroy_database(self, alias: str) -> None:
+        connection = connections[alias]
+        connection.creation.destroy_test_db(connection.settings_dict["NAME"], verbosity=0)
+        connection.close()
+        del connections.databases[alias]
+
+    def run(self, alias: str, mode: str, options) -> Tuple[float, int]:
+        """
+        singleは1件ずつsave(自動コミット)し、batchはbatch_size件ずつbulk_createする
+        経過時間と、ロックの待ち時間切れなどで書き込めなかった件数を返す
+        """
+        user = UserName(username=f"bench-{mode}")
+        user.save(using=alias)
+        room = Chatroom.objects.using(alias).create(room_name=f"bench-{mode}", create_user=user)
+        per_writer = options["messages"] // options["writers"]
+        batch_size = 1 if mode == "single" else options["batch_size"]
+        failed = []
+
+        def write(writer: int):
+            messages = [
+                ChatMessage(room_id=room.pk, sender_id=user.pk, text=f"message {writer}-{i}")
+                for i in range(per_writer)
+            ]
+            try:
+                for i in range(0, len(messages), batch_size):
+                    batch = messages[i:i + batch_size]
+                    try:
+                        if mode == "single":
+                            batch[0].save(using=alias)
+                        else:
+                            with transaction.atomic(using=alias):
+                                ChatMessage.objects.using(alias).bulk_create(batch)
+                    except OperationalError:
+                        failed.append(len(batch))
+            finally:
+                connections[alias].close()
+
+        threads = [threading.Thread(target=write, args=(writer, )) for writer in range(options["writers"])]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        return time.perf_counter() - start, sum(failed)
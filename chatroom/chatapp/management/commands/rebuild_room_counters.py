@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chatapp.logic.room_counters import rebuild_counters
+from chatapp.models import Chatroom, ChatroomMember, ChatMessage, PrivateChatroom, PrivateChatroomMember, PrivateChatMessage
+
+
+class Command(BaseCommand):
+    help = "ルームのメンバー数・メッセージ数・最終投稿日時をメンバーとメッセージから集計し直す"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--room-id",
+            type=int,
+            help="指定したidのルームだけを集計し直す"
+        )
+        parser.add_argument(
+            "--kind",
+            choices=["public", "private"],
+            help="publicかprivateのルームだけを集計し直す"
+        )
+
+    def handle(self, *args, **options):
+        targets = {
+            "public": (Chatroom, ChatroomMember, ChatMessage),
+            "private": (PrivateChatroom, PrivateChatroomMember, PrivateChatMessage),
+        }
+        for kind, models in targets.items():
+            if options["kind"] not in (None, kind):
+                continue
+
+            with transaction.atomic():
+                updated = rebuild_counters(*models, room_id=options["room_id"])
+
+            self.stdout.write(f"{kind}ルームを{updated}件集計し直しました")
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.14 on 2026-10-18 10:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0002_auto_20210312_1646'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['room', 'send_date', 'id'], name='chatmessage_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='privatechatmessage',
+            index=models.Index(fields=['room', 'send_date', 'id'], name='privatechatmessage_history_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 3.1.14 on 2026-10-18 10:32
+
+from django.db import migrations, models
+
+
+ROLE_RANK = {"GU": 0, "MA": 1, "OW": 2}
+
+
+def remove_duplicate_members(apps, schema_editor):
+    """
+    同じ(room, user)のメンバーを、最も強いroleと入室状態を引き継いだ1行にまとめる
+    """
+    db_alias = schema_editor.connection.alias
+    for model_name in ("ChatroomMember", "PrivateChatroomMember"):
+        member_type = apps.get_model("chatapp", model_name)
+        duplicates = (
+            member_type.objects.using(db_alias).filter(user__isnull=False)
+            .values("room_id", "user_id")
+            .annotate(count=models.Count("id"))
+            .filter(count__gt=1)
+        )
+        for duplicate in duplicates:
+            members = list(member_type.objects.using(db_alias).filter(room_id=duplicate["room_id"], user_id=duplicate["user_id"]).order_by("id"))
+            keep = members[0]
+            keep.role = max((member.role for member in members), key=lambda role: ROLE_RANK.get(role, 0))
+            keep.is_enter = any(member.is_enter for member in members)
+            keep.save(using=db_alias)
+            member_type.objects.using(db_alias).filter(pk__in=[member.pk for member in members[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0003_auto_20261018_1924'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_members, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chatroommember',
+            constraint=models.UniqueConstraint(fields=('room', 'user'), name='chatroommember_room_user_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='privatechatroommember',
+            constraint=models.UniqueConstraint(fields=('room', 'user'), name='privatechatroommember_room_user_unique'),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 3.1.14 on 2026-10-18 10:36
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_counters(apps, schema_editor):
+    """
+    既存のルームの集計値を、メンバーとメッセージから集計して埋める
+    """
+    db_alias = schema_editor.connection.alias
+    for room_name, member_name, message_name in (
+        ("Chatroom", "ChatroomMember", "ChatMessage"),
+        ("PrivateChatroom", "PrivateChatroomMember", "PrivateChatMessage"),
+    ):
+        room_type = apps.get_model("chatapp", room_name)
+        members = apps.get_model("chatapp", member_name).objects.filter(room=OuterRef("pk"), user__isnull=False)
+        messages = apps.get_model("chatapp", message_name).objects.filter(room=OuterRef("pk"))
+        room_type.objects.using(db_alias).update(
+            member_count=Coalesce(Subquery(members.values("room").annotate(count=Count("id")).values("count")), 0),
+            message_count=Coalesce(Subquery(messages.values("room").annotate(count=Count("id")).values("count")), 0),
+            last_message_at=Subquery(messages.order_by("-send_date").values("send_date")[:1])
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0004_auto_20261018_1932'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='member_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='message_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='privatechatroom',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='privatechatroom',
+            name='member_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='privatechatroom',
+            name='message_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
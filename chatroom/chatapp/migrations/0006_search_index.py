@@ -0,0 +1,77 @@
+from django.db import OperationalError, migrations
+
+
+# (全文検索用の仮想テーブルを作成する元のテーブル, 検索対象の列)
+SEARCH_TARGETS = (
+    ("chatapp_chatroom", "room_name"),
+    ("chatapp_privatechatroom", "room_name"),
+    ("chatapp_chatmessage", "text"),
+    ("chatapp_privatechatmessage", "text"),
+)
+
+
+def supports_trigram(connection) -> bool:
+    """
+    trigramトークナイザはSQLite 3.34.0以降で使える。FTS5を含めずにビルドされたSQLiteもあるため、実際に作成して確かめる
+    """
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE VIRTUAL TABLE temp.chatapp_trigram_probe USING fts5(x, tokenize='trigram')")
+            cursor.execute("DROP TABLE temp.chatapp_trigram_probe")
+    except OperationalError:
+        return False
+
+    return True
+
+
+def create_search_index(apps, schema_editor):
+    """
+    SQLiteの場合だけ、FTS5の仮想テーブルと元のテーブルに同期させるトリガーを作成する
+    日本語は単語の区切りが無いため、trigramで部分一致を検索できるようにする
+    trigramに対応していないSQLiteでは作成せず、検索はicontainsで行う(chatapp.logic.search)
+    """
+    if schema_editor.connection.vendor != "sqlite" or not supports_trigram(schema_editor.connection):
+        return
+
+    for table, column in SEARCH_TARGETS:
+        fts = f"{table}_fts"
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {fts} USING fts5({column}, content='{table}', content_rowid='id', tokenize='trigram')"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {fts}_ai AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {fts}_ad AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); END"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {fts}_au AFTER UPDATE OF {column} ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); "
+            f"INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END"
+        )
+        schema_editor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+
+    for table, _ in SEARCH_TARGETS:
+        fts = f"{table}_fts"
+        for suffix in ("ai", "ad", "au"):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {fts}_{suffix}")
+
+        schema_editor.execute(f"DROP TABLE IF EXISTS {fts}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0005_auto_20261018_1936'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -3,6 +3,8 @@ from typing import Final
 from users.models import UserName
 from django.db import models, transaction
 
+from chatapp.logic.membership_cache import get_room_membership
+
 
 class AbstractChatroom(models.Model):
     room_name = models.CharField(max_length=64)
@@ -11,6 +13,12 @@ class AbstractChatroom(models.Model):
     is_active = models.BooleanField(default=True)
     create_user = models.ForeignKey(UserName, on_delete=models.SET_NULL, null=True)
 
+    # 一覧で集計せずに並び替えられるよう、メンバーとメッセージの集計値を保持する
+    # 値はchatapp.logic.room_countersで更新し、ずれた場合はrebuild_room_countersコマンドで集計し直す
+    member_count = models.IntegerField(default=0)
+    message_count = models.IntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
     def __str__(self):
         return self.room_name
 
@@ -24,7 +32,8 @@ class Chatroom(AbstractChatroom):
         with transaction.atomic():
             chatroom: Chatroom = cls.objects.create(
                 room_name=name,
-                create_user=create_user
+                create_user=create_user,
+                member_count=1
             )
             
             member = ChatroomMember()
@@ -42,7 +51,8 @@ class PrivateChatroom(AbstractChatroom):
         with transaction.atomic():
             chatroom: PrivateChatroom = cls.objects.create(
                 room_name=name,
-                create_user=create_user
+                create_user=create_user,
+                member_count=1
             )
             
             member = PrivateChatroomMember()
@@ -76,33 +86,39 @@ class AbstractChatroomMember(models.Model):
 class ChatroomMember(AbstractChatroomMember):
     room = models.ForeignKey(Chatroom, on_delete=models.CASCADE)
 
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["room", "user"], name="chatroommember_room_user_unique")]
+
     def allow_update_room(self) -> bool:
         """
         roomの情報を更新する権限があるかどうかを確認する
         """
-        return self.role != MemberRoles.GUEST
+        return get_room_membership(ChatroomMember, self.room_id).role_of(self.user_id) not in (None, MemberRoles.GUEST)
 
     def allow_delete_room(self) -> bool:
         """
         roomを削除する権限があるかどうかを確認する
         """
-        return self.user == self.room.create_user
+        return self.user_id is not None and self.user_id == get_room_membership(ChatroomMember, self.room_id).create_user_id
 
 
 class PrivateChatroomMember(AbstractChatroomMember):
     room = models.ForeignKey(PrivateChatroom, on_delete=models.CASCADE)
 
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["room", "user"], name="privatechatroommember_room_user_unique")]
+
     def allow_update_room(self) -> bool:
         """
         roomの情報を更新する権限があるかどうかを確認する
         """
-        return self.role != MemberRoles.GUEST
+        return get_room_membership(PrivateChatroomMember, self.room_id).role_of(self.user_id) not in (None, MemberRoles.GUEST)
 
     def allow_delete_room(self) -> bool:
         """
         roomを削除する権限があるかどうかを確認する
         """
-        return self.user == self.room.create_user
+        return self.user_id is not None and self.user_id == get_room_membership(PrivateChatroomMember, self.room_id).create_user_id
 
 
 class AbstractMessage(models.Model):
@@ -124,7 +140,14 @@ class AbstractMessage(models.Model):
 class ChatMessage(AbstractMessage):
     room = models.ForeignKey(Chatroom, on_delete=models.CASCADE)
 
+    class Meta:
+        # 履歴をkeyset paginationで取得するための索引
+        indexes = [models.Index(fields=["room", "send_date", "id"], name="chatmessage_history_idx")]
+
 
 class PrivateChatMessage(AbstractMessage):
     room = models.ForeignKey(PrivateChatroom, on_delete=models.CASCADE)
+
+    class Meta:
+        indexes = [models.Index(fields=["room", "send_date", "id"], name="privatechatmessage_history_idx")]
     
\ No newline at end of file
@@ -3,15 +3,24 @@ from graphql_relay import from_global_id
 from graphene_django import DjangoObjectType
 from graphene_django.filter import DjangoFilterConnectionField
 import django_filters
+from django.utils.dateparse import parse_datetime
 
-from .models import Chatroom, PrivateChatroom
+from .models import Chatroom, ChatMessage, PrivateChatroom, PrivateChatMessage
 
 from users.schema import UserNameNode
 from users.models import UserName
+from users.loaders import load_user_name
 from common.nodes.url_safe_encode_node import UrlSafeEncodeNode
 from .logic import chatroom_interactor as logic
+from .logic import message_history
+from .logic import search
+from .logic.presence import presence_registry
+from .logic import room_events
+from .consumers.chatroom_consumer import connection_url
 from users.auth.auth import Auth
+from users.auth.decorator import rate_limit
 from common.errors.graphql_error_decorator import reraise_graphql_error
+from common.graphql.subscription_streams import subscription_streams
 
 
 class ChatroomFilter(django_filters.FilterSet):
@@ -24,32 +33,36 @@ class ChatroomFilter(django_filters.FilterSet):
             "create_user": ["exact"],
         }
 
+    # 集計値はルームに保持しているため、活発なルーム順などに並び替えてもCOUNTは発生しない
+    order_by = django_filters.OrderingFilter(
+        fields=("last_message_at", "message_count", "member_count", "create_date")
+    )
+
+
+class PrivateChatroomFilter(ChatroomFilter):
+    class Meta(ChatroomFilter.Meta):
+        model = PrivateChatroom
+
 
 class ChatroomNode(DjangoObjectType):
     class Meta:
         model = Chatroom
-        #filterset_class = ChatroomFilter
-        filter_fields =  {
-            "room_name": ["exact", "icontains", "istartswith"],
-            "create_date": ["exact"],
-            "is_active": ["exact"],
-            "create_user": ["exact"],
-        }
+        filterset_class = ChatroomFilter
         interfaces = (UrlSafeEncodeNode, )
 
+    def resolve_create_user(self: Chatroom, info):
+        return load_user_name(info.context, self.create_user_id)
+
 
 class PrivateChatroomNode(DjangoObjectType):
     class Meta:
         model = PrivateChatroom
-        #filterset_class = ChatroomFilter
-        filter_fields =  {
-            "room_name": ["exact", "icontains", "istartswith"],
-            "create_date": ["exact"],
-            "is_active": ["exact"],
-            "create_user": ["exact"],
-        }
+        filterset_class = PrivateChatroomFilter
         interfaces = (UrlSafeEncodeNode, )
 
+    def resolve_create_user(self: PrivateChatroom, info):
+        return load_user_name(info.context, self.create_user_id)
+
     @classmethod
     def get_queryset(cls, queryset, info):
         auth = Auth(info.context)
@@ -57,6 +70,86 @@ class PrivateChatroomNode(DjangoObjectType):
         return queryset.filter(privatechatroommember__user=auth.current_user)
 
 
+class MessageNode(graphene.ObjectType):
+    id = graphene.ID()
+    text = graphene.String()
+    send_date = graphene.DateTime()
+    sender = graphene.Field(UserNameNode)
+    room_id = graphene.ID()
+
+    def resolve_id(self, info):
+        return UrlSafeEncodeNode.to_global_id(type(self).__name__, self.id)
+
+    def resolve_room_id(self, info):
+        node_type = PrivateChatroomNode if isinstance(self, PrivateChatMessage) else ChatroomNode
+        return UrlSafeEncodeNode.to_global_id(str(node_type), self.room_id)
+
+    def resolve_sender(self, info):
+        return load_user_name(info.context, self.sender_id)
+
+
+class MessageConnection(graphene.relay.Connection):
+    class Meta:
+        node = MessageNode
+
+
+class RoomSearchResultNode(graphene.ObjectType):
+    public_rooms = graphene.List(ChatroomNode)
+    private_rooms = graphene.List(PrivateChatroomNode)
+
+
+class RoomPresenceNode(graphene.ObjectType):
+    count = graphene.Int()
+    users = graphene.List(UserNameNode)
+
+    def resolve_count(self, info):
+        return len(self)
+
+    def resolve_users(self, info):
+        return [load_user_name(info.context, user_id) for user_id in self]
+
+
+RoomEventType = graphene.Enum.from_enum(room_events.RoomEventType)
+
+
+class RoomEventNode(graphene.ObjectType):
+    """
+    channel layerで受け取ったイベント(room_events.room_eventのevent)から値を返す
+    """
+    event_type = graphene.Field(RoomEventType)
+    room_id = graphene.ID()
+    room_name = graphene.String()
+    message = graphene.Field(MessageNode)
+    invited_users = graphene.List(UserNameNode)
+
+    def resolve_event_type(self, info):
+        return self["event_type"]
+
+    def resolve_room_id(self, info):
+        node_type = ChatroomNode if self["room_kind"] == "public" else PrivateChatroomNode
+        return UrlSafeEncodeNode.to_global_id(str(node_type), self["room_id"])
+
+    def resolve_room_name(self, info):
+        return self.get("room_name")
+
+    def resolve_message(self, info):
+        message = self.get("message")
+        if message is None:
+            return None
+
+        message_type = ChatMessage if self["room_kind"] == "public" else PrivateChatMessage
+        return message_type(
+            id=message["id"],
+            text=message["text"],
+            room_id=int(self["room_id"]),
+            sender_id=message["sender_id"],
+            send_date=parse_datetime(message["send_date"])
+        )
+
+    def resolve_invited_users(self, info):
+        return [load_user_name(info.context, user_id) for user_id in self.get("user_ids", [])]
+
+
 class Query(graphene.ObjectType):
     chatroom = UrlSafeEncodeNode.Field(ChatroomNode)
     all_chatrooms = DjangoFilterConnectionField(ChatroomNode)
@@ -64,15 +157,94 @@ class Query(graphene.ObjectType):
     all_private_rooms = DjangoFilterConnectionField(PrivateChatroomNode)
     current_user_joined_public_chatroom = DjangoFilterConnectionField(ChatroomNode)
     current_user_joined_private_chatroom = DjangoFilterConnectionField(PrivateChatroomNode)
-
+    room_messages = graphene.Field(
+        MessageConnection,
+        room_id=graphene.ID(required=True),
+        before=graphene.String(),
+        after=graphene.String(),
+        first=graphene.Int(),
+        last=graphene.Int()
+    )
+    room_presence = graphene.Field(RoomPresenceNode, room_id=graphene.ID(required=True))
+    search_rooms = graphene.Field(RoomSearchResultNode, query=graphene.String(required=True), first=graphene.Int())
+    search_messages = graphene.List(
+        MessageNode,
+        query=graphene.String(required=True),
+        room_id=graphene.ID(),
+        first=graphene.Int()
+    )
+
+    # 入室中かどうかはis_enterではなく、WebSocketの接続を記録しているpresence_registryから判断する
     def resolve_current_user_joined_public_chatroom(root, info, **kwargs):
-        return Chatroom.objects.filter(chatroommember__user=Auth(info.context).current_user, chatroommember__is_enter=True)
+        user = Auth(info.context).current_user
+        return Chatroom.objects.filter(pk__in=presence_registry.rooms_of("public", user.pk) if user else [])
 
     def resolve_current_user_joined_private_chatroom(root, info, **kwargs):
-        return PrivateChatroom.objects.filter(privatechatroommember__user=Auth(info.context).current_user, privatechatroommember__is_enter=True)
+        user = Auth(info.context).current_user
+        return PrivateChatroom.objects.filter(pk__in=presence_registry.rooms_of("private", user.pk) if user else [])
 
     def resolve_exclude_joined_public_chatroom(root, info, **kwargs):
-        return Chatroom.objects.exclude(chatroommember__user=Auth(info.context).current_user, chatroommember__is_enter=True)
+        user = Auth(info.context).current_user
+        return Chatroom.objects.exclude(pk__in=presence_registry.rooms_of("public", user.pk) if user else [])
+
+    def resolve_room_presence(root, info, room_id):
+        try:
+            node_type, room_pk = from_global_id(room_id)
+        except UnicodeDecodeError:
+            raise Exception("指定のルームは存在しません")
+
+        if node_type == str(ChatroomNode):
+            return logic.public_room_presence(room_pk)
+        elif node_type == str(PrivateChatroomNode):
+            return logic.private_room_presence(info.context, room_pk)
+
+        raise Exception("指定のルームは存在しません")
+
+    def resolve_room_messages(root, info, room_id, **kwargs):
+        try:
+            node_type, room_pk = from_global_id(room_id)
+        except UnicodeDecodeError:
+            raise Exception("指定のルームは存在しません")
+
+        if node_type == str(ChatroomNode):
+            page = message_history.fetch_public_room_messages(room_pk, **kwargs)
+        elif node_type == str(PrivateChatroomNode):
+            page = message_history.fetch_private_room_messages(info.context, room_pk, **kwargs)
+        else:
+            raise Exception("指定のルームは存在しません")
+
+        edges = [
+            MessageConnection.Edge(node=message, cursor=message_history.encode_cursor(message))
+            for message in page.messages
+        ]
+        return MessageConnection(
+            edges=edges,
+            page_info=graphene.relay.PageInfo(
+                start_cursor=edges[0].cursor if edges else None,
+                end_cursor=edges[-1].cursor if edges else None,
+                has_previous_page=page.has_previous_page,
+                has_next_page=page.has_next_page
+            )
+        )
+
+    def resolve_search_rooms(root, info, query, first=None):
+        return search.search_rooms(info.context, query, first)
+
+    def resolve_search_messages(root, info, query, room_id=None, first=None):
+        if room_id is None:
+            return search.search_messages(info.context, query, first)
+
+        try:
+            node_type, room_pk = from_global_id(room_id)
+        except UnicodeDecodeError:
+            raise Exception("指定のルームは存在しません")
+
+        if node_type == str(ChatroomNode):
+            return search.search_public_messages(query, room_pk, first)
+        elif node_type == str(PrivateChatroomNode):
+            return search.search_private_messages(info.context, query, room_pk, first)
+
+        raise Exception("指定のルームは存在しません")
 
 
 class CreateChatroom(graphene.Mutation):
@@ -85,6 +257,7 @@ class CreateChatroom(graphene.Mutation):
 
     @classmethod
     @reraise_graphql_error
+    @rate_limit("create_room")
     def mutate(cls, root, info, name:str, description:str):
         room = logic.create_public_chatroom(info.context, name)
 
@@ -101,6 +274,7 @@ class CreatePrivateChatroom(graphene.Mutation):
 
     @classmethod
     @reraise_graphql_error
+    @rate_limit("create_room")
     def mutate(cls, root, info, name:str, description:str):
         room = logic.create_private_chatroom(info.context, name)
 
@@ -108,30 +282,52 @@ class CreatePrivateChatroom(graphene.Mutation):
 
 
 #todo publicルームにも招待機能を追加する
+InvitationStatus = graphene.Enum.from_enum(logic.InvitationStatus)
+
+
+class InvitationResultNode(graphene.ObjectType):
+    user = graphene.ID()
+    status = graphene.Field(InvitationStatus)
+
+
 class InvitationUser(graphene.Mutation):
     class Arguments:
         users = graphene.List(graphene.ID)
         room = graphene.ID()
 
     ok = graphene.Boolean()
+    results = graphene.List(InvitationResultNode)
 
     @classmethod
     @reraise_graphql_error
+    @rate_limit("invitation", room_argument="room")
     def mutate(cls, root, info, users, room):
-        node_type, private_room_id = from_global_id(room)
+        try:
+            node_type, private_room_id = from_global_id(room)
+        except UnicodeDecodeError as ude:
+            raise Exception("指定のルームは存在しません") from ude
+
         if node_type != str(PrivateChatroomNode):
             raise Exception("指定のルームは存在しません")
-        
-        target_user_ids = [None] * len(users)
-        for i, user_id in enumerate(users):
-            node_type, primary_id = from_global_id(user_id)
-            if node_type != str(UserNameNode):
-                raise Exception(f"指定のユーザー「{user_id}」は存在しません")
-            
-            target_user_ids[i] = primary_id
 
-        logic.invitation(info.context, private_room_id, target_user_ids)
-        return InvitationUser(ok=True)
+        # 存在しないユーザーが含まれていても、残りのユーザーは招待して結果で知らせる
+        target_user_ids = {}
+        for user_id in users:
+            try:
+                node_type, primary_id = from_global_id(user_id)
+            except (UnicodeDecodeError, ValueError):
+                node_type, primary_id = None, ""
+
+            target_user_ids[user_id] = primary_id if node_type == str(UserNameNode) else ""
+
+        results = {
+            result.user_id: result.status
+            for result in logic.invitation(info.context, private_room_id, list(target_user_ids.values()))
+        }
+        return InvitationUser(ok=True, results=[
+            InvitationResultNode(user=user_id, status=results.get(primary_id, logic.InvitationStatus.NOT_FOUND))
+            for user_id, primary_id in target_user_ids.items()
+        ])
 
 
 class RenamePublicRoomName(graphene.Mutation):
@@ -243,7 +439,7 @@ class EnterPublicChatroom(graphene.Mutation):
             raise Exception("指定のルームは存在しません")
 
         logic.enter_public_room(request=info.context, room_id=room_pk)
-        return EnterPublicChatroom(ok=True, connection_url="websocket接続用のURLをreturnする")
+        return EnterPublicChatroom(ok=True, connection_url=connection_url("public", room_pk))
 
 
 class EnterPrivateChatroom(graphene.Mutation):
@@ -265,7 +461,7 @@ class EnterPrivateChatroom(graphene.Mutation):
             raise Exception("指定のルームは存在しません")
 
         logic.enter_private_room(request=info.context, room_id=room_pk)
-        return EnterPublicChatroom(ok=True, connection_url="websocket接続用のURLをreturnする")
+        return EnterPrivateChatroom(ok=True, connection_url=connection_url("private", room_pk))
 
 
 class ExitChatroom(graphene.Mutation):
@@ -304,4 +500,39 @@ class Mutation(graphene.ObjectType):
     enter_private_chatroom = EnterPrivateChatroom().Field()
     exit_chatroom = ExitChatroom().Field()
 
-schema = graphene.Schema(query=Query, mutation=Mutation)
+class Subscription(graphene.ObjectType):
+    """
+    WebSocket(graphql-ws)で接続した場合だけ購読できる
+    """
+    room_events = graphene.Field(RoomEventNode, room_id=graphene.ID(required=True))
+    invited_rooms = graphene.Field(RoomEventNode)
+
+    @reraise_graphql_error
+    def resolve_room_events(root, info, room_id):
+        try:
+            node_type, room_pk = from_global_id(room_id)
+        except (UnicodeDecodeError, ValueError):
+            raise Exception("指定のルームは存在しません")
+
+        if node_type == str(ChatroomNode):
+            room_kind, is_member = "public", logic.is_public_room_member
+        elif node_type == str(PrivateChatroomNode):
+            room_kind, is_member = "private", logic.is_private_room_member
+        else:
+            raise Exception("指定のルームは存在しません")
+
+        if not is_member(info.context, room_pk):
+            raise Exception("指定のルームは存在しません")
+
+        return subscription_streams(info.context).listen(room_events.room_events_group(room_kind, room_pk))
+
+    @reraise_graphql_error
+    def resolve_invited_rooms(root, info):
+        user = Auth(info.context).current_user
+        if user is None:
+            raise Exception("サインインしてください")
+
+        return subscription_streams(info.context).listen(room_events.user_events_group(user.pk))
+
+
+schema = graphene.Schema(query=Query, mutation=Mutation, subscription=Subscription)
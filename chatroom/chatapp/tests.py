@@ -1,3 +1,1269 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError
+from django.db.utils import ConnectionHandler
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from graphql import parse
+
+from chatroom.asgi import application
+from chatroom.schema import schema
+from chatapp.checks import check_shared_cache
+from chatapp.consumers.chatroom_consumer import DeliveredCursor, coalesce_frames
+from chatapp.logic import message_history
+from chatapp.logic.membership_cache import get_room_membership
+from chatapp.logic.message_writer import MessageWriteBuffer, bulk_insert_messages
+from chatapp.logic.room_events import RoomEventType, room_event, room_events_group
+from chatapp.logic.presence import PresenceRegistry, presence_registry, user_room_group_name
+from chatapp.models import Chatroom, ChatroomMember, ChatMessage, MemberRoles, PrivateChatroom, PrivateChatroomMember, PrivateChatMessage
+from common.channel_layers.brokers import RedisBroker
+from common.channel_layers.pubsub_layer import PubSubChannelLayer
+from common.consumers.outbound_queue import OutboundQueue, OverflowPolicy
+from common.db.profiles import DEFAULT_SQLITE_PRAGMAS, database_settings
+from common.db.routers import ReadReplicaRouter, use_replica
+from common.graphql import instrumentation
+from common.graphql.document_cache import LRUCachedBackend, document_hash
+from common.graphql.persisted_queries import PERSISTED_QUERY_NOT_FOUND, PersistedQueryStore
+from common.graphql.query_cost import QueryCostAnalyzer, QueryCostLimit
+from common.nodes.url_safe_encode_node import UrlSafeEncodeNode
+from common.ratelimit.token_bucket import rate_limiter
+from common.testing.load import LoadRecorder, OperationStats, find_regressions, percentile
+from common.testing.query_count import GraphQLClient, QueryCountAssertions, capture_queries
+from common.views.replica_routing_graphql_view import PRIMARY_STICKY_COOKIE
+from users.models import UserName, UserOnMyApp
+
+
+class PubSubChannelLayerTest(SimpleTestCase):
+    """
+    LocalBrokerを共有する2つのlayerを別ノードに見立てて、ノード間のfan-outを確認する
+    """
+
+    def create_nodes(self, name, **kwargs):
+        options = {"broker_options": {"name": name}}
+        options.update(kwargs)
+        return PubSubChannelLayer(**options), PubSubChannelLayer(**options)
+
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), timeout=1)
+
+    async def test_group_send_reaches_other_node(self):
+        node_a, node_b = self.create_nodes("group-send")
+        channel_a = await node_a.new_channel()
+        channel_b = await node_b.new_channel()
+        await node_a.group_add("chatroom-public-1", channel_a)
+        await node_b.group_add("chatroom-public-1", channel_b)
+
+        await node_b.group_send("chatroom-public-1", {"type": "chat.message", "text": "hello"})
+
+        self.assertEqual((await self.receive(node_a, channel_a))["text"], "hello")
+        self.assertEqual((await self.receive(node_b, channel_b))["text"], "hello")
+
+    async def test_send_to_channel_on_other_node(self):
+        node_a, node_b = self.create_nodes("send")
+        channel_a = await node_a.new_channel()
+
+        await node_b.send(channel_a, {"type": "oauth.callback", "text": "ok"})
+
+        self.assertEqual((await self.receive(node_a, channel_a))["text"], "ok")
+
+    async def test_group_discard_stops_delivery(self):
+        node_a, node_b = self.create_nodes("discard")
+        channel_a = await node_a.new_channel()
+        await node_a.group_add("chatroom-public-1", channel_a)
+        await node_a.group_discard("chatroom-public-1", channel_a)
+
+        await node_b.group_send("chatroom-public-1", {"type": "chat.message"})
+        await node_b.flush()
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(node_a.receive(channel_a), timeout=0.1)
+
+    async def test_group_sends_are_batched_into_one_publish(self):
+        node_a, node_b = self.create_nodes("batch", batch_interval=0.05)
+        channel_a = await node_a.new_channel()
+        # 送信をまとめるのは、consumerがchannelを作成したループから呼び出された場合だけ
+        await node_b.new_channel()
+        await node_a.group_add("chatroom-public-1", channel_a)
+
+        for i in range(10):
+            await node_b.group_send("chatroom-public-1", {"type": "chat.message", "index": i})
+
+        received = [(await self.receive(node_a, channel_a))["index"] for _ in range(10)]
+        self.assertEqual(received, list(range(10)))
+        self.assertEqual(node_b.broker.published_count, 1)
+
+    def test_group_send_from_sync_code_reaches_other_node(self):
+        """
+        viewや管理コマンドのようにasync_to_syncで呼び出した場合も、戻るまでに送信すること
+        """
+        node_a, node_b = self.create_nodes("sync", batch_interval=0.05)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        channel_a = loop.run_until_complete(node_a.new_channel())
+        loop.run_until_complete(node_a.group_add("chatroom-public-1", channel_a))
+
+        async_to_sync(node_b.group_send)("chatroom-public-1", {"type": "chat.message", "text": "hello"})
+
+        self.assertEqual(loop.run_until_complete(self.receive(node_a, channel_a))["text"], "hello")
+
+    async def test_channel_queue_is_capped(self):
+        node_a, node_b = self.create_nodes("capacity", capacity=3)
+        channel_a = await node_a.new_channel()
+        await node_a.group_add("chatroom-public-1", channel_a)
+
+        for i in range(5):
+            await node_b.group_send("chatroom-public-1", {"type": "chat.message", "index": i})
+        await node_b.flush()
+        await asyncio.sleep(0)
+
+        received = [(await self.receive(node_a, channel_a))["index"] for _ in range(3)]
+        self.assertEqual(received, [0, 1, 2])
+        with self.assertRaises(ChannelFull):
+            for i in range(4):
+                await node_a.send(channel_a, {"type": "chat.message"})
+
+
+class FakePubSub:
+    """
+    redisが無い環境でRedisBrokerを試すため、redis.asyncioのPubSubの代わりに使う
+    """
+    def __init__(self, redis):
+        self.redis = redis
+        self.topics = []
+
+    async def subscribe(self, *topics):
+        if self.redis.fail_subscribe:
+            self.redis.fail_subscribe -= 1
+            raise ConnectionError("subscribe")
+        self.topics.extend(topics)
+
+    async def get_message(self, ignore_subscribe_messages, timeout):
+        await asyncio.sleep(0)
+        if self.redis.fail_read:
+            self.redis.fail_read -= 1
+            raise ConnectionError("read")
+        return self.redis.messages.pop(0) if self.redis.messages and self.topics else None
+
+    async def close(self):
+        pass
+
+
+class FakeRedis:
+    def __init__(self):
+        self.pubsubs = []
+        self.messages = []
+        self.fail_read = 0
+        self.fail_subscribe = 0
+
+    def pubsub(self):
+        self.pubsubs.append(FakePubSub(self))
+        return self.pubsubs[-1]
+
+    async def close(self):
+        pass
+
+
+class RedisBrokerTest(SimpleTestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        aioredis = mock.Mock(from_url=lambda url: self.redis)
+        modules = mock.patch.dict(sys.modules, {"redis": mock.Mock(asyncio=aioredis), "redis.asyncio": aioredis})
+        modules.start()
+        self.addCleanup(modules.stop)
+        backoff = mock.patch("common.channel_layers.brokers.RECONNECT_BACKOFF", 0.001)
+        backoff.start()
+        self.addCleanup(backoff.stop)
+
+    async def test_reconnects_and_resubscribes_after_read_error(self):
+        broker = RedisBroker()
+        received = asyncio.get_running_loop().create_future()
+        self.redis.fail_read = 1
+        self.redis.messages.append({"channel": b"topic", "data": b"payload"})
+
+        with self.assertLogs("common.channel_layers.brokers", "ERROR") as logs:
+            await broker.subscribe("topic", received.set_result)
+            self.redis.fail_subscribe = 1
+            self.assertEqual(await asyncio.wait_for(received, timeout=1), b"payload")
+            await broker.close()
+
+        self.assertEqual(len(logs.records), 2)
+        # 再購読に失敗したpubsubは使わず、作り直したpubsubで購読し直す
+        self.assertEqual(len(self.redis.pubsubs), 3)
+        self.assertEqual(self.redis.pubsubs[-1].topics, ["topic"])
+
+
+class LoadRecorderTest(SimpleTestCase):
+    """
+    bench_loadが集計とベースラインとの比較に使うcommon.testing.load
+    """
+
+    def stats(self, p95=10.0, queries_per_op=3.0, errors=0):
+        return OperationStats(count=100, errors=errors, p50=5.0, p95=p95, p99=p95, ops_per_sec=50.0, queries_per_op=queries_per_op)
+
+    def test_percentile_uses_nearest_rank(self):
+        values = [float(i) for i in range(1, 101)]
+
+        self.assertEqual(percentile(values, 50), 50.0)
+        self.assertEqual(percentile(values, 95), 95.0)
+        self.assertEqual(percentile(values, 99), 99.0)
+        self.assertEqual(percentile([], 95), 0.0)
+
+    def test_summarize_excludes_errors_from_latency(self):
+        recorder = LoadRecorder()
+        recorder.record("allChatrooms", 0.010, queries=3)
+        recorder.record("allChatrooms", 0.030, queries=3)
+        recorder.record("allChatrooms", 1.0, error=True)
+        recorder.add_queries("ws.send", 8)
+        recorder.record("ws.send", 0.002)
+        recorder.record("ws.send", 0.004)
+
+        stats = recorder.summarize(elapsed=2.0)
+
+        self.assertEqual(stats["allChatrooms"].count, 2)
+        self.assertEqual(stats["allChatrooms"].errors, 1)
+        self.assertAlmostEqual(stats["allChatrooms"].p99, 30.0)
+        self.assertAlmostEqual(stats["allChatrooms"].ops_per_sec, 1.0)
+        self.assertAlmostEqual(stats["allChatrooms"].queries_per_op, 3.0)
+        self.assertAlmostEqual(stats["ws.send"].queries_per_op, 4.0)
+
+    def test_find_regressions(self):
+        baseline = {"allChatrooms": self.stats()}
+
+        self.assertEqual(find_regressions({"allChatrooms": self.stats(p95=14.0)}, baseline), [])
+        self.assertEqual(len(find_regressions({"allChatrooms": self.stats(p95=16.0)}, baseline)), 1)
+        self.assertEqual(len(find_regressions({"allChatrooms": self.stats(queries_per_op=4.0)}, baseline)), 1)
+        self.assertEqual(len(find_regressions({"allChatrooms": self.stats(queries_per_op=4.0, errors=1)}, baseline)), 1)
+        # ベースラインに無い操作と、計測しなかった操作は比較しない
+        self.assertEqual(find_regressions({"allProfiles": self.stats(p95=100.0)}, baseline), [])
+
+
+
+
+class QueryCountAssertionsTest(SimpleTestCase):
+    def test_requires_grow_fixtures(self):
+        class Incomplete(QueryCountAssertions, SimpleTestCase):
+            pass
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+    @override_settings(QUERY_COUNT_TIME_BUDGET=0)
+    def test_time_budget_is_read_from_settings(self):
+        class Slow(QueryCountAssertions, SimpleTestCase):
+            def grow_fixtures(self, size):
+                pass
+
+            def runTest(self):
+                pass
+
+        case = Slow()
+
+        self.assertEqual(case.time_budget, 0)
+        with self.assertRaisesMessage(AssertionError, "(上限0秒)"):
+            case.assertQueriesIndependentOfSize({"sleep": lambda: lambda: time.sleep(0.001)})
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class ChatroomQueryCountTest(QueryCountAssertions, TestCase):
+    """
+    ルーム・メンバー・メッセージを増やしても、各queryとmutationのSQLの件数が変わらないこと
+    """
+
+    def setUp(self):
+        self.owner = UserOnMyApp.objects.create_user(username="owner", email="owner@example.com", password="password")
+        self.graphql = GraphQLClient(self, self.owner)
+        self.public_room = Chatroom.create("public", self.owner.username)
+        self.private_room = PrivateChatroom.create("private", self.owner.username)
+        self.users = []
+
+    def grow_fixtures(self, size):
+        """
+        ユーザーを1人増やすごとに、そのユーザーが作成したpublic・privateルーム(ownerも招待済み)と
+        ownerのルームへの参加・メッセージを1つずつ増やす
+        """
+        for i in range(len(self.users), size):
+            user = UserName(username=f"member-{i}")
+            user.save()
+            self.users.append(user)
+            Chatroom.create(f"room-{i}", user)
+            PrivateChatroomMember.objects.create(room=PrivateChatroom.create(f"private-{i}", user), user=self.owner.username, role=MemberRoles.GUEST)
+            ChatroomMember.objects.create(room=self.public_room, user=user, role=MemberRoles.GUEST)
+            PrivateChatroomMember.objects.create(room=self.private_room, user=user, role=MemberRoles.GUEST)
+            ChatMessage.objects.create(room=self.public_room, sender=user, text=f"message {i}")
+            PrivateChatMessage.objects.create(room=self.private_room, sender=user, text=f"message {i}")
+
+    def room_with_members(self, room_type, member_type, create_user):
+        """
+        現在のユーザー全員がメンバーのルームを作成し、global idを返す
+        """
+        room = room_type.create(f"target-{room_type.objects.count()}", create_user)
+        member_type.objects.bulk_create([member_type(room=room, user=user, role=MemberRoles.GUEST) for user in self.users if user != create_user])
+        return UrlSafeEncodeNode.to_global_id(f"{room_type.__name__}Node", room.pk)
+
+    def query(self, query, **variables):
+        return lambda: lambda: self.graphql.execute(query, variables)
+
+    def mutation(self, query, variables):
+        """
+        variablesは実行ごとの対象を準備して変数を返す関数
+        """
+        def prepare():
+            values = variables()
+            return lambda: self.graphql.execute(query, values)
+
+        return prepare
+
+    def test_queries(self):
+        public_room = UrlSafeEncodeNode.to_global_id("ChatroomNode", self.public_room.pk)
+        private_room = UrlSafeEncodeNode.to_global_id("PrivateChatroomNode", self.private_room.pk)
+        room_fields = "edges { node { id roomName memberCount messageCount createUser { id username email } } }"
+        message_fields = "edges { node { id text sendDate roomId sender { id username email } } }"
+        self.assertQueriesIndependentOfSize({
+            "chatroom": self.query("query($id: ID!) { chatroom(id: $id) { roomName createUser { username } } }", id=public_room),
+            "allChatrooms": self.query("{ allChatrooms(first: 100) { %s } }" % room_fields),
+            "excludeJoinedPublicChatroom": self.query("{ excludeJoinedPublicChatroom(first: 100) { %s } }" % room_fields),
+            "allPrivateRooms": self.query("{ allPrivateRooms(first: 100) { %s } }" % room_fields),
+            "currentUserJoinedPublicChatroom": self.query("{ currentUserJoinedPublicChatroom(first: 100) { %s } }" % room_fields),
+            "currentUserJoinedPrivateChatroom": self.query("{ currentUserJoinedPrivateChatroom(first: 100) { %s } }" % room_fields),
+            "roomMessages(public)": self.query("query($room: ID!) { roomMessages(roomId: $room, last: 100) { %s } }" % message_fields, room=public_room),
+            "roomMessages(private)": self.query("query($room: ID!) { roomMessages(roomId: $room, last: 100) { %s } }" % message_fields, room=private_room),
+            "roomPresence": self.query("query($room: ID!) { roomPresence(roomId: $room) { count users { username } } }", room=public_room),
+            "searchRooms": self.query(
+                '{ searchRooms(query: "room", first: 100) { publicRooms { roomName createUser { username } } privateRooms { roomName createUser { username } } } }'
+            ),
+            "searchMessages": self.query('{ searchMessages(query: "message", first: 100) { text sender { username email } } }'),
+        })
+
+    def test_mutations(self):
+        owner = self.owner.username
+        self.assertQueriesIndependentOfSize({
+            "createPublicChatroom": self.mutation(
+                "mutation($name: String) { createPublicChatroom(name: $name, description: \"\") { ok chatroom { roomName createUser { username } } } }",
+                lambda: {"name": f"created-{Chatroom.objects.count()}"}
+            ),
+            "createPrivateChatroom": self.mutation(
+                "mutation($name: String) { createPrivateChatroom(name: $name, description: \"\") { ok chatroom { roomName createUser { username } } } }",
+                lambda: {"name": f"created-{PrivateChatroom.objects.count()}"}
+            ),
+            "invitationUser": self.mutation(
+                "mutation($room: ID, $users: [ID]) { invitationUser(room: $room, users: $users) { ok results { user status } } }",
+                lambda: {
+                    "room": self.room_with_members(PrivateChatroom, PrivateChatroomMember, owner),
+                    "users": [UrlSafeEncodeNode.to_global_id("UserNameNode", user.pk) for user in self.users]
+                }
+            ),
+            "renamePublicRoomName": self.mutation(
+                "mutation($id: ID) { renamePublicRoomName(id: $id, newName: \"renamed\") { ok chatroom { roomName } } }",
+                lambda: {"id": self.room_with_members(Chatroom, ChatroomMember, owner)}
+            ),
+            "renamePrivateRoomName": self.mutation(
+                "mutation($id: ID) { renamePrivateRoomName(id: $id, newName: \"renamed\") { ok chatroom { roomName } } }",
+                lambda: {"id": self.room_with_members(PrivateChatroom, PrivateChatroomMember, owner)}
+            ),
+            "deletePublicRoom": self.mutation(
+                "mutation($id: ID) { deletePublicRoom(id: $id) { ok } }",
+                lambda: {"id": self.room_with_members(Chatroom, ChatroomMember, owner)}
+            ),
+            "deletePrivateRoom": self.mutation(
+                "mutation($id: ID) { deletePrivateRoom(id: $id) { ok } }",
+                lambda: {"id": self.room_with_members(PrivateChatroom, PrivateChatroomMember, owner)}
+            ),
+            "enterPublicChatroom": self.mutation(
+                "mutation($room: ID) { enterPublicChatroom(roomId: $room) { ok connectionUrl } }",
+                lambda: {"room": self.room_with_members(Chatroom, ChatroomMember, self.users[0])}
+            ),
+            "enterPrivateChatroom": self.mutation(
+                "mutation($room: ID) { enterPrivateChatroom(roomId: $room) { ok connectionUrl } }",
+                lambda: {"room": self.room_with_members(PrivateChatroom, PrivateChatroomMember, owner)}
+            ),
+            "exitChatroom": self.mutation(
+                "mutation($room: ID) { exitChatroom(roomId: $room) { ok } }",
+                lambda: {"room": self.room_with_members(Chatroom, ChatroomMember, owner)}
+            ),
+        })
+
+
+class QueryCostAnalyzerTest(SimpleTestCase):
+    """
+    検証より前に実行されるため、不正なドキュメントでも例外を投げずにエラーを返すこと
+    """
+
+    def check(self, query, variables=None, limit=None):
+        analyzer = QueryCostAnalyzer(schema, limit or QueryCostLimit())
+        return [error.message for error in analyzer.check(parse(query), variables, None)]
+
+    def test_rejects_page_size_over_limit(self):
+        self.assertEqual(len(self.check("{ allChatrooms(first: 1000) { edges { node { roomName } } } }")), 1)
+
+    def test_rejects_negative_page_size(self):
+        limit = QueryCostLimit(max_cost=150)
+        expensive = "allProfiles(first: 100) { edges { node { user { username } } } }"
+        self.assertEqual(len(self.check("{ %s }" % expensive, limit=limit)), 1)
+
+        # 負のページサイズで兄弟のフィールドのコストを打ち消せないこと
+        errors = self.check(
+            "query($f: Int) { %s allChatrooms(first: $f) { edges { node { owner { username } } } } }" % expensive, {"f": -100}, limit
+        )
+
+        self.assertIn("firstは0以上で指定してください", errors)
+
+    def test_rejects_non_integer_page_size_variable(self):
+        errors = self.check("query($f: Int) { allChatrooms(first: $f) { edges { node { roomName } } } }", {"f": "1000"})
+
+        self.assertEqual(errors, ["firstは整数で指定してください"])
+
+    def test_rejects_self_referencing_fragment(self):
+        errors = self.check("fragment F on Query { ...F } query { ...F }")
+
+        self.assertEqual(errors, ["フラグメント「F」が自身を含んでいます"])
+
+    def test_cached_backend_validates_self_referencing_fragment(self):
+        document = LRUCachedBackend().document_from_string(schema, "fragment F on Query { ...F } query { ...F }")
+
+        result = document.execute()
+
+        self.assertTrue(result.invalid)
+        self.assertIn("F", result.errors[0].message)
+
+    def test_repeated_fragments_are_counted_without_expanding_every_path(self):
+        fragments = "".join(f"fragment F{i} on Query {{ ...F{i + 1} ...F{i + 1} }} " for i in range(40))
+        query = fragments + "fragment F40 on Query { currentUser { username } } query { ...F0 }"
+
+        self.assertEqual(len(self.check(query)), 1)
+
+
+class ReplicaRoutingGraphQLViewTest(TestCase):
+    """
+    プライマリから読み込む期限のcookieは、mutationを実行した場合だけ設定すること
+    """
+
+    def setUp(self):
+        self.client = Client(HTTP_HOST="django")
+
+    def post(self, query):
+        return self.client.post("/graphql", json.dumps({"query": query}), content_type="application/json")
+
+    def test_mutation_sets_primary_sticky_cookie(self):
+        response = self.post("mutation { signOut { ok } }")
+
+        self.assertIn(PRIMARY_STICKY_COOKIE, response.cookies)
+
+    def test_query_during_primary_sticky_period_does_not_renew_cookie(self):
+        self.client.cookies[PRIMARY_STICKY_COOKIE] = str(time.time() + 60)
+
+        response = self.post("{ currentUser { username } }")
+
+        self.assertNotIn(PRIMARY_STICKY_COOKIE, response.cookies)
+
+    def test_unparsable_document_does_not_set_cookie(self):
+        response = self.post("mutation {")
+
+        self.assertNotIn(PRIMARY_STICKY_COOKIE, response.cookies)
+
+
+@override_settings(DATABASE_REPLICAS=["replica0"])
+class ReadReplicaRouterTest(SimpleTestCase):
+    def setUp(self):
+        self.router = ReadReplicaRouter()
+
+    def test_reads_from_replica_only_inside_use_replica(self):
+        self.assertEqual(self.router.db_for_read(Chatroom), "default")
+        with use_replica():
+            self.assertEqual(self.router.db_for_read(Chatroom), "replica0")
+            self.assertEqual(self.router.db_for_write(Chatroom), "default")
+
+        self.assertEqual(self.router.db_for_read(Chatroom), "default")
+
+    def test_resets_after_exception(self):
+        with self.assertRaises(RuntimeError), use_replica():
+            raise RuntimeError
+
+        self.assertEqual(self.router.db_for_read(Chatroom), "default")
+
+    def test_nested_block_restores_outer_choice(self):
+        with use_replica():
+            with override_settings(DATABASE_REPLICAS=[]), use_replica():
+                self.assertEqual(self.router.db_for_read(Chatroom), "default")
+
+            self.assertEqual(self.router.db_for_read(Chatroom), "replica0")
+
+    def test_does_not_migrate_replicas(self):
+        self.assertTrue(self.router.allow_migrate("default", "chatapp"))
+        self.assertFalse(self.router.allow_migrate("replica0", "chatapp"))
+
+
+class DatabaseProfileTest(SimpleTestCase):
+    def test_sqlite_is_default(self):
+        database = database_settings({}, Path("/srv"))
+
+        self.assertEqual(database, {"ENGINE": "django.db.backends.sqlite3", "NAME": Path("/srv/db.sqlite3")})
+
+    def test_sqlite_wal_merges_pragmas(self):
+        database = database_settings({"PROFILE": "sqlite-wal", "PRAGMAS": {"busy_timeout": 100}}, Path("/srv"))
+
+        self.assertEqual(database["ENGINE"], "common.db.backends.sqlite_wal")
+        self.assertEqual(database["PRAGMAS"], {**DEFAULT_SQLITE_PRAGMAS, "busy_timeout": 100})
+
+    def test_postgres_behind_pgbouncer(self):
+        direct = database_settings({"PROFILE": "postgres"}, Path("/srv"))
+        pooled = database_settings({"PROFILE": "postgres", "POOLER": "pgbouncer"}, Path("/srv"))
+
+        self.assertEqual((direct["PORT"], direct["CONN_MAX_AGE"]), (5432, 60))
+        self.assertNotIn("DISABLE_SERVER_SIDE_CURSORS", direct)
+        self.assertEqual((pooled["PORT"], pooled["CONN_MAX_AGE"]), (6432, 0))
+        self.assertTrue(pooled["DISABLE_SERVER_SIDE_CURSORS"])
+
+    def test_rejects_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            database_settings({"PROFILE": "mysql"}, Path("/srv"))
+
+
+class SqliteWalBackendTest(SimpleTestCase):
+    """
+    テスト用のインメモリのDBとは別に、一時ファイルのDBへ接続して確かめる
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / "db.sqlite3"
+
+    def connect(self, config=None):
+        handler = ConnectionHandler({"default": database_settings({"PROFILE": "sqlite-wal", "NAME": self.path, **(config or {})}, self.path.parent)})
+        connection = handler["default"]
+        self.addCleanup(connection.close)
+        return connection
+
+    def pragma(self, connection, name):
+        with connection.cursor() as cursor:
+            return cursor.execute(f"PRAGMA {name}").fetchone()[0]
+
+    def test_new_connection_applies_pragmas(self):
+        connection = self.connect()
+
+        self.assertEqual(self.pragma(connection, "journal_mode"), "wal")
+        self.assertEqual(self.pragma(connection, "busy_timeout"), 5000)
+        # NORMAL
+        self.assertEqual(self.pragma(connection, "synchronous"), 1)
+        self.assertEqual(self.pragma(connection, "cache_size"), -20000)
+        # MEMORY
+        self.assertEqual(self.pragma(connection, "temp_store"), 2)
+
+    def test_transaction_takes_write_lock_at_begin(self):
+        writer = self.connect()
+        other = self.connect({"OPTIONS": {"timeout": 0}, "PRAGMAS": {"busy_timeout": 0}})
+        with writer.cursor() as cursor:
+            cursor.execute("CREATE TABLE t (id INTEGER)")
+
+        statements = []
+        with writer.execute_wrapper(lambda execute, sql, *args: statements.append(sql) or execute(sql, *args)):
+            writer.set_autocommit(False, force_begin_transaction_with_broken_autocommit=True)
+        self.addCleanup(writer.set_autocommit, True)
+
+        self.assertEqual(statements, ["BEGIN IMMEDIATE"])
+        # まだ書き込んでいなくても、他の接続は書き込めない
+        with self.assertRaisesMessage(OperationalError, "database is locked"), other.cursor() as cursor:
+            cursor.execute("INSERT INTO t VALUES (1)")
+
+        writer.commit()
+        with other.cursor() as cursor:
+            cursor.execute("INSERT INTO t VALUES (1)")
+
+
+class RoomMembershipCacheTest(TestCase):
+    """
+    キャッシュは全てのリクエストで共有するため、レプリカへ振り分けている間もdefaultから読み込むこと
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.owner = UserName(username="owner")
+        self.owner.save()
+        self.room = Chatroom.create("room", self.owner)
+
+    @override_settings(DATABASE_REPLICAS=["replica"])
+    def test_fills_cache_from_default_inside_use_replica(self):
+        # "replica"はDATABASESに無いため、レプリカから読み込むとConnectionDoesNotExistになる
+        with use_replica():
+            membership = get_room_membership(ChatroomMember, self.room.pk)
+
+        self.assertEqual(membership.role_of(self.owner.pk), MemberRoles.OWNER)
+
+
+class SharedCacheCheckTest(SimpleTestCase):
+    """
+    複数ワーカーで動かす設定のときだけ、プロセスごとのキャッシュを警告すること
+    """
+
+    @override_settings(DATABASE_REPLICAS=[], RATE_LIMIT_BACKEND="local")
+    def test_single_worker_with_local_cache(self):
+        self.assertEqual(check_shared_cache(None), [])
+
+    @override_settings(RATE_LIMIT_BACKEND="cache")
+    def test_multi_worker_with_local_cache(self):
+        self.assertEqual([warning.id for warning in check_shared_cache(None)], ["chatapp.W001"])
+
+    @override_settings(RATE_LIMIT_BACKEND="cache", CACHES={"default": {"BACKEND": "django.core.cache.backends.memcached.PyLibMCCache"}})
+    def test_multi_worker_with_shared_cache(self):
+        self.assertEqual(check_shared_cache(None), [])
+
+
+class OutboundQueueTest(SimpleTestCase):
+    """
+    送信が追いつかずに溢れた場合の、CHAT_OUTBOUND_QUEUE_POLICYごとの動作
+    """
+
+    async def fill(self, policy, frames, **kwargs):
+        """
+        送信を止めた状態でframesを溜めてから送信させ、送信されたフレームを返す
+        """
+        sent = []
+        blocked = asyncio.Event()
+
+        async def send(frame):
+            await blocked.wait()
+            sent.append(frame)
+
+        queue = OutboundQueue(send, max_size=3, policy=policy, **kwargs)
+        # 送信タスクが最初のフレームを取り出して待つため、以降のフレームが溜まる
+        queue.put(frames[0])
+        await asyncio.sleep(0)
+        for frame in frames[1:]:
+            queue.put(frame)
+
+        blocked.set()
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+        queue.close()
+        return sent
+
+    def message(self, index):
+        return {"type": "message", "message": {"cursor": f"cursor-{index}"}}
+
+    async def test_coalesce_keeps_ack_and_error(self):
+        ack = {"type": "ack", "client_message_id": "a", "message": {"cursor": "cursor-ack"}}
+        error = {"type": "error", "message": "送信できません"}
+        frames = [self.message(0), self.message(1), ack, self.message(2), error, self.message(3)]
+
+        sent = await self.fill(OverflowPolicy.COALESCE, frames, coalesce=coalesce_frames)
+
+        self.assertEqual(sent, [self.message(0), {"type": "skipped", "count": 2, "after": None}, ack, error, self.message(3)])
+
+    async def test_drop_oldest_keeps_newest_frames(self):
+        frames = [self.message(i) for i in range(6)]
+
+        sent = await self.fill(OverflowPolicy.DROP_OLDEST, frames)
+
+        self.assertEqual(sent, [self.message(0)] + frames[3:])
+
+    async def test_coalesce_without_coalesce_function_drops_oldest(self):
+        frames = [self.message(i) for i in range(6)]
+
+        sent = await self.fill(OverflowPolicy.COALESCE, frames)
+
+        self.assertEqual(sent, [self.message(0)] + frames[3:])
+
+    async def test_disconnect_closes_queue_and_notifies(self):
+        disconnected = []
+
+        async def on_disconnect():
+            disconnected.append(True)
+
+        sent = await self.fill(OverflowPolicy.DISCONNECT, [self.message(i) for i in range(6)], on_disconnect=on_disconnect)
+
+        # 取り出し済みのフレームの送信も取り消される
+        self.assertEqual(sent, [])
+        self.assertEqual(disconnected, [True])
+
+    async def test_frames_under_max_size_are_sent_in_order(self):
+        frames = [self.message(i) for i in range(4)]
+
+        for policy in OverflowPolicy:
+            with self.subTest(policy=policy):
+                self.assertEqual(await self.fill(policy, frames, coalesce=coalesce_frames), frames)
+
+    def test_coalesce_frames_without_messages(self):
+        ack = {"type": "ack", "client_message_id": "a", "message": {"cursor": "cursor-ack"}}
+
+        self.assertEqual(coalesce_frames([ack]), [ack])
+
+    def test_coalesce_frames_with_unknown_count(self):
+        frames = [{"type": "skipped", "count": None, "after": None}, self.message(0)]
+
+        self.assertEqual(coalesce_frames(frames), [{"type": "skipped", "count": None, "after": None}])
+
+
+def session_cookie(user) -> bytes:
+    """
+    WebSocketの接続でuserとしてサインインするためのCookieヘッダー
+    """
+    client = Client(HTTP_HOST="django")
+    client.force_login(user)
+    return f"sessionid={client.cookies['sessionid'].value}".encode()
+
+
+class ChatroomConsumerTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = UserOnMyApp.objects.create_user(username="owner", email="owner@example.com", password="password")
+        self.guest = UserOnMyApp.objects.create_user(username="guest", email="guest@example.com", password="password")
+        self.outsider = UserOnMyApp.objects.create_user(username="outsider", email="outsider@example.com", password="password")
+        self.room = Chatroom.create("room", self.owner.username)
+        ChatroomMember.objects.create(room=self.room, user=self.guest.username, role=MemberRoles.GUEST)
+        self.cookies = {user.pk: session_cookie(user) for user in (self.owner, self.guest, self.outsider)}
+
+        limiter = mock.patch.object(rate_limiter, "rates", {})
+        limiter.start()
+        self.addCleanup(limiter.stop)
+
+    async def connect(self, user, query=""):
+        communicator = WebsocketCommunicator(
+            application,
+            f"/chatroom/public/{self.room.pk}/{query}",
+            headers=[(b"cookie", self.cookies[user.pk])]
+        )
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def test_rejects_non_member(self):
+        communicator, connected = await self.connect(self.outsider)
+
+        self.assertFalse(connected)
+
+    async def test_acks_sender_and_broadcasts_to_members(self):
+        sender, _ = await self.connect(self.owner)
+        receiver, _ = await self.connect(self.guest)
+
+        await sender.send_json_to({"text": "hello", "client_message_id": "c-1"})
+
+        ack = await sender.receive_json_from()
+        self.assertEqual((ack["type"], ack["client_message_id"], ack["message"]["text"]), ("ack", "c-1", "hello"))
+        broadcast = await receiver.receive_json_from()
+        self.assertEqual((broadcast["type"], broadcast["message"]["id"]), ("message", ack["message"]["id"]))
+        await sender.disconnect()
+        await receiver.disconnect()
+
+    async def test_heartbeat_keeps_presence_without_reply(self):
+        communicator, _ = await self.connect(self.guest)
+
+        await communicator.send_json_to({"type": "heartbeat"})
+
+        self.assertTrue(await communicator.receive_nothing())
+        self.assertEqual(presence_registry.users_in("public", self.room.pk), [self.guest.username.pk])
+        await communicator.disconnect()
+        self.assertEqual(presence_registry.users_in("public", self.room.pk), [])
+
+    async def test_resumes_after_cursor(self):
+        first, second = await sync_to_async(lambda: [
+            ChatMessage.objects.create(room=self.room, sender=self.owner.username, text=text) for text in ("first", "second")
+        ])()
+
+        communicator, _ = await self.connect(self.guest, f"?after={message_history.encode_cursor(first)}")
+
+        resumed = await communicator.receive_json_from()
+        self.assertEqual((resumed["type"], resumed["message"]["id"]), ("message", second.id))
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+
+class GraphQLSubscriptionConsumerTest(TestCase):
+    """
+    graphql-wsのstart/data/stopでroomEventsを購読する
+    """
+
+    def setUp(self):
+        # ロールバックで再利用されたルームのidに、前のテストのメンバーのキャッシュが残らないようにする
+        cache.clear()
+        self.owner = UserOnMyApp.objects.create_user(username="owner", email="owner@example.com", password="password")
+        self.outsider = UserOnMyApp.objects.create_user(username="outsider", email="outsider@example.com", password="password")
+        self.room = Chatroom.create("room", self.owner.username)
+        self.room_id = UrlSafeEncodeNode.to_global_id("ChatroomNode", self.room.pk)
+        self.cookies = {user.pk: session_cookie(user) for user in (self.owner, self.outsider)}
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(application, "/graphql/", headers=[(b"cookie", self.cookies[user.pk])], subprotocols=["graphql-ws"])
+        connected, subprotocol = await communicator.connect()
+        self.assertEqual((connected, subprotocol), (True, "graphql-ws"))
+        await communicator.send_json_to({"type": "connection_init"})
+        self.assertEqual(await communicator.receive_json_from(), {"type": "connection_ack"})
+        return communicator
+
+    async def subscribe(self, communicator, id):
+        query = "subscription($room: ID!) { roomEvents(roomId: $room) { eventType roomId } }"
+        await communicator.send_json_to({"type": "start", "id": id, "payload": {"query": query, "variables": {"room": self.room_id}}})
+        # 続けて送ったqueryの結果が届けば、それより前のstartの購読は始まっている
+        await communicator.send_json_to({"type": "start", "id": "sync", "payload": {"query": "{ __typename }"}})
+        self.assertEqual((await communicator.receive_json_from())["id"], "sync")
+        self.assertEqual(await communicator.receive_json_from(), {"type": "complete", "id": "sync"})
+
+    async def send_event(self):
+        group = room_events_group("public", self.room.pk)
+        await get_channel_layer().group_send(group, room_event(group, RoomEventType.DELETED, "public", self.room.pk))
+
+    async def test_delivers_events_until_stopped(self):
+        communicator = await self.connect(self.owner)
+        await self.subscribe(communicator, "1")
+
+        await self.send_event()
+
+        self.assertEqual(await communicator.receive_json_from(), {
+            "type": "data", "id": "1", "payload": {"data": {"roomEvents": {"eventType": "DELETED", "roomId": self.room_id}}}
+        })
+
+        await communicator.send_json_to({"type": "stop", "id": "1"})
+        self.assertEqual(await communicator.receive_json_from(), {"type": "complete", "id": "1"})
+        await self.send_event()
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_rejects_room_of_other_users(self):
+        communicator = await self.connect(self.outsider)
+        query = "subscription($room: ID!) { roomEvents(roomId: $room) { eventType } }"
+
+        await communicator.send_json_to({"type": "start", "id": "1", "payload": {"query": query, "variables": {"room": self.room_id}}})
+
+        data = await communicator.receive_json_from()
+        self.assertEqual(data["payload"]["errors"][0]["message"], "指定のルームは存在しません")
+        self.assertEqual(await communicator.receive_json_from(), {"type": "complete", "id": "1"})
+        await self.send_event()
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+
+class DeliveredCursorTest(SimpleTestCase):
+    def frame(self, type, id, seconds):
+        message = ChatMessage(id=id, send_date=timezone.now().replace(microsecond=0) + timedelta(seconds=seconds))
+        return {"type": type, "message": {"cursor": message_history.encode_cursor(message)}}
+
+    def test_ack_does_not_advance(self):
+        # 同じバッチで先にコミットされたメッセージより先に、後のメッセージのackが届いた場合
+        delivered = DeliveredCursor(None)
+        delivered.advance(self.frame("ack", 3, 3))
+
+        self.assertIsNone(delivered.cursor)
+
+    def test_keeps_latest_message_when_frames_arrive_out_of_order(self):
+        later, earlier = self.frame("message", 2, 2), self.frame("message", 1, 1)
+        delivered = DeliveredCursor("invalid")
+        delivered.advance(later)
+        delivered.advance(earlier)
+
+        self.assertEqual(delivered.cursor, later["message"]["cursor"])
+
+
+class PresenceRegistryTest(TestCase):
+    """
+    2つのPresenceRegistryをCACHESを共有する別のワーカーに見立てて、在室状況の共有を確認する
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.owner = UserName(username="owner")
+        self.owner.save()
+        self.guest = UserName(username="guest")
+        self.guest.save()
+        self.room = Chatroom.create("room", self.owner)
+        ChatroomMember.objects.create(room=self.room, user=self.guest, role=MemberRoles.GUEST)
+        self.worker_a, self.worker_b = PresenceRegistry(), PresenceRegistry()
+
+    def is_enter(self):
+        return dict(ChatroomMember.objects.filter(room=self.room).values_list("user_id", "is_enter"))
+
+    async def test_presence_is_shared_between_workers(self):
+        await self.worker_a.touch("public", self.room.pk, self.owner.pk, "channel-a")
+        await self.worker_b.touch("public", self.room.pk, self.guest.pk, "channel-b")
+
+        self.assertCountEqual(self.worker_a.users_in("public", self.room.pk), [self.owner.pk, self.guest.pk])
+        self.assertEqual(self.worker_a.rooms_of("public", self.guest.pk), [str(self.room.pk)])
+
+    async def test_checkpoints_do_not_overwrite_other_workers(self):
+        await self.worker_a.touch("public", self.room.pk, self.owner.pk, "channel-a")
+        await self.worker_b.touch("public", self.room.pk, self.guest.pk, "channel-b")
+        await self.worker_a.checkpoint()
+        await self.worker_b.checkpoint()
+        self.assertEqual(await sync_to_async(self.is_enter)(), {self.owner.pk: True, self.guest.pk: True})
+
+        await self.worker_a.leave("channel-a")
+        await self.worker_b.checkpoint()
+        await self.worker_a.checkpoint()
+
+        self.assertEqual(await sync_to_async(self.is_enter)(), {self.owner.pk: False, self.guest.pk: True})
+
+    async def test_touch_does_not_wait_for_database_thread(self):
+        # database_sync_to_asyncと共有するスレッドが塞がっていても、在室状況を更新できること
+        release = threading.Event()
+        busy = asyncio.ensure_future(sync_to_async(release.wait)())
+        await asyncio.sleep(0.05)
+        try:
+            await asyncio.wait_for(self.worker_a.touch("public", self.room.pk, self.owner.pk, "channel-a"), timeout=1)
+        finally:
+            release.set()
+            await busy
+
+        self.assertEqual(self.worker_b.users_in("public", self.room.pk), [self.owner.pk])
+
+    async def test_disconnect_user_reaches_connection_on_other_worker(self):
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add(user_room_group_name("public", self.room.pk, self.guest.pk), channel_name)
+        await self.worker_b.touch("public", self.room.pk, self.guest.pk, channel_name)
+
+        await sync_to_async(self.worker_a.disconnect_user)("public", self.room.pk, self.guest.pk)
+
+        self.assertEqual((await asyncio.wait_for(channel_layer.receive(channel_name), timeout=1))["type"], "room.exit")
+        self.assertEqual(self.worker_a.users_in("public", self.room.pk), [])
+
+
+class MessageWriteBufferTest(TestCase):
+    def setUp(self):
+        self.user = UserName(username="owner")
+        self.user.save()
+        self.room = Chatroom.create("room", self.user)
+        self.other_room = Chatroom.create("other", self.user)
+
+    def message(self, text, room=None):
+        return ChatMessage(room=room or self.room, sender=self.user, text=text)
+
+    async def write_all(self, buffer, messages):
+        return await asyncio.wait_for(asyncio.gather(*(buffer.write(message) for message in messages), return_exceptions=True), timeout=5)
+
+    def saved_texts(self, room):
+        return list(ChatMessage.objects.filter(room=room).order_by("id").values_list("id", "text"))
+
+    async def test_keeps_order_within_room_and_backfills_ids(self):
+        buffer = MessageWriteBuffer(max_batch_size=3, max_delay=0.01)
+        messages = [self.message(f"message {i}", self.room if i % 2 == 0 else self.other_room) for i in range(10)]
+
+        saved = await self.write_all(buffer, messages)
+
+        for room in (self.room, self.other_room):
+            rows = await sync_to_async(self.saved_texts)(room)
+            expected = [message for message in saved if message.room_id == room.pk]
+            self.assertEqual(rows, [(message.id, message.text) for message in expected])
+
+    async def test_flushes_when_batch_is_full(self):
+        buffer = MessageWriteBuffer(max_batch_size=2, max_delay=60)
+
+        saved = await self.write_all(buffer, [self.message("a"), self.message("b")])
+
+        self.assertTrue(all(message.id is not None for message in saved))
+
+    async def test_flushes_after_delay(self):
+        buffer = MessageWriteBuffer(max_batch_size=100, max_delay=0.01)
+
+        saved = await self.write_all(buffer, [self.message("a")])
+
+        self.assertIsNotNone(saved[0].id)
+
+    async def test_errors_reach_every_sender_in_batch(self):
+        buffer = MessageWriteBuffer(max_batch_size=2, max_delay=60)
+
+        with mock.patch("chatapp.logic.message_writer.bulk_insert_messages", side_effect=ValueError("保存できません")):
+            results = await self.write_all(buffer, [self.message("a"), self.message("b")])
+
+        self.assertEqual([str(result) for result in results], ["保存できません", "保存できません"])
+
+    async def test_retries_when_database_is_locked(self):
+        buffer = MessageWriteBuffer(max_batch_size=1, max_delay=60)
+        errors = [OperationalError("database is locked")]
+
+        def locked_once(*args):
+            if errors:
+                raise errors.pop()
+
+            bulk_insert_messages(*args)
+
+        with mock.patch("chatapp.logic.message_writer.bulk_insert_messages", side_effect=locked_once), \
+                mock.patch("chatapp.logic.message_writer.LOCKED_BACKOFF", 0):
+            saved = await self.write_all(buffer, [self.message("a")])
+
+        self.assertIsNotNone(saved[0].id)
+
+
+class MessageHistoryTest(TestCase):
+    """
+    cursorの前後へ辿って、全てのメッセージを(send_date, id)の順に重複なく取得できること
+    """
+
+    def setUp(self):
+        user = UserName(username="owner")
+        user.save()
+        self.room = Chatroom.create("room", user)
+        ChatMessage.objects.bulk_create([ChatMessage(room=self.room, sender=user, text=f"message {i}") for i in range(7)])
+        # send_dateが同じメッセージはidの順に並ぶ
+        base = timezone.now()
+        for i, message in enumerate(ChatMessage.objects.filter(room=self.room).order_by("id")):
+            ChatMessage.objects.filter(pk=message.pk).update(send_date=base + timedelta(seconds=i // 2))
+
+        self.texts = [f"message {i}" for i in range(7)]
+
+    def fetch(self, **kwargs):
+        return message_history.fetch_public_room_messages(self.room.pk, **kwargs)
+
+    def texts_of(self, page):
+        return [message.text for message in page.messages]
+
+    def test_walks_forward_with_first_and_after(self):
+        texts, after = [], None
+        while True:
+            page = self.fetch(first=3, after=after)
+            texts.extend(self.texts_of(page))
+            if not page.has_next_page:
+                break
+
+            after = message_history.encode_cursor(page.messages[-1])
+
+        self.assertEqual(texts, self.texts)
+
+    def test_walks_backward_with_last_and_before(self):
+        texts, before = [], None
+        while True:
+            page = self.fetch(last=3, before=before)
+            texts[:0] = self.texts_of(page)
+            if not page.has_previous_page:
+                break
+
+            before = message_history.encode_cursor(page.messages[0])
+
+        self.assertEqual(texts, self.texts)
+
+    def test_default_page_is_latest_messages(self):
+        page = self.fetch()
+
+        self.assertEqual(self.texts_of(page), self.texts)
+        self.assertFalse(page.has_previous_page)
+
+    def test_between_after_and_before(self):
+        messages = self.fetch().messages
+
+        page = self.fetch(after=message_history.encode_cursor(messages[1]), before=message_history.encode_cursor(messages[5]))
+
+        self.assertEqual(self.texts_of(page), self.texts[2:5])
+
+    def test_rejects_invalid_arguments(self):
+        for kwargs in ({"first": 1, "last": 1}, {"first": message_history.MAX_PAGE_SIZE + 1}, {"last": -1}, {"after": "invalid"}):
+            with self.subTest(**kwargs), self.assertRaises(Exception):
+                self.fetch(**kwargs)
+
+
+class InvitationTest(TestCase):
+    def setUp(self):
+        self.owner = UserOnMyApp.objects.create_user(username="owner", email="owner@example.com", password="password")
+        self.member = UserName(username="member")
+        self.member.save()
+        self.guest = UserName(username="guest")
+        self.guest.save()
+        self.room = PrivateChatroom.create("private", self.owner.username)
+        PrivateChatroomMember.objects.create(room=self.room, user=self.member, role=MemberRoles.GUEST)
+        self.graphql = GraphQLClient(self, self.owner)
+
+    def invite(self, users):
+        query = "mutation($users: [ID], $room: ID) { invitationUser(users: $users, room: $room) { ok results { user status } } }"
+        room = UrlSafeEncodeNode.to_global_id("PrivateChatroomNode", self.room.pk)
+        return self.graphql.execute(query, {"users": users, "room": room})["invitationUser"]
+
+    def test_reports_status_per_user(self):
+        guest = UrlSafeEncodeNode.to_global_id("UserNameNode", self.guest.pk)
+        member = UrlSafeEncodeNode.to_global_id("UserNameNode", self.member.pk)
+        missing = UrlSafeEncodeNode.to_global_id("UserNameNode", 10000)
+        other_type = UrlSafeEncodeNode.to_global_id("ChatroomNode", self.guest.pk)
+
+        result = self.invite([guest, member, missing, other_type, "invalid", guest])
+
+        self.assertEqual(result["results"], [
+            {"user": guest, "status": "INVITED"},
+            {"user": member, "status": "ALREADY_MEMBER"},
+            {"user": missing, "status": "NOT_FOUND"},
+            {"user": other_type, "status": "NOT_FOUND"},
+            {"user": "invalid", "status": "NOT_FOUND"},
+        ])
+        self.assertTrue(PrivateChatroomMember.objects.filter(room=self.room, user=self.guest, role=MemberRoles.GUEST).exists())
+        self.assertEqual(PrivateChatroom.objects.get(pk=self.room.pk).member_count, 3)
+
+    def test_inviting_again_reports_already_member(self):
+        guest = UrlSafeEncodeNode.to_global_id("UserNameNode", self.guest.pk)
+        self.invite([guest])
+
+        result = self.invite([guest])
+
+        self.assertEqual(result["results"], [{"user": guest, "status": "ALREADY_MEMBER"}])
+        self.assertEqual(PrivateChatroom.objects.get(pk=self.room.pk).member_count, 3)
+
+
+    def test_takes_write_lock_before_reading(self):
+        """
+        SQLiteで他の書き込みと同時に実行された場合に、読み込みから書き込みへ昇格できずに失敗しないよう
+        トランザクションの最初の文でルームの書き込みのロックを取ること
+        """
+        guest = UrlSafeEncodeNode.to_global_id("UserNameNode", self.guest.pk)
+        with capture_queries() as statements:
+            self.invite([guest])
+
+        savepoint = next(i for i, sql in enumerate(statements) if sql.startswith("SAVEPOINT"))
+        self.assertRegex(statements[savepoint + 1], r'^UPDATE "chatapp_privatechatroom"')
+
+
+class RoomCountersTest(TestCase):
+    def setUp(self):
+        self.owner = UserOnMyApp.objects.create_user(username="owner", email="owner@example.com", password="password")
+        self.guest = UserOnMyApp.objects.create_user(username="guest", email="guest@example.com", password="password")
+        self.room = Chatroom.create("room", self.owner.username)
+        self.other_room = Chatroom.create("other", self.owner.username)
+
+    def counters(self, room):
+        return Chatroom.objects.filter(pk=room.pk).values("member_count", "message_count", "last_message_at").get()
+
+    def test_counters_follow_members_and_messages(self):
+        room_id = UrlSafeEncodeNode.to_global_id("ChatroomNode", self.room.pk)
+        GraphQLClient(self, self.guest).execute("mutation($id: ID) { enterPublicChatroom(roomId: $id) { ok } }", {"id": room_id})
+        messages = [ChatMessage(room=self.room, sender=self.owner.username, text=f"message {i}") for i in range(3)]
+        bulk_insert_messages(ChatMessage, messages)
+
+        counters = self.counters(self.room)
+        self.assertEqual((counters["member_count"], counters["message_count"]), (2, 3))
+        self.assertEqual(counters["last_message_at"], max(message.send_date for message in messages))
+
+    def test_rebuild_room_counters(self):
+        ChatroomMember.objects.create(room=self.room, user=self.guest.username, role=MemberRoles.GUEST)
+        ChatroomMember.objects.create(room=self.room, user=None, role=MemberRoles.GUEST)
+        message = ChatMessage.objects.create(room=self.room, sender=self.owner.username, text="message")
+        Chatroom.objects.update(member_count=100, message_count=100, last_message_at=None)
+
+        call_command("rebuild_room_counters", "--kind", "public", "--room-id", str(self.room.pk), stdout=io.StringIO())
+
+        # 退会したユーザー(userがNULL)はメンバーとして数えない
+        self.assertEqual(self.counters(self.room), {"member_count": 2, "message_count": 1, "last_message_at": message.send_date})
+        self.assertEqual(self.counters(self.other_room)["member_count"], 100)
+
+        call_command("rebuild_room_counters", stdout=io.StringIO())
+
+        self.assertEqual(self.counters(self.other_room), {"member_count": 1, "message_count": 0, "last_message_at": None})
+
+
+class PersistedQueryTest(TestCase):
+    query = "{ allChatrooms(first: 1) { edges { node { roomName } } } }"
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client(HTTP_HOST="django")
+
+    def post(self, query=None, sha256_hash=None):
+        body = {"query": query}
+        if sha256_hash is not None:
+            body["extensions"] = {"persistedQuery": {"version": 1, "sha256Hash": sha256_hash}}
+
+        response = self.client.post("/graphql", json.dumps(body), content_type="application/json")
+        return response.status_code, json.loads(response.content)
+
+    def test_unknown_hash_asks_client_to_send_query(self):
+        sha256_hash = document_hash(self.query)
+
+        self.assertEqual(self.post(sha256_hash=sha256_hash), (200, {"errors": [{"message": PERSISTED_QUERY_NOT_FOUND}]}))
+
+        status, content = self.post(self.query, sha256_hash)
+        self.assertEqual((status, "errors" in content), (200, False))
+
+        status, content = self.post(sha256_hash=sha256_hash)
+        self.assertEqual((status, content), (200, {"data": {"allChatrooms": {"edges": []}}}))
+
+    def test_rejects_hash_that_does_not_match_query(self):
+        status, content = self.post(self.query, "0" * 64)
+
+        self.assertEqual(status, 400)
+        self.assertEqual(content["errors"][0]["message"], "sha256Hashがクエリ文字列のハッシュと一致しません")
+
+    def test_whitelist_runs_only_manifest_queries(self):
+        store = PersistedQueryStore({document_hash(self.query): self.query}, allow_registration=False)
+        other = "{ allChatrooms(first: 2) { edges { node { roomName } } } }"
+
+        with mock.patch("common.views.replica_routing_graphql_view.persisted_query_store", store):
+            self.assertEqual(self.post(sha256_hash=document_hash(self.query))[0], 200)
+            self.assertEqual(self.post(self.query)[0], 200)
+            for response in (self.post(other), self.post(other, document_hash(other))):
+                self.assertEqual(response, (400, {"errors": [{"message": "登録されていないクエリは実行できません"}]}))
+
+
+class SearchTest(TestCase):
+    """
+    FTS5の仮想テーブルが無い(trigramに対応していないSQLiteなど)場合も、icontainsで同じ結果を返すこと
+    """
+
+    def setUp(self):
+        self.owner = UserOnMyApp.objects.create_user(username="owner", email="owner@example.com", password="password")
+        other = UserName(username="other")
+        other.save()
+        room = Chatroom.create("テスト部屋", self.owner.username)
+        Chatroom.create("雑談", self.owner.username)
+        PrivateChatroom.create("テストの秘密", self.owner.username)
+        PrivateChatroom.create("テストの別件", other)
+        ChatMessage.objects.create(room=room, sender=self.owner.username, text="テストです")
+        ChatMessage.objects.create(room=room, sender=self.owner.username, text="こんにちは")
+        self.graphql = GraphQLClient(self, self.owner)
+
+    def search(self):
+        rooms = self.graphql.execute('{ searchRooms(query: "テスト") { publicRooms { roomName } privateRooms { roomName } } }')
+        messages = self.graphql.execute('{ searchMessages(query: "テスト") { text } }')
+        return rooms, messages
+
+    def test_falls_back_to_icontains_without_search_index(self):
+        with capture_queries() as statements:
+            with_index = self.search()
+        with mock.patch("chatapp.logic.search.__has_search_index", return_value=False), capture_queries() as fallback_statements:
+            without_index = self.search()
+
+        self.assertTrue(any("_fts" in sql for sql in statements))
+        self.assertFalse(any("_fts" in sql for sql in fallback_statements))
+
+        self.assertEqual(with_index, without_index)
+        self.assertEqual(with_index, (
+            {"searchRooms": {"publicRooms": [{"roomName": "テスト部屋"}], "privateRooms": [{"roomName": "テストの秘密"}]}},
+            {"searchMessages": [{"text": "テストです"}]},
+        ))
+
+
+class MetricsViewTest(TestCase):
+    def setUp(self):
+        self.client = Client(HTTP_HOST="django")
+
+    def test_allows_only_loopback_by_default(self):
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="127.0.0.1").status_code, 200)
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="203.0.113.1").status_code, 403)
+        # X-Forwarded-Forは偽装できるため信用しない
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="203.0.113.1", HTTP_X_FORWARDED_FOR="127.0.0.1").status_code, 403)
+
+    @override_settings(METRICS_ALLOWED_IPS=["10.0.0.0/8"])
+    def test_allows_configured_networks(self):
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.1.2.3").status_code, 200)
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="127.0.0.1").status_code, 403)
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_requires_token_when_configured(self):
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="127.0.0.1").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="203.0.113.1", HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
+
+    def test_counts_fetched_rows_on_sqlite(self):
+        for i in range(3):
+            UserName(username=f"user-{i}").save()
+
+        with instrumentation.instrument_operation("count-rows"):
+            list(UserName.objects.all())
+            UserName.objects.filter(username="user-0").update(username="renamed")
+
+        # SELECTで取得した3行と、UPDATEした1行
+        self.assertIn('graphql_operation_sql_rows_sum{operation="count-rows"} 4', self.client.get("/metrics").content.decode())
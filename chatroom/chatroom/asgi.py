@@ -11,18 +11,25 @@ import os
 
 from django.urls import re_path
 from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatroom.settings')
+# モデルを参照するconsumerをimportする前にDjangoを初期化しておく
+django_asgi_app = get_asgi_application()
+
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from users.auth.google_auth_consumer import GoogleAuthConsumer
-
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatroom.settings')
+from chatapp.consumers.chatroom_consumer import ChatroomConsumer
+from chatapp.consumers.graphql_subscription_consumer import GraphQLSubscriptionConsumer
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": django_asgi_app,
     # Just HTTP for now. (We can add other protocols later.)
     "websocket": AuthMiddlewareStack(
         URLRouter([
-            re_path(r"^oauthcallback/(?P<state>\w+)/$", GoogleAuthConsumer.as_asgi())
+            re_path(r"^oauthcallback/(?P<state>\w+)/$", GoogleAuthConsumer.as_asgi()),
+            re_path(r"^chatroom/(?P<room_kind>public|private)/(?P<room_id>\d+)/$", ChatroomConsumer.as_asgi()),
+            re_path(r"^graphql/?$", GraphQLSubscriptionConsumer.as_asgi()),
         ])
     )
 })
\ No newline at end of file
@@ -10,4 +10,7 @@ class Query(users.schema.Query, chatapp.schema.Query, graphene.ObjectType):
 class Mutation(users.schema.Mutation, chatapp.schema.Mutation, graphene.ObjectType):
     pass
 
-schema = graphene.Schema(query=Query, mutation=Mutation)
\ No newline at end of file
+class Subscription(chatapp.schema.Subscription, graphene.ObjectType):
+    pass
+
+schema = graphene.Schema(query=Query, mutation=Mutation, subscription=Subscription)
\ No newline at end of file
@@ -14,6 +14,8 @@ from pathlib import Path
 import os
 import json
 
+from common.db.profiles import database_settings
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -37,12 +39,20 @@ else:
 
 ALLOWED_HOSTS = ["django"]
 
-DATA_UPLOAD_MAX_MEMORY_SIZE = None
+# ファイル以外のリクエストボディ(GraphQLのoperationsなど)の上限
+DATA_UPLOAD_MAX_MEMORY_SIZE = 2621440
+
+# 上限を超えるファイルは一時ファイルへ書き出す途中で打ち切る
+FILE_UPLOAD_MAX_SIZE = 50 * 1024 * 1024
+FILE_UPLOAD_HANDLERS = [
+    "django.core.files.uploadhandler.MemoryFileUploadHandler",
+    "common.uploads.limited_upload_handler.LimitedTemporaryFileUploadHandler",
+]
 
 # Application definition
 
 INSTALLED_APPS = [
-    "chatapp",
+    "chatapp.apps.ChatappConfig",
     "users",
     "graphene_django",
     'django.contrib.admin',
@@ -90,13 +100,38 @@ WSGI_APPLICATION = 'chatroom.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
+# 設定ファイルのDATABASEでPROFILEを切り替える(既定はsqlite)
+# 例: 単一ノード {"PROFILE": "sqlite-wal"}
+#     複数ノード {"PROFILE": "postgres", "HOST": "pgbouncer", "POOLER": "pgbouncer", "PASSWORD": "..."}
+# 各PROFILEのメッセージ書き込み性能は manage.py bench_message_insert で比較できる
+DATABASE_CONFIG = setting_file.get("DATABASE", {})
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    'default': database_settings(DATABASE_CONFIG, BASE_DIR)
 }
 
+# DATABASEのREPLICASにPROFILEと同じ形式で読み込み専用のレプリカを列挙すると、GraphQLのqueryはレプリカから読み込む
+# 例: {"PROFILE": "postgres", "HOST": "primary", "REPLICAS": [{"PROFILE": "postgres", "HOST": "replica1"}]}
+DATABASE_REPLICAS = []
+for i, replica_config in enumerate(DATABASE_CONFIG.get("REPLICAS", [])):
+    DATABASE_REPLICAS.append(f"replica{i}")
+    # テストではレプリカもdefaultのテスト用DBを参照する
+    DATABASES[f"replica{i}"] = {**database_settings(replica_config, BASE_DIR), "TEST": {"MIRROR": "default"}}
+
+DATABASE_ROUTERS = ["common.db.routers.ReadReplicaRouter"]
+# mutationの後、この秒数の間は同じクライアントのqueryもプライマリから読み込む
+DATABASE_READ_AFTER_WRITE_SECONDS = 5
+
+# ルームのメンバーとroleのキャッシュ、WebSocketの在室状況、persisted query、RATE_LIMIT_BACKEND="cache"のレート制限で使う
+# 既定のLocMemCacheはプロセスごとのため、メンバーを削除しても他のワーカーではタイムアウトまで古い権限が残り、
+# 他のワーカーに接続しているユーザーは在室中にならない
+# 複数ワーカーで動かす場合は設定ファイルのCACHESでMemcachedなどの共有キャッシュを指定する(指定しない場合はmanage.py checkで警告する)
+# 例: {"default": {"BACKEND": "django.core.cache.backends.memcached.PyLibMCCache", "LOCATION": "memcached:11211"}}
+CACHES = setting_file.get("CACHES", {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+})
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -142,15 +177,80 @@ MEDIA_URL = setting_file["MEDIA_URL"]
 
 GRAPHENE = {
     'SCHEMA': 'chatroom.schema.schema',
+    # subscriptionはasgi.pyのGraphQLSubscriptionConsumerがgraphql-wsプロトコルで配信する
+    'SUBSCRIPTION_PATH': '/graphql',
+}
+
+# 構文解析と検証を済ませたGraphQLのドキュメントを、クエリ文字列のハッシュごとにこの件数までキャッシュする
+GRAPHQL_DOCUMENT_CACHE_SIZE = 256
+# クライアントのビルド時に書き出した {sha256: クエリ文字列} のJSON。PERSISTED_QUERIES_ONLYの場合はここに載っているクエリだけを実行する
+GRAPHQL_PERSISTED_QUERY_MANIFEST = setting_file.get("GRAPHQL_PERSISTED_QUERY_MANIFEST")
+GRAPHQL_PERSISTED_QUERIES_ONLY = setting_file.get("GRAPHQL_PERSISTED_QUERIES_ONLY", False)
+
+# 実行前に見積もるクエリの深さ・コスト・connectionのfirst(last)の上限
+# FIELD_COSTSには"型名.フィールド名"ごとの重みを指定する(既定はオブジェクトが1、スカラーが0)
+GRAPHQL_QUERY_COST = {
+    "MAX_DEPTH": 10,
+    "MAX_COST": 5000,
+    "MAX_FIRST": 100,
+    "FIELD_COSTS": {
+        # 返したURLごとに画像の取得(初回はレンディションの生成)が発生するため重く数える
+        "UserProfileNode.icon": 50,
+        "UserProfileNode.coverImage": 50,
+    },
 }
 
+# resolve_xxxを定義したフィールドごとの実行時間とSQLの件数を/metricsで公開する
+GRAPHQL_RESOLVER_METRICS = setting_file.get("GRAPHQL_RESOLVER_METRICS", True)
+# 設定した場合、/metricsには Authorization: Bearer <METRICS_TOKEN> が必要
+METRICS_TOKEN = setting_file.get("METRICS_TOKEN")
+# METRICS_TOKENを設定しない場合に/metricsを取得できる接続元のIPアドレス(ネットワークも可)
+METRICS_ALLOWED_IPS = setting_file.get("METRICS_ALLOWED_IPS", ["127.0.0.1", "::1"])
+
+# テストのQueryCountAssertionsで、各操作の1回の実行に許す時間(秒)。遅いCIでは環境変数で延ばす
+QUERY_COUNT_TIME_BUDGET = float(os.environ.get("QUERY_COUNT_TIME_BUDGET", 2.0))
+
 ASGI_APPLICATION = "chatroom.asgi.application"
 
-CHANNEL_LAYERS = {
+# チャットメッセージはこの件数か待ち時間(秒)に達するまでまとめてから保存する
+CHAT_MESSAGE_BATCH_SIZE = 100
+CHAT_MESSAGE_BATCH_DELAY = 0.05
+
+# WebSocketの接続はこの秒数heartbeatが無ければ切断されたとみなし、在室状況はこの間隔(秒)でDBのis_enterへ書き込む
+CHAT_PRESENCE_TTL = 60
+CHAT_PRESENCE_CHECKPOINT_INTERVAL = 30
+
+# WebSocketの接続ごとに送信待ちにできるフレームの件数と、溢れた場合の方針(drop_oldest, coalesce, disconnect)
+CHAT_OUTBOUND_QUEUE_SIZE = 256
+CHAT_OUTBOUND_QUEUE_POLICY = "coalesce"
+
+# 操作ごとのレート制限。RATEは持続できる頻度("回数/s|m|h|d")、BURSTは連続して許可する回数
+# サインイン中はユーザーごと、していない場合はIPアドレスごとに数え、send_messageとinvitationはルームごとに数える
+# 複数ワーカーで共有する場合はRATE_LIMIT_BACKENDを"cache"にし、CACHESにRedisなどを設定する
+RATE_LIMIT_BACKEND = setting_file.get("RATE_LIMIT_BACKEND", "local")
+# nginxなどのリバースプロキシ越しの場合は、X-Forwarded-Forの先頭を接続元とする
+RATE_LIMIT_USE_FORWARDED_FOR = setting_file.get("RATE_LIMIT_USE_FORWARDED_FOR", False)
+RATE_LIMITS = {
+    "sign_in": {"RATE": "10/m", "BURST": 5},
+    "sign_up": {"RATE": "5/h", "BURST": 3},
+    "create_room": {"RATE": "10/h", "BURST": 5},
+    "invitation": {"RATE": "30/m", "BURST": 10},
+    "edit_profile": {"RATE": "10/m", "BURST": 5},
+    "send_message": {"RATE": "5/s", "BURST": 20},
+}
+
+# 複数ワーカー・ノードでgroupを共有する場合は設定ファイルのCHANNEL_LAYERSでRedisBrokerを指定する
+# 例: {"default": {"BACKEND": "common.channel_layers.pubsub_layer.PubSubChannelLayer",
+#                  "CONFIG": {"broker": "common.channel_layers.brokers.RedisBroker",
+#                             "broker_options": {"url": "redis://redis:6379/0"}}}}
+CHANNEL_LAYERS = setting_file.get("CHANNEL_LAYERS", {
     "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
+        "BACKEND": "common.channel_layers.pubsub_layer.PubSubChannelLayer",
+        "CONFIG": {
+            "broker": "common.channel_layers.brokers.LocalBroker",
+        },
     }
-}
+})
 
 """
 CORS_ORIGIN_WHITELIST = ["http://localhost:3000", "http://localhost:8080", "http://127.0.0.1:8080"]
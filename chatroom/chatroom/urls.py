@@ -13,17 +13,27 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path
 from django.urls import include
 from django.views.decorators.csrf import csrf_exempt
-
-from graphene_file_upload.django import FileUploadGraphQLView
+from graphql.execution.middleware import MiddlewareManager
 
 from chatroom.schema import schema
+from common.graphql.document_cache import LRUCachedBackend
+from common.graphql.instrumentation import ResolverMetricsMiddleware
+from common.views.metrics_view import metrics
+from common.views.replica_routing_graphql_view import ReplicaRoutingGraphQLView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path("graphql", (FileUploadGraphQLView.as_view(graphiql=True, schema=schema))),
+    path("graphql", (ReplicaRoutingGraphQLView.as_view(
+        graphiql=True,
+        schema=schema,
+        backend=LRUCachedBackend(settings.GRAPHQL_DOCUMENT_CACHE_SIZE),
+        middleware=MiddlewareManager(ResolverMetricsMiddleware(), wrap_in_promise=False)
+    ))),
+    path("metrics", metrics),
     path("users/", include("users.urls"))
 ]
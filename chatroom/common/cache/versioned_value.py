@@ -0,0 +1,63 @@
+from typing import Callable, Final, Optional, Tuple, TypeVar
+
+from django.core.cache import cache
+
+
+T = TypeVar("T")
+
+# 新しい版を書き込んだ後も、古い版を読み込んでいる途中の他のワーカーのために残しておく秒数
+STALE_VERSION_TIMEOUT: Final[int] = 2
+# 他のワーカーの更新と競合し続けた場合に、読み込み直して更新し直す回数の上限
+MAX_ATTEMPTS: Final[int] = 100
+
+
+class ConcurrentUpdateError(Exception):
+    pass
+
+
+def _version_key(key: str) -> str:
+    return "%s-version" % key
+
+
+def _value_key(key: str, version: int) -> str:
+    return "%s-v%s" % (key, version)
+
+
+def _latest(key: str) -> Tuple[int, Optional[tuple]]:
+    """
+    最新の版と、その値を(値, )で返す。値が無い(期限切れの)場合はNone
+    版の番号は書き込んだ後に更新するため、番号より新しい版が無いかを確かめながら辿る
+    """
+    version = cache.get(_version_key(key), 0)
+    values = cache.get_many([_value_key(key, version), _value_key(key, version + 1)])
+    value, following = values.get(_value_key(key, version)), values.get(_value_key(key, version + 1))
+    while following is not None:
+        version, value = version + 1, following
+        following = cache.get(_value_key(key, version + 1))
+
+    return version, value
+
+
+def get(key: str, default=None):
+    _, value = _latest(key)
+    return default if value is None else value[0]
+
+
+def update(key: str, func: Callable[[Optional[T]], T], timeout: int) -> T:
+    """
+    keyの値をfunc(現在の値。無い場合はNone)の結果で置き換えて返す
+    ロックを取らずに、次の版をcache.addで書き込めたワーカーだけが更新できるようにし、
+    他のワーカーと同時に更新しても互いの更新を失わない
+    書き込めなかった場合は最新の版を読み込み直してfuncを呼び出し直すため、funcは副作用を持たないこと
+    """
+    timeout = max(timeout, STALE_VERSION_TIMEOUT)
+    for _ in range(MAX_ATTEMPTS):
+        version, value = _latest(key)
+        new_value = func(None if value is None else value[0])
+        if cache.add(_value_key(key, version + 1), (new_value, ), timeout):
+            cache.set(_version_key(key), version + 1, timeout)
+            if value is not None:
+                cache.touch(_value_key(key, version), STALE_VERSION_TIMEOUT)
+            return new_value
+
+    raise ConcurrentUpdateError("他の更新と競合し続けたため、%sを更新できませんでした" % key)
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+from typing import Callable, Dict, Final, List, Tuple
+
+from django.core.exceptions import ImproperlyConfigured
+
+
+logger = logging.getLogger(__name__)
+
+Callback = Callable[[bytes], None]
+
+# Redisから受信できなくなった場合に再接続するまでの秒数。失敗するたびに倍にし、MAXを上限とする
+RECONNECT_BACKOFF: Final[float] = 0.5
+RECONNECT_BACKOFF_MAX: Final[float] = 30
+
+
+class LocalBroker:
+    """
+    Redisを使わずに複数ノード構成を再現するためのプロセス内pub/subブローカー
+    同じnameを指定したインスタンス同士でtopicを共有するので、
+    PubSubChannelLayerを複数作ればそれぞれを別ノードとして扱える
+    """
+    __networks: Dict[str, Dict[str, Dict[int, Tuple[asyncio.AbstractEventLoop, Callback]]]] = {}
+
+    def __init__(self, name: str = "default") -> None:
+        self.__topics = LocalBroker.__networks.setdefault(name, {})
+        self.published_count = 0
+
+
+    async def publish_many(self, items: List[Tuple[str, bytes]]) -> None:
+        self.published_count += len(items)
+        for topic, payload in items:
+            for loop, callback in list(self.__topics.get(topic, {}).values()):
+                loop.call_soon_threadsafe(callback, payload)
+
+
+    async def subscribe(self, topic: str, callback: Callback) -> None:
+        self.__topics.setdefault(topic, {})[id(self)] = (asyncio.get_running_loop(), callback)
+
+
+    async def unsubscribe(self, topic: str) -> None:
+        subscribers = self.__topics.get(topic, {})
+        subscribers.pop(id(self), None)
+        if not subscribers:
+            self.__topics.pop(topic, None)
+
+
+    async def close(self) -> None:
+        for topic in list(self.__topics):
+            await self.unsubscribe(topic)
+
+
+class RedisBroker:
+    """
+    Redisのpub/subを利用するブローカー
+    publishはpipelineにまとめて1往復で送信する
+    受信できなくなった場合は、間隔を空けながら接続し直して全てのtopicを購読し直す
+    """
+    def __init__(self, url: str = "redis://localhost:6379/0") -> None:
+        try:
+            import redis.asyncio as aioredis
+        except ImportError as err:
+            raise ImproperlyConfigured("RedisBrokerを使用するにはredis(4.2以上)をインストールしてください") from err
+
+        self.__redis = aioredis.from_url(url)
+        self.__pubsub = self.__redis.pubsub()
+        self.__callbacks: Dict[str, Callback] = {}
+        self.__reader = None
+
+
+    async def publish_many(self, items: List[Tuple[str, bytes]]) -> None:
+        async with self.__redis.pipeline(transaction=False) as pipe:
+            for topic, payload in items:
+                pipe.publish(topic, payload)
+            await pipe.execute()
+
+
+    async def subscribe(self, topic: str, callback: Callback) -> None:
+        self.__callbacks[topic] = callback
+        await self.__pubsub.subscribe(topic)
+        if self.__reader is None:
+            self.__reader = asyncio.ensure_future(self.__read())
+
+
+    async def unsubscribe(self, topic: str) -> None:
+        self.__callbacks.pop(topic, None)
+        await self.__pubsub.unsubscribe(topic)
+
+
+    async def close(self) -> None:
+        if self.__reader is not None:
+            self.__reader.cancel()
+            self.__reader = None
+
+        await self.__pubsub.close()
+        await self.__redis.close()
+
+
+    async def __read(self) -> None:
+        while True:
+            try:
+                message = await self.__pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Redisのpub/subから受信できませんでした。接続し直します")
+                await self.__reconnect()
+                continue
+
+            if message is None:
+                continue
+
+            callback = self.__callbacks.get(message["channel"].decode())
+            if callback is not None:
+                try:
+                    callback(message["data"])
+                except Exception:
+                    logger.exception("Redisのpub/subから受信したメッセージを処理できませんでした")
+
+
+    async def __reconnect(self) -> None:
+        backoff = RECONNECT_BACKOFF
+        while True:
+            await asyncio.sleep(backoff)
+            pubsub = self.__redis.pubsub()
+            try:
+                topics = list(self.__callbacks)
+                if topics:
+                    await pubsub.subscribe(*topics)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+                logger.exception("Redisへ再接続できませんでした。%s秒後にもう一度試します", backoff)
+                await self.__close_quietly(pubsub)
+                continue
+
+            old, self.__pubsub = self.__pubsub, pubsub
+            await self.__close_quietly(old)
+            # 再接続している間に購読を始めたtopic
+            added = [topic for topic in self.__callbacks if topic not in topics]
+            if added:
+                await pubsub.subscribe(*added)
+            logger.info("Redisのpub/subへ再接続しました")
+            return
+
+
+    async def __close_quietly(self, pubsub) -> None:
+        try:
+            await pubsub.close()
+        except Exception:
+            pass
@@ -0,0 +1,259 @@
+import asyncio
+import json
+import time
+import uuid
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.utils.module_loading import import_string
+
+
+class PubSubChannelLayer(BaseChannelLayer):
+    """
+    pub/subブローカーを介して複数のASGIワーカー・ノードでgroupを共有するchannel layer
+
+    - ノード(=layerのインスタンス)ごとに1つのtopicを購読し、そのノードのchannel宛のメッセージを受け取る
+    - groupごとに1つのtopicを用意し、groupに所属するchannelを持つノードだけが購読する
+      group_sendは所属channel数に関係なく1回のpublishで済み、受信したノードがローカルのchannelに配る
+    - publishはbatch_sizeかbatch_intervalに達するまでまとめてからブローカーへ送る
+      batch_intervalが0の場合と、channelを作成して受信しているイベントループ以外(async_to_syncで作られた一時的なループなど)から
+      呼び出された場合は、まとめずに送ってから戻る。一時的なループは閉じられ、予約した送信が実行されないため
+    - channelごとのキューはcapacityで上限を設け、溢れたgroup宛メッセージは破棄する
+
+    メッセージはJSONでシリアライズするため、JSONに変換できる値のみ送信できる
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(
+        self,
+        broker: str = "common.channel_layers.brokers.LocalBroker",
+        broker_options: dict = None,
+        prefix: str = "chatroom",
+        expiry: int = 60,
+        capacity: int = 100,
+        channel_capacity: dict = None,
+        batch_size: int = 100,
+        batch_interval: float = 0.0,
+        **kwargs
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.broker = import_string(broker)(**(broker_options or {}))
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.node_name = "%s.%s!" % (prefix, uuid.uuid4().hex)
+
+        self.__queues: Dict[str, Deque[Tuple[float, dict]]] = {}
+        self.__waiters: Dict[str, asyncio.Future] = {}
+        self.__groups: Dict[str, Set[str]] = {}
+        self.__subscribed: Set[str] = set()
+        self.__outbox: Dict[str, List[list]] = {}
+        self.__outbox_size = 0
+        self.__flush_handle = None
+        # channelを作成して受信しているイベントループ。送信をまとめるのはこのループから呼び出された場合だけ
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__cleaned_at = time.time()
+
+
+    # Channel layer API
+
+    async def send(self, channel: str, message: dict) -> None:
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+
+        if self.__is_local(channel):
+            if not self.__deliver(channel, message):
+                raise ChannelFull(channel)
+            return
+
+        await self.__publish(self.__topic(self.non_local_name(channel)), ["c", channel, message])
+
+
+    async def receive(self, channel: str) -> dict:
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        self.__loop = asyncio.get_running_loop()
+        if not self.__is_local(channel):
+            await self.__subscribe(self.__topic(channel))
+
+        self.__clean_expired()
+        while True:
+            queue = self.__queues.get(channel)
+            while queue:
+                expires_at, message = queue.popleft()
+                if not queue:
+                    del self.__queues[channel]
+
+                if expires_at >= time.time():
+                    return message
+
+            waiter = asyncio.get_running_loop().create_future()
+            self.__waiters[channel] = waiter
+            try:
+                await waiter
+            finally:
+                self.__waiters.pop(channel, None)
+
+
+    async def new_channel(self, prefix: str = "specific") -> str:
+        self.__loop = asyncio.get_running_loop()
+        await self.__subscribe(self.__topic(self.node_name))
+        return "%s%s.%s" % (self.node_name, prefix, uuid.uuid4().hex)
+
+
+    # Groups extension
+
+    async def group_add(self, group: str, channel: str) -> None:
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+
+        self.__groups.setdefault(group, set()).add(channel)
+        await self.__subscribe(self.__topic("group." + group))
+
+
+    async def group_discard(self, group: str, channel: str) -> None:
+        assert self.valid_group_name(group), "Invalid group name"
+        assert self.valid_channel_name(channel), "Invalid channel name"
+
+        members = self.__groups.get(group)
+        if members is None:
+            return
+
+        members.discard(channel)
+        if not members:
+            del self.__groups[group]
+            topic = self.__topic("group." + group)
+            self.__subscribed.discard(topic)
+            await self.broker.unsubscribe(topic)
+
+
+    async def group_send(self, group: str, message: dict) -> None:
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+
+        # 自ノードのメンバーにはブローカーを経由せずに配信する
+        self.__deliver_to_group(group, message)
+        await self.__publish(self.__topic("group." + group), ["g", group, message])
+
+
+    # Flush extension
+
+    async def flush(self) -> None:
+        await self.__flush_outbox()
+        self.__queues = {}
+        self.__groups = {}
+        for topic in list(self.__subscribed):
+            await self.broker.unsubscribe(topic)
+        self.__subscribed = set()
+
+
+    async def close(self) -> None:
+        await self.__flush_outbox()
+        await self.broker.close()
+
+
+    # ブローカーとのやり取り
+
+    def __topic(self, name: str) -> str:
+        return "%s:%s" % (self.prefix, name)
+
+
+    def __is_local(self, channel: str) -> bool:
+        return channel.startswith(self.node_name)
+
+
+    async def __subscribe(self, topic: str) -> None:
+        if topic in self.__subscribed:
+            return
+
+        self.__subscribed.add(topic)
+        await self.broker.subscribe(topic, self.__on_broker_message)
+
+
+    async def __publish(self, topic: str, item: list) -> None:
+        if asyncio.get_running_loop() is not self.__loop:
+            # 他のループの予約と混ざらないよう、まとめ待ちのメッセージには加えずにそのまま送る
+            await self.broker.publish_many([(topic, self.__encode([item]))])
+            return
+
+        self.__outbox.setdefault(topic, []).append(item)
+        self.__outbox_size += 1
+
+        if self.__outbox_size >= self.batch_size or self.batch_interval <= 0:
+            await self.__flush_outbox()
+        elif self.__flush_handle is None:
+            self.__flush_handle = self.__loop.call_later(
+                self.batch_interval,
+                lambda: asyncio.ensure_future(self.__flush_outbox())
+            )
+
+
+    async def __flush_outbox(self) -> None:
+        if self.__flush_handle is not None:
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+
+        if not self.__outbox:
+            return
+
+        outbox, self.__outbox, self.__outbox_size = self.__outbox, {}, 0
+        await self.broker.publish_many([(topic, self.__encode(items)) for topic, items in outbox.items()])
+
+
+    def __encode(self, items: List[list]) -> bytes:
+        return json.dumps({"node": self.node_name, "items": items}).encode("utf-8")
+
+
+    def __on_broker_message(self, payload: bytes) -> None:
+        envelope = json.loads(payload)
+        if envelope["node"] == self.node_name:
+            return
+
+        for kind, name, message in envelope["items"]:
+            if kind == "g":
+                self.__deliver_to_group(name, message)
+            else:
+                self.__deliver(name, message)
+
+
+    # ローカルキューへの配信
+
+    def __clean_expired(self) -> None:
+        """
+        受信されないまま残ったキューを、expiryごとに1回まとめて削除する
+        """
+        now = time.time()
+        if now - self.__cleaned_at < self.expiry:
+            return
+
+        self.__cleaned_at = now
+        for channel, queue in list(self.__queues.items()):
+            while queue and queue[0][0] < now:
+                queue.popleft()
+
+            if not queue:
+                del self.__queues[channel]
+
+
+    def __deliver_to_group(self, group: str, message: dict) -> None:
+        for channel in list(self.__groups.get(group, ())):
+            self.__deliver(channel, message)
+
+
+    def __deliver(self, channel: str, message: dict) -> bool:
+        """
+        キューが上限に達している場合は配信せずにFalseを返す
+        """
+        queue = self.__queues.setdefault(channel, deque())
+        if len(queue) >= self.get_capacity(channel):
+            return False
+
+        queue.append((time.time() + self.expiry, dict(message)))
+        waiter = self.__waiters.get(channel)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+        return True
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import weakref
+from collections import deque
+from enum import Enum
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+Frame = dict
+
+
+class OverflowPolicy(Enum):
+    # 最も古いフレームを捨てる
+    DROP_OLDEST = "drop_oldest"
+    # 溜まっているフレームをcoalesceでまとめる(例: 読み飛ばした範囲の通知)
+    COALESCE = "coalesce"
+    # 接続を切断する。クライアントは受信済みのcursorから再接続する
+    DISCONNECT = "disconnect"
+
+
+class OutboundQueueMetrics:
+    """
+    プロセス内のOutboundQueueの深さと、溢れたときに捨てた・まとめた・切断した回数
+    """
+    def __init__(self) -> None:
+        self.__queues: "weakref.WeakSet[OutboundQueue]" = weakref.WeakSet()
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnected = 0
+
+
+    def register(self, queue: "OutboundQueue") -> None:
+        self.__queues.add(queue)
+
+
+    def unregister(self, queue: "OutboundQueue") -> None:
+        self.__queues.discard(queue)
+
+
+    def snapshot(self) -> Dict[str, int]:
+        depths = [len(queue) for queue in list(self.__queues)]
+        return {
+            "queues": len(depths),
+            "depth": sum(depths),
+            "max_depth": max(depths, default=0),
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "disconnected": self.disconnected,
+        }
+
+
+outbound_queue_metrics = OutboundQueueMetrics()
+
+
+class OutboundQueue:
+    """
+    WebSocketの接続ごとに、送信するフレームをmax_size件までためて1つのタスクから順に送信する
+
+    consumerのハンドラはputするだけで送信の完了を待たないため、受信が遅いクライアントがいても
+    channel layerからの受信は滞らず、溜まる量はmax_size件で頭打ちになる
+    coalesceは溜まっているフレームを受け取り、置き換えるフレームのリストを返す。まとめられないフレームを残した結果、
+    max_size件以上になる場合もそのまま送信する
+    coalesceが指定されていない場合、COALESCEはDROP_OLDESTと同じく古いフレームを捨てる
+    """
+    def __init__(
+        self,
+        send: Callable[[Frame], Awaitable[None]],
+        max_size: int = 256,
+        policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+        coalesce: Optional[Callable[[List[Frame]], List[Frame]]] = None,
+        on_disconnect: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> None:
+        self.max_size = max_size
+        self.policy = policy
+        self.__send = send
+        self.__coalesce = coalesce
+        self.__on_disconnect = on_disconnect
+        self.__frames: Deque[Frame] = deque()
+        self.__ready = asyncio.Event()
+        self.__closed = False
+        self.__writer = asyncio.get_running_loop().create_task(self.__write())
+        outbound_queue_metrics.register(self)
+
+
+    def __len__(self) -> int:
+        return len(self.__frames)
+
+
+    def put(self, frame: Frame) -> None:
+        if self.__closed:
+            return
+
+        if len(self.__frames) >= self.max_size:
+            self.__overflow()
+            if self.__closed:
+                return
+
+        self.__frames.append(frame)
+        self.__ready.set()
+
+
+    def close(self) -> None:
+        """
+        溜まっているフレームを捨てて送信タスクを止める
+        """
+        self.__closed = True
+        self.__frames.clear()
+        self.__writer.cancel()
+        outbound_queue_metrics.unregister(self)
+
+
+    def __overflow(self) -> None:
+        if self.policy == OverflowPolicy.DISCONNECT:
+            outbound_queue_metrics.disconnected += 1
+            self.close()
+            if self.__on_disconnect is not None:
+                asyncio.get_running_loop().create_task(self.__on_disconnect())
+            return
+
+        if self.policy == OverflowPolicy.COALESCE and self.__coalesce is not None:
+            frames = list(self.__frames)
+            coalesced = self.__coalesce(frames)
+            self.__frames.clear()
+            self.__frames.extend(coalesced)
+            outbound_queue_metrics.coalesced += len(frames) - len(coalesced)
+            return
+
+        self.__frames.popleft()
+        outbound_queue_metrics.dropped += 1
+
+
+    async def __write(self) -> None:
+        while True:
+            await self.__ready.wait()
+            while self.__frames:
+                frame = self.__frames.popleft()
+                try:
+                    await self.__send(frame)
+                except Exception:
+                    logger.exception("WebSocketへ送信できませんでした")
+
+            self.__ready.clear()
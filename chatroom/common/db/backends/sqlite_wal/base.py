@@ -0,0 +1,24 @@
+from django.db.backends.sqlite3 import base
+
+from common.db.profiles import DEFAULT_SQLITE_PRAGMAS
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    接続するたびに、設定のPRAGMASをSQLiteへ設定する
+
+    トランザクションはBEGIN IMMEDIATEで開始して、最初から書き込みロックを取得する
+    読み込みから始めたトランザクションが後から書き込もうとすると、他の書き込みと競合したときに
+    busy_timeoutを待たずに「database is locked」で失敗するため
+    """
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.settings_dict.get("PRAGMAS", DEFAULT_SQLITE_PRAGMAS).items():
+            conn.execute(f"PRAGMA {name} = {value}")
+
+        return conn
+
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute("BEGIN IMMEDIATE")
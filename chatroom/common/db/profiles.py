@@ -0,0 +1,58 @@
+from pathlib import Path
+from typing import Final
+
+
+# 単一ノードでの運用向け。WALにより読み込みが書き込みを待たなくなり、同期の回数も減らす
+DEFAULT_SQLITE_PRAGMAS: Final[dict] = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "cache_size": -20000,
+    "temp_store": "MEMORY",
+    "mmap_size": 268435456,
+}
+
+
+def database_settings(config: dict, base_dir: Path) -> dict:
+    """
+    設定ファイルのDATABASEからDATABASES["default"]を作成する
+    PROFILEにはsqlite(既定)、sqlite-wal、postgresのいずれかを指定する
+    """
+    profile = config.get("PROFILE", "sqlite")
+    if profile == "sqlite":
+        return {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": config.get("NAME", base_dir / "db.sqlite3"),
+        }
+
+    if profile == "sqlite-wal":
+        return {
+            "ENGINE": "common.db.backends.sqlite_wal",
+            "NAME": config.get("NAME", base_dir / "db.sqlite3"),
+            # 書き込みロックの待ち時間(秒)。PRAGMAのbusy_timeoutと合わせる
+            "OPTIONS": {"timeout": 5},
+            "PRAGMAS": {**DEFAULT_SQLITE_PRAGMAS, **config.get("PRAGMAS", {})},
+        }
+
+    if profile == "postgres":
+        database = {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": config.get("NAME", "chatroom"),
+            "USER": config.get("USER", "chatroom"),
+            "PASSWORD": config.get("PASSWORD", ""),
+            "HOST": config.get("HOST", "localhost"),
+            "PORT": config.get("PORT", 5432),
+            # リクエストごとに接続し直さないよう、ワーカーごとに接続を使い回す
+            "CONN_MAX_AGE": config.get("CONN_MAX_AGE", 60),
+            "OPTIONS": config.get("OPTIONS", {}),
+        }
+        if config.get("POOLER") == "pgbouncer":
+            # pgbouncerのtransaction poolingでは、トランザクションをまたぐサーバーサイドカーソルを使えない
+            # 接続はpgbouncerがプールするため、Django側では使い回さずに返却する
+            database["DISABLE_SERVER_SIDE_CURSORS"] = True
+            database["CONN_MAX_AGE"] = config.get("CONN_MAX_AGE", 0)
+            database["PORT"] = config.get("PORT", 6432)
+
+        return database
+
+    raise ValueError(f"DATABASEのPROFILE「{profile}」はサポートしていません")
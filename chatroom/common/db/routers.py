@@ -0,0 +1,43 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from django.conf import settings
+
+
+_read_database: ContextVar[Optional[str]] = ContextVar("read_database", default=None)
+
+
+@contextmanager
+def use_replica():
+    """
+    このブロックの中の読み込みだけを、DATABASE_REPLICASのいずれかへ振り分ける
+    レプリカが設定されていない場合はdefaultのまま
+    """
+    replicas = getattr(settings, "DATABASE_REPLICAS", [])
+    token = _read_database.set(random.choice(replicas) if replicas else None)
+    try:
+        yield
+    finally:
+        _read_database.reset(token)
+
+
+class ReadReplicaRouter:
+    """
+    use_replicaの中の読み込みはレプリカへ、それ以外の読み込みと書き込みはすべてdefaultへ振り分ける
+    """
+
+    def db_for_read(self, model, **hints):
+        return _read_database.get() or "default"
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # レプリカはdefaultの複製なので、どのDBから読み込んだオブジェクトでも関連付けてよい
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # レプリカのスキーマはレプリケーションでdefaultから複製される
+        return db not in getattr(settings, "DATABASE_REPLICAS", [])
@@ -0,0 +1,88 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import partial
+from typing import Final, Tuple
+
+from graphql.backend.base import GraphQLDocument
+from graphql.backend.core import GraphQLCoreBackend
+from graphql.execution import ExecutionResult, execute
+from graphql.language.base import parse
+from graphql.type.schema import GraphQLSchema
+from graphql.validation import validate
+from graphql.validation.rules import NoFragmentCycles
+
+
+DEFAULT_CACHE_SIZE: Final[int] = 256
+
+
+def document_hash(document_string: str) -> str:
+    """
+    Apollo Clientのpersisted queryと同じく、クエリ文字列のsha256を16進数で返す
+    """
+    return hashlib.sha256(document_string.encode("utf-8")).hexdigest()
+
+
+def _validate(schema: GraphQLSchema, document_ast) -> list:
+    """
+    graphql-core 2のOverlappingFieldsCanBeMergedは循環するフラグメントで無限に再帰するため、
+    先に循環だけを検証し、循環している場合は他の検証を行わない
+    """
+    return validate(schema, document_ast, [NoFragmentCycles]) or validate(schema, document_ast)
+
+
+def _execute_validated(schema: GraphQLSchema, document_ast, validation_errors: list, *args, **kwargs):
+    if validation_errors:
+        return ExecutionResult(errors=validation_errors, invalid=True)
+
+    kwargs.pop("validate", None)
+    return execute(schema, document_ast, *args, **kwargs)
+
+
+class LRUCachedBackend(GraphQLCoreBackend):
+    """
+    クエリ文字列のハッシュごとに、構文解析と検証を済ませたドキュメントをLRUでmax_size件まで保持する
+    同じoperationを繰り返し実行する場合、解析と検証は最初の1回だけ行う
+    """
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE, executor=None) -> None:
+        super().__init__(executor=executor)
+        self.max_size = max_size
+        self.__documents: "OrderedDict[Tuple[int, str], GraphQLDocument]" = OrderedDict()
+        self.__lock = threading.Lock()
+
+
+    def document_from_string(self, schema: GraphQLSchema, document_string) -> GraphQLDocument:
+        if not isinstance(document_string, str):
+            return super().document_from_string(schema, document_string)
+
+        key = (id(schema), document_hash(document_string))
+        with self.__lock:
+            document = self.__documents.get(key)
+            if document is not None:
+                self.__documents.move_to_end(key)
+                return document
+
+        # 構文エラーはキャッシュせず、そのまま送出する
+        document_ast = parse(document_string)
+        document = GraphQLDocument(
+            schema=schema,
+            document_string=document_string,
+            document_ast=document_ast,
+            execute=partial(_execute_validated, schema, document_ast, _validate(schema, document_ast), **self.execute_params),
+        )
+        with self.__lock:
+            self.__documents[key] = document
+            self.__documents.move_to_end(key)
+            while len(self.__documents) > self.max_size:
+                self.__documents.popitem(last=False)
+
+        return document
+
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__documents.clear()
+
+
+    def __len__(self) -> int:
+        return len(self.__documents)
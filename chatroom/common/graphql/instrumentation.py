@@ -0,0 +1,152 @@
+import time
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connections
+from graphene.types.resolver import get_default_resolver
+from promise import Promise
+
+from common.metrics.prometheus import COUNT_BUCKETS, Histogram, registry
+
+
+operation_duration = registry.register(Histogram(
+    "graphql_operation_duration_seconds", "GraphQLのoperationの実行時間", ["operation"]
+))
+operation_queries = registry.register(Histogram(
+    "graphql_operation_sql_queries", "GraphQLのoperationごとに実行したSQLの件数", ["operation"], COUNT_BUCKETS
+))
+operation_rows = registry.register(Histogram(
+    "graphql_operation_sql_rows", "GraphQLのoperationごとにSQLが返した(更新した)行数", ["operation"], COUNT_BUCKETS
+))
+resolver_duration = registry.register(Histogram(
+    "graphql_resolver_duration_seconds", "resolverの実行時間。DataLoaderを使う場合は値が揃うまで", ["field"]
+))
+resolver_queries = registry.register(Histogram(
+    "graphql_resolver_sql_queries", "resolverの実行中に発行したSQLの件数", ["field"], COUNT_BUCKETS
+))
+resolver_rows = registry.register(Histogram(
+    "graphql_resolver_sql_rows", "resolverの実行中にSQLが返した(更新した)行数", ["field"], COUNT_BUCKETS
+))
+
+
+class SQLTally:
+    def __init__(self) -> None:
+        self.queries = 0
+        self.rows = 0
+
+
+# 実行中のoperationと、実行中のresolver(DataLoaderのバッチなどresolverの外ではNone)
+_operation_tally: ContextVar[Optional[SQLTally]] = ContextVar("graphql_operation_tally", default=None)
+_resolver_tally: ContextVar[Optional[SQLTally]] = ContextVar("graphql_resolver_tally", default=None)
+
+
+def _count_sql(execute, sql, params, many, context):
+    result = execute(sql, params, many, context)
+    tallies = [tally for tally in (_operation_tally.get(), _resolver_tally.get()) if tally is not None]
+    for tally in tallies:
+        tally.queries += 1
+
+    cursor = context["cursor"]
+    if cursor.description is None:
+        for tally in tallies:
+            tally.rows += max(cursor.rowcount, 0)
+    elif tallies:
+        _count_fetched_rows(cursor, tallies)
+
+    return result
+
+
+def _count_fetched_rows(cursor, tallies: List[SQLTally]) -> None:
+    """
+    SQLiteはSELECTのrowcountが-1のため、取得した行数をfetchのたびに数える
+    行を取得するのはresolverから戻った後(DataLoaderのバッチなど)のこともあるため、実行した時点のtallyに加える
+    """
+    def counting(fetch, many: bool):
+        def fetch_and_count(*args):
+            rows = fetch(*args)
+            count = len(rows) if many else int(rows is not None)
+            for tally in tallies:
+                tally.rows += count
+            return rows
+
+        return fetch_and_count
+
+    for name, many in (("fetchone", False), ("fetchmany", True), ("fetchall", True)):
+        # 同じカーソルで続けて実行した場合に、前回のtallyへ数えないよう包み直す
+        cursor.__dict__.pop(name, None)
+        setattr(cursor, name, counting(getattr(cursor, name), many))
+
+
+@contextmanager
+def instrument_operation(operation: str):
+    """
+    operationの実行時間と、全てのDB接続で実行したSQLの件数・行数を記録する
+    """
+    tally = SQLTally()
+    token = _operation_tally.set(tally)
+    start = time.perf_counter()
+    try:
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(_count_sql))
+
+            yield
+    finally:
+        _operation_tally.reset(token)
+        operation_duration.observe(time.perf_counter() - start, operation)
+        operation_queries.observe(tally.queries, operation)
+        operation_rows.observe(tally.rows, operation)
+
+
+class ResolverMetricsMiddleware:
+    """
+    resolve_xxxを定義したフィールドごとに、実行時間とSQLの件数・行数を"型名.フィールド名"で記録する
+    属性を返すだけの既定のresolverは数が多く記録しても役に立たないため、何もせずに呼び出す
+
+    MiddlewareManager(wrap_in_promise=False)で使う。既定の設定では全てのフィールドの結果がPromiseで包まれ、
+    その分だけ遅くなるため
+    """
+    def __init__(self, enabled: Optional[bool] = None) -> None:
+        self.enabled = getattr(settings, "GRAPHQL_RESOLVER_METRICS", True) if enabled is None else enabled
+        self.__fields: Dict[Tuple[str, str], Optional[str]] = {}
+
+
+    def resolve(self, next, root, info, **args):
+        field = self.__field(info) if self.enabled else None
+        if field is None:
+            return next(root, info, **args)
+
+        tally = SQLTally()
+        token = _resolver_tally.set(tally)
+        start = time.perf_counter()
+        try:
+            result = next(root, info, **args)
+        finally:
+            _resolver_tally.reset(token)
+
+        if isinstance(result, Promise) and result.is_pending:
+            return result.then(partial(self.__observe, field, start, tally))
+
+        return self.__observe(field, start, tally, result)
+
+
+    def __observe(self, field: str, start: float, tally: SQLTally, result):
+        resolver_duration.observe(time.perf_counter() - start, field)
+        resolver_queries.observe(tally.queries, field)
+        resolver_rows.observe(tally.rows, field)
+        return result
+
+
+    def __field(self, info) -> Optional[str]:
+        key = (info.parent_type.name, info.field_name)
+        if key not in self.__fields:
+            # __typenameはparent_type.fieldsに含まれないため、先にイントロスペクションかどうかを確かめる
+            is_introspection = info.parent_type.name.startswith("__") or info.field_name.startswith("__")
+            resolver = None if is_introspection else info.parent_type.fields[info.field_name].resolver
+            is_default = isinstance(resolver, partial) and resolver.func is get_default_resolver()
+            self.__fields[key] = None if is_default or is_introspection else "%s.%s" % key
+
+        return self.__fields[key]
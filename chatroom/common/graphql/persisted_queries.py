@@ -0,0 +1,120 @@
+import json
+from typing import Dict, Final, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+from common.graphql.document_cache import document_hash
+
+
+# Apollo Clientはこのメッセージを受け取ると、クエリ文字列を付けて送り直す
+PERSISTED_QUERY_NOT_FOUND: Final[str] = "PersistedQueryNotFound"
+PERSISTED_QUERY_CACHE_TIMEOUT: Final[Optional[int]] = getattr(settings, "GRAPHQL_PERSISTED_QUERY_CACHE_TIMEOUT", None)
+
+
+class PersistedQueryError(Exception):
+    pass
+
+
+def load_manifest(path: Optional[str]) -> Dict[str, str]:
+    """
+    ビルド時にクライアントが書き出した {sha256: クエリ文字列} のJSONを読み込む
+    ハッシュがクエリ文字列と一致しない場合は、書き出しの誤りとして例外を送出する
+    """
+    if not path:
+        return {}
+
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    for sha256_hash, query in manifest.items():
+        if document_hash(query) != sha256_hash:
+            raise ValueError(f"{path}の{sha256_hash}がクエリ文字列のハッシュと一致しません")
+
+    return manifest
+
+
+class PersistedQueryStore:
+    """
+    ハッシュからクエリ文字列を引く。manifestに無いクエリは、allow_registrationの場合だけ
+    Automatic Persisted Queries(APQ)と同様にクライアントから登録されたものをキャッシュから引く
+
+    allow_registrationがFalseの場合はmanifestに載っているクエリだけを実行できる(ホワイトリスト)
+    """
+    def __init__(self, manifest: Dict[str, str], allow_registration: bool = True) -> None:
+        self.__manifest = manifest
+        self.allow_registration = allow_registration
+
+
+    def resolve(self, query: Optional[str], extensions) -> Optional[str]:
+        """
+        リクエストのqueryとextensionsから、実行するクエリ文字列を返す
+        """
+        sha256_hash = self.__persisted_query_hash(extensions)
+        if sha256_hash is None:
+            if query and not self.allow_registration and document_hash(query) not in self.__manifest:
+                raise PersistedQueryError("登録されていないクエリは実行できません")
+
+            return query
+
+        if not query:
+            query = self.get(sha256_hash)
+            if query is None:
+                raise PersistedQueryError(PERSISTED_QUERY_NOT_FOUND)
+
+            return query
+
+        if document_hash(query) != sha256_hash:
+            raise PersistedQueryError("sha256Hashがクエリ文字列のハッシュと一致しません")
+
+        self.register(sha256_hash, query)
+        return query
+
+
+    def get(self, sha256_hash: str) -> Optional[str]:
+        query = self.__manifest.get(sha256_hash)
+        if query is None and self.allow_registration:
+            query = cache.get(self.__cache_key(sha256_hash))
+
+        return query
+
+
+    def register(self, sha256_hash: str, query: str) -> None:
+        if sha256_hash in self.__manifest:
+            return
+
+        if not self.allow_registration:
+            raise PersistedQueryError("登録されていないクエリは実行できません")
+
+        cache.set(self.__cache_key(sha256_hash), query, PERSISTED_QUERY_CACHE_TIMEOUT)
+
+
+    def __cache_key(self, sha256_hash: str) -> str:
+        return "graphql-persisted-query-%s" % sha256_hash
+
+
+    def __persisted_query_hash(self, extensions) -> Optional[str]:
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise PersistedQueryError("extensionsが不正なJSONです")
+
+        if not isinstance(extensions, dict) or not isinstance(extensions.get("persistedQuery"), dict):
+            return None
+
+        persisted_query = extensions["persistedQuery"]
+        if persisted_query.get("version") != 1:
+            raise PersistedQueryError("persistedQueryのversionは1だけに対応しています")
+
+        sha256_hash = persisted_query.get("sha256Hash")
+        if not isinstance(sha256_hash, str):
+            raise PersistedQueryError("persistedQueryのsha256Hashを指定してください")
+
+        return sha256_hash.lower()
+
+
+persisted_query_store = PersistedQueryStore(
+    manifest=load_manifest(getattr(settings, "GRAPHQL_PERSISTED_QUERY_MANIFEST", None)),
+    allow_registration=not getattr(settings, "GRAPHQL_PERSISTED_QUERIES_ONLY", False),
+)
@@ -0,0 +1,209 @@
+from dataclasses import dataclass, field
+from typing import Dict, Final, List, Optional
+
+from django.conf import settings
+from graphql.error import GraphQLError
+from graphql.language import ast
+from graphql.type.definition import GraphQLInterfaceType, GraphQLObjectType, GraphQLUnionType, get_named_type
+from graphql.type.scalars import GraphQLInt
+from graphql.type.schema import GraphQLSchema
+from graphql.utils.value_from_ast import value_from_ast
+
+
+# connectionでfirst, lastを省略した場合に取得される件数(graphene-djangoのRELAY_CONNECTION_MAX_LIMITの既定値)
+DEFAULT_PAGE_SIZE: Final[int] = getattr(settings, "GRAPHENE", {}).get("RELAY_CONNECTION_MAX_LIMIT", 100)
+PAGINATION_ARGUMENTS: Final = ("first", "last")
+
+
+@dataclass(frozen=True)
+class QueryCostLimit:
+    """
+    field_costsには"型名.フィールド名"ごとの重みを指定する。指定が無いフィールドは
+    オブジェクトを返す場合は1、スカラーを返す場合は0とする
+    """
+    max_depth: int = 10
+    max_cost: int = 5000
+    max_first: int = 100
+    field_costs: Dict[str, int] = field(default_factory=dict)
+
+
+    @classmethod
+    def from_settings(cls) -> "QueryCostLimit":
+        config = getattr(settings, "GRAPHQL_QUERY_COST", {})
+        return cls(
+            max_depth=config.get("MAX_DEPTH", cls.max_depth),
+            max_cost=config.get("MAX_COST", cls.max_cost),
+            max_first=config.get("MAX_FIRST", cls.max_first),
+            field_costs=config.get("FIELD_COSTS", {}),
+        )
+
+
+class QueryCostError(Exception):
+    pass
+
+
+class QueryCostAnalyzer:
+    """
+    実行前にoperationを走査して、深さ・コスト・first/lastの件数が上限を超えていないか確認する
+
+    コストは各フィールドの重みの合計で、connectionの子フィールドはfirst(last)の件数倍する
+    @skipや@includeは考慮せず、最も重い場合で見積もる。イントロスペクションは数えない
+
+    検証より前に実行するため、循環するフラグメントや型の合わない変数もここでエラーにする
+    """
+    def __init__(self, schema: GraphQLSchema, limit: QueryCostLimit) -> None:
+        self.schema = schema
+        self.limit = limit
+
+
+    def check(self, document_ast: ast.Document, variables: Optional[dict], operation_name: Optional[str]) -> List[GraphQLError]:
+        operation = self.__find_operation(document_ast, operation_name)
+        if operation is None:
+            # operationを特定できないエラーは実行時に返す
+            return []
+
+        root_type = {
+            "query": self.schema.get_query_type(),
+            "mutation": self.schema.get_mutation_type(),
+            "subscription": self.schema.get_subscription_type(),
+        }.get(operation.operation)
+        if root_type is None:
+            return []
+
+        fragments = {
+            definition.name.value: definition
+            for definition in document_ast.definitions
+            if isinstance(definition, ast.FragmentDefinition)
+        }
+        variables = {**self.__default_variables(operation), **(variables or {})}
+        # 同じフラグメントを何度も展開しても走査が指数的に増えないよう、展開先の型と深さごとにコストを覚えておく
+        self.__fragment_costs = {}
+        try:
+            cost = self.__selection_set_cost(root_type, operation.selection_set, fragments, variables, 1, frozenset())
+        except QueryCostError as e:
+            return [GraphQLError(str(e), [operation])]
+
+        if cost > self.limit.max_cost:
+            return [GraphQLError(f"クエリのコスト({cost})が上限({self.limit.max_cost})を超えています", [operation])]
+
+        return []
+
+
+    def __find_operation(self, document_ast: ast.Document, operation_name: Optional[str]) -> Optional[ast.OperationDefinition]:
+        operations = [definition for definition in document_ast.definitions if isinstance(definition, ast.OperationDefinition)]
+        if operation_name:
+            return next((operation for operation in operations if operation.name and operation.name.value == operation_name), None)
+
+        return operations[0] if len(operations) == 1 else None
+
+
+    def __default_variables(self, operation: ast.OperationDefinition) -> dict:
+        return {
+            definition.variable.name.value: value_from_ast(definition.default_value, GraphQLInt)
+            for definition in operation.variable_definitions or []
+            if definition.default_value is not None
+        }
+
+
+    def __selection_set_cost(
+        self,
+        parent_type,
+        selection_set: ast.SelectionSet,
+        fragments: dict,
+        variables: dict,
+        depth: int,
+        expanding: frozenset
+        ) -> int:
+        """
+        expandingは展開中のフラグメントの名前。自身を含むフラグメントは検証でエラーになるが、その前に無限に展開しないため
+        """
+        if depth > self.limit.max_depth:
+            raise QueryCostError(f"クエリの深さが上限({self.limit.max_depth})を超えています")
+
+        cost = 0
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.Field):
+                cost += self.__field_cost(parent_type, selection, fragments, variables, depth, expanding)
+            elif isinstance(selection, ast.FragmentSpread):
+                cost += self.__fragment_spread_cost(parent_type, selection.name.value, fragments, variables, depth, expanding)
+            else:
+                # フラグメントは展開先と同じ深さとして数える
+                fragment_type = self.__fragment_type(parent_type, selection)
+                cost += self.__selection_set_cost(fragment_type, selection.selection_set, fragments, variables, depth, expanding)
+
+        return cost
+
+
+    def __fragment_spread_cost(self, parent_type, name: str, fragments: dict, variables: dict, depth: int, expanding: frozenset) -> int:
+        fragment = fragments.get(name)
+        if fragment is None:
+            return 0
+
+        if name in expanding:
+            raise QueryCostError(f"フラグメント「{name}」が自身を含んでいます")
+
+        fragment_type = self.__fragment_type(parent_type, fragment)
+        key = (name, fragment_type.name, depth)
+        if key not in self.__fragment_costs:
+            self.__fragment_costs[key] = self.__selection_set_cost(
+                fragment_type, fragment.selection_set, fragments, variables, depth, expanding | {name}
+            )
+
+        return self.__fragment_costs[key]
+
+
+    def __fragment_type(self, parent_type, fragment):
+        if fragment.type_condition is None:
+            return parent_type
+
+        return self.schema.get_type(fragment.type_condition.name.value) or parent_type
+
+
+    def __field_cost(self, parent_type, node: ast.Field, fragments: dict, variables: dict, depth: int, expanding: frozenset) -> int:
+        name = node.name.value
+        if name.startswith("__"):
+            return 0
+
+        fields = parent_type.fields if isinstance(parent_type, (GraphQLObjectType, GraphQLInterfaceType)) else {}
+        field_def = fields.get(name)
+        if field_def is None:
+            # 存在しないフィールドは検証でエラーになる
+            return 0
+
+        field_type = get_named_type(field_def.type)
+        is_composite = isinstance(field_type, (GraphQLObjectType, GraphQLInterfaceType, GraphQLUnionType))
+        cost = self.limit.field_costs.get(f"{parent_type.name}.{name}", 1 if is_composite else 0)
+        if node.selection_set is None:
+            return cost
+
+        children = self.__selection_set_cost(field_type, node.selection_set, fragments, variables, depth + 1, expanding)
+        # 兄弟のフィールドのコストを打ち消さないよう、負にはしない
+        return max(cost + self.__page_size(node, field_def, variables) * children, 0)
+
+
+    def __page_size(self, node: ast.Field, field_def, variables: dict) -> int:
+        if not any(argument in field_def.args for argument in PAGINATION_ARGUMENTS):
+            return 1
+
+        page_size = None
+        for argument in node.arguments or []:
+            if argument.name.value not in PAGINATION_ARGUMENTS:
+                continue
+
+            value = value_from_ast(argument.value, GraphQLInt, variables)
+            if value is None:
+                continue
+
+            # 変数の値は型が変換されずにそのまま返るため、整数以外はここで弾く
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise QueryCostError(f"{argument.name.value}は整数で指定してください")
+
+            if value < 0:
+                raise QueryCostError(f"{argument.name.value}は0以上で指定してください")
+
+            if value > self.limit.max_first:
+                raise QueryCostError(f"{argument.name.value}は{self.limit.max_first}以下で指定してください")
+
+            page_size = value if page_size is None else min(page_size, value)
+
+        return DEFAULT_PAGE_SIZE if page_size is None else page_size
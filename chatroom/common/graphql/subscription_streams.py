@@ -0,0 +1,47 @@
+from typing import Dict, List
+
+from rx.subjects import Subject
+
+
+class SubscriptionStreams:
+    """
+    1つのsubscription(operation)が購読しているchannel layerのgroupと、groupごとのイベントの流れ
+
+    subscriptionのresolverはlistenで得たSubjectを返し、consumerはgroupに届いたイベントをpublishで流す
+    """
+    def __init__(self) -> None:
+        self.__subjects: Dict[str, List[Subject]] = {}
+
+
+    def listen(self, group: str) -> Subject:
+        subject = Subject()
+        self.__subjects.setdefault(group, []).append(subject)
+        return subject
+
+
+    def publish(self, group: str, event) -> None:
+        for subject in self.__subjects.get(group, []):
+            subject.on_next(event)
+
+
+    def groups(self) -> List[str]:
+        return list(self.__subjects)
+
+
+    def complete(self) -> None:
+        for subjects in self.__subjects.values():
+            for subject in subjects:
+                subject.on_completed()
+
+        self.__subjects.clear()
+
+
+def subscription_streams(context) -> SubscriptionStreams:
+    """
+    subscriptionのresolverからcontextに設定されたSubscriptionStreamsを取り出す
+    """
+    streams = getattr(context, "subscription_streams", None)
+    if streams is None:
+        raise Exception("subscriptionはWebSocketで接続して購読してください")
+
+    return streams
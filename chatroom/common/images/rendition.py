@@ -0,0 +1,80 @@
+import io
+import posixpath
+from typing import Final, Optional, Tuple
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+from PIL import Image
+
+
+RENDITION_SIZES: Final[Tuple[int, ...]] = (64, 256, 1024)
+DEFAULT_RENDITION_SIZE: Final[int] = 256
+RENDITION_DIR: Final[str] = "renditions"
+RENDITION_FORMAT: Final[str] = "WEBP"
+RENDITION_CONTENT_TYPE: Final[str] = "image/webp"
+# これより画素数の多い画像は受け付けない。縮小してもデコードにかかる時間とメモリは元の画素数に比例するため
+RENDITION_MAX_PIXELS: Final[int] = 40_000_000
+
+
+def bucket_size(size: Optional[int]) -> int:
+    """
+    要求されたサイズ以上で最小のレンディションのサイズを返す
+    """
+    if size is None:
+        return DEFAULT_RENDITION_SIZE
+
+    for bucket in RENDITION_SIZES:
+        if size <= bucket:
+            return bucket
+
+    return RENDITION_SIZES[-1]
+
+
+def rendition_name(source_name: str, size: int) -> str:
+    return posixpath.join(RENDITION_DIR, source_name, f"{size}.{RENDITION_FORMAT.lower()}")
+
+
+def create_rendition(storage: Storage, source_name: str, size: int) -> str:
+    """
+    長辺がsize pxに収まるよう縮小した画像を保存する
+    JPEGはdraftで縮小した状態からデコードし、それ以外もreduceで整数分の1にしてから補間するため、
+    元の画素数のまま補間することはない
+    """
+    with storage.open(source_name, "rb") as source:
+        image = Image.open(source)
+        if image.width * image.height > RENDITION_MAX_PIXELS:
+            raise Exception("画像の画素数が上限を超えています")
+
+        image.draft("RGB", (size, size))
+        image.thumbnail((size, size), reducing_gap=2.0)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+
+        content = io.BytesIO()
+        image.save(content, RENDITION_FORMAT, quality=80)
+
+    # 同じ画像を同時に要求された場合は、先に保存された方を使う。画像は内容から名前が決まるため中身は同じになる
+    name = rendition_name(source_name, size)
+    if storage.exists(name):
+        return name
+
+    return storage.save(name, ContentFile(content.getvalue()))
+
+
+def ensure_rendition(storage: Storage, source_name: str, size: int) -> str:
+    """
+    レンディションが無い場合は作成してから名前を返す
+    アップロード時には作成せず、最初に要求されたサイズだけをここで作成する
+    """
+    name = rendition_name(source_name, size)
+    if storage.exists(name):
+        return name
+
+    return create_rendition(storage, source_name, size)
+
+
+def delete_renditions(storage: Storage, source_name: str) -> None:
+    for size in RENDITION_SIZES:
+        name = rendition_name(source_name, size)
+        if storage.exists(name):
+            storage.delete(name)
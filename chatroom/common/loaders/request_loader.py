@@ -0,0 +1,22 @@
+from typing import Type, TypeVar
+
+from promise.dataloader import DataLoader
+
+
+Loader = TypeVar("Loader", bound=DataLoader)
+
+
+def get_loader(context, loader_class: Type[Loader]) -> Loader:
+    """
+    GraphQLのcontext(リクエスト)ごとにDataLoaderを1つだけ生成して返す
+    同じリクエスト内のloadはまとめて1回のbatch_load_fnで解決され、結果もリクエストの間キャッシュされる
+    """
+    loaders = getattr(context, "_dataloaders", None)
+    if loaders is None:
+        loaders = {}
+        context._dataloaders = loaders
+
+    if loader_class not in loaders:
+        loaders[loader_class] = loader_class()
+
+    return loaders[loader_class]
@@ -0,0 +1,130 @@
+import bisect
+import math
+import threading
+from typing import Callable, Dict, Final, List, Sequence, Tuple
+
+
+CONTENT_TYPE: Final[str] = "text/plain; version=0.0.4; charset=utf-8"
+
+# 秒
+DURATION_BUCKETS: Final[Tuple[float, ...]] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# SQLの件数や行数
+COUNT_BUCKETS: Final[Tuple[float, ...]] = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000, 10000)
+
+# ラベルの組み合わせがmax_seriesを超えた場合は、以降の組み合わせをこの値にまとめる
+OTHER_LABEL: Final[str] = "__other__"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    Prometheusのテキスト形式で出力するヒストグラム
+
+    observeはロックを1回取ってバケットを1つ加算するだけにし、累積は出力する時に計算する
+    ラベルの値にクライアントが送ったoperation名などを使うため、組み合わせはmax_seriesまでに制限する
+    """
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DURATION_BUCKETS, max_series: int = 1000) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.max_series = max_series
+        # ラベルの値ごとに [各バケットの件数(+Infを含む), 合計]
+        self.__series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self.__lock = threading.Lock()
+
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            series = self.__series.get(labelvalues)
+            if series is None:
+                if len(self.__series) >= self.max_series:
+                    labelvalues = (OTHER_LABEL, ) * len(self.labelnames)
+
+                series = self.__series.setdefault(labelvalues, ([0] * (len(self.buckets) + 1), [0.0]))
+
+            series[0][index] += 1
+            series[1][0] += value
+
+
+    def collect(self) -> List[str]:
+        with self.__lock:
+            snapshot = [(labelvalues, list(counts), total[0]) for labelvalues, (counts, total) in self.__series.items()]
+
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labelvalues, counts, total in sorted(snapshot):
+            labels = list(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf, ), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', _format_value(float(bound)))])} {cumulative}")
+
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+
+        return lines
+
+
+class CallbackMetric:
+    """
+    出力する時にcallbackを呼び出して値を取得するgaugeやcounter
+    OutboundQueueMetricsのように、既に別の場所で数えている値を公開するために使う
+    """
+    def __init__(self, name: str, documentation: str, metric_type: str, callback: Callable[[], float]) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.metric_type = metric_type
+        self.__callback = callback
+
+
+    def collect(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+            f"{self.name} {_format_value(self.__callback())}",
+        ]
+
+
+class Registry:
+    """
+    プロセス内のメトリクス。ワーカーごとに別々に数えるため、Prometheusからはワーカーごとにscrapeする
+    """
+    def __init__(self) -> None:
+        self.__metrics: Dict[str, object] = {}
+        self.__lock = threading.Lock()
+
+
+    def register(self, metric):
+        """
+        同じ名前のメトリクスが登録済みの場合は、登録済みの方を返す
+        """
+        with self.__lock:
+            return self.__metrics.setdefault(metric.name, metric)
+
+
+    def render(self) -> str:
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+
+        return "\n".join(line for metric in metrics for line in metric.collect()) + "\n"
+
+
+registry = Registry()
@@ -0,0 +1,167 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Final, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from common.cache import versioned_value
+
+
+PERIODS: Final[Dict[str, int]] = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, retry_after: float) -> None:
+        self.retry_after = retry_after
+        super().__init__(f"リクエストが多すぎます。{math.ceil(retry_after)}秒後にもう一度お試しください")
+
+
+@dataclass(frozen=True)
+class Rate:
+    """
+    1秒あたりに補充するトークン数(持続できる頻度)と、バケットの容量(連続して許可する回数)
+    """
+    per_second: float
+    burst: int
+
+
+    @classmethod
+    def parse(cls, config: dict) -> "Rate":
+        """
+        {"RATE": "30/m", "BURST": 10} の形式。RATEは"回数/s|m|h|d"か1秒あたりの回数
+        """
+        rate = config["RATE"]
+        if isinstance(rate, str):
+            count, period = rate.split("/")
+            rate = float(count) / PERIODS[period]
+
+        return cls(per_second=float(rate), burst=int(config.get("BURST", max(1, math.ceil(rate)))))
+
+
+    def refill(self, tokens: float, elapsed: float) -> float:
+        return min(float(self.burst), tokens + max(elapsed, 0) * self.per_second)
+
+
+    def retry_after(self, tokens: float) -> float:
+        return (1 - tokens) / self.per_second
+
+
+class LocalBucketStore:
+    """
+    プロセス内にバケットを保持する。ワーカーごとに別々に数えるため、全体ではワーカー数倍まで許可される
+    バケットは最後に消費した順に並べ、max_keysを超えたら最も長く使われていないものから捨てる
+    捨てたバケットは次の消費で満タンから数え直す
+    """
+    def __init__(self, max_keys: int = 10000) -> None:
+        self.max_keys = max_keys
+        self.__buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self.__lock = threading.Lock()
+
+
+    def consume(self, key: str, rate: Rate) -> float:
+        """
+        トークンを1つ消費できた場合は0を、できなかった場合は次に消費できるまでの秒数を返す
+        """
+        now = time.monotonic()
+        with self.__lock:
+            tokens, updated_at = self.__buckets.pop(key, (float(rate.burst), now))
+            tokens = rate.refill(tokens, now - updated_at)
+            allowed = tokens >= 1
+            self.__buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if len(self.__buckets) > self.max_keys:
+                self.__buckets.popitem(last=False)
+
+        return 0 if allowed else rate.retry_after(tokens)
+
+
+    async def aconsume(self, key: str, rate: Rate) -> float:
+        """
+        メモリの中だけで済むため、イベントループで直接実行する
+        """
+        return self.consume(key, rate)
+
+
+    def __len__(self) -> int:
+        return len(self.__buckets)
+
+
+class CacheBucketStore:
+    """
+    Djangoのキャッシュ(RedisやMemcachedを設定した場合はワーカー間で共有)にバケットを保持する
+    バケットはversioned_valueで更新し、同時のリクエストが同じトークンを消費しないようにする
+    """
+    def __init__(self, prefix: str = "ratelimit") -> None:
+        self.prefix = prefix
+
+
+    def consume(self, key: str, rate: Rate) -> float:
+        now = time.time()
+        refilled = 0.0
+
+        def take(bucket: Optional[Tuple[float, float]]) -> Tuple[float, float]:
+            nonlocal refilled
+            tokens, updated_at = bucket or (float(rate.burst), now)
+            refilled = rate.refill(tokens, now - updated_at)
+            return (refilled - 1 if refilled >= 1 else refilled, now)
+
+        # 満タンに戻るまでの間だけ保持する
+        versioned_value.update("%s-%s" % (self.prefix, key), take, math.ceil(rate.burst / rate.per_second) + 1)
+        return 0 if refilled >= 1 else rate.retry_after(refilled)
+
+
+    async def aconsume(self, key: str, rate: Rate) -> float:
+        """
+        キャッシュへの問い合わせでイベントループを止めないよう、スレッドで実行する
+        DBの接続を使わないため、database_sync_to_asyncと共有するスレッドは使わない
+        """
+        return await sync_to_async(self.consume, thread_sensitive=False)(key, rate)
+
+
+class RateLimiter:
+    """
+    scope(操作の種類)ごとにRateを設定し、scopeとkey(ユーザーやIPアドレス、ルーム)の組ごとにトークンバケットで制限する
+    Rateを設定していないscopeは制限しない
+    """
+    def __init__(self, rates: Dict[str, Rate], store) -> None:
+        self.rates = rates
+        self.store = store
+
+
+    def check(self, scope: str, key: str) -> None:
+        rate = self.rates.get(scope)
+        if rate is None:
+            return
+
+        retry_after = self.store.consume(f"{scope}:{key}", rate)
+        if retry_after > 0:
+            raise RateLimitExceeded(retry_after)
+
+
+    async def acheck(self, scope: str, key: str) -> None:
+        """
+        consumerなどのイベントループから呼び出す場合に使う
+        """
+        rate = self.rates.get(scope)
+        if rate is None:
+            return
+
+        retry_after = await self.store.aconsume(f"{scope}:{key}", rate)
+        if retry_after > 0:
+            raise RateLimitExceeded(retry_after)
+
+
+def __create_store(backend: Optional[str]):
+    if backend == "cache":
+        return CacheBucketStore()
+
+    return LocalBucketStore()
+
+
+rate_limiter = RateLimiter(
+    rates={scope: Rate.parse(config) for scope, config in getattr(settings, "RATE_LIMITS", {}).items()},
+    store=__create_store(getattr(settings, "RATE_LIMIT_BACKEND", "local")),
+)
@@ -0,0 +1,176 @@
+import json
+import math
+import threading
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    最近傍順位法でp(0〜100)パーセンタイルを返す
+    """
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+@dataclass
+class OperationSamples:
+    latencies: List[float] = field(default_factory=list)
+    queries: int = 0
+    errors: int = 0
+
+
+@dataclass(frozen=True)
+class OperationStats:
+    """
+    latencyはミリ秒。ops_per_secは計測期間全体に対する成功した操作の件数
+    """
+    count: int
+    errors: int
+    p50: float
+    p95: float
+    p99: float
+    ops_per_sec: float
+    queries_per_op: float
+
+
+class QueryTally:
+    """
+    スレッドごとに実行されたSQLの件数を数える
+    installした後に作られた接続にも、connection_createdで数えるためのexecute_wrapperを追加する
+
+    connection.execute_wrapper()は終了時に末尾のwrapperを取り除くため、その途中で接続が作られても
+    取り除かれないよう先頭に追加する
+    """
+    def __init__(self) -> None:
+        self.__counts: Dict[int, int] = {}
+        self.__lock = threading.Lock()
+
+
+    def __call__(self, execute, sql, params, many, context):
+        ident = threading.get_ident()
+        with self.__lock:
+            self.__counts[ident] = self.__counts.get(ident, 0) + 1
+
+        return execute(sql, params, many, context)
+
+
+    def count(self, ident: Optional[int] = None) -> int:
+        return self.__counts.get(threading.get_ident() if ident is None else ident, 0)
+
+
+    def total(self, exclude: List[int] = ()) -> int:
+        with self.__lock:
+            return sum(count for ident, count in self.__counts.items() if ident not in exclude)
+
+
+    def install(self) -> None:
+        connection_created.connect(self.__on_connection_created)
+        for connection in connections.all():
+            self.__on_connection_created(None, connection)
+
+
+    def uninstall(self) -> None:
+        connection_created.disconnect(self.__on_connection_created)
+        for connection in connections.all():
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+    def __on_connection_created(self, sender, connection, **kwargs) -> None:
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.insert(0, self)
+
+
+class LoadRecorder:
+    """
+    複数のスレッド・タスクから操作ごとの所要時間とSQLの件数を記録する
+    """
+    def __init__(self) -> None:
+        self.__samples: Dict[str, OperationSamples] = {}
+        self.__lock = threading.Lock()
+
+
+    def record(self, operation: str, seconds: float, queries: int = 0, error: bool = False) -> None:
+        with self.__lock:
+            samples = self.__samples.setdefault(operation, OperationSamples())
+            if error:
+                samples.errors += 1
+                return
+
+            samples.latencies.append(seconds * 1000)
+            samples.queries += queries
+
+
+    def add_queries(self, operation: str, queries: int) -> None:
+        """
+        操作ごとに数えられない場合(WebSocketなど)に、まとめて数えたSQLの件数を加える
+        """
+        with self.__lock:
+            self.__samples.setdefault(operation, OperationSamples()).queries += queries
+
+
+    def summarize(self, elapsed: float) -> Dict[str, OperationStats]:
+        with self.__lock:
+            samples = dict(self.__samples)
+
+        return {
+            operation: OperationStats(
+                count=len(s.latencies),
+                errors=s.errors,
+                p50=percentile(s.latencies, 50),
+                p95=percentile(s.latencies, 95),
+                p99=percentile(s.latencies, 99),
+                ops_per_sec=len(s.latencies) / elapsed if elapsed > 0 else 0.0,
+                queries_per_op=s.queries / len(s.latencies) if s.latencies else 0.0,
+            )
+            for operation, s in sorted(samples.items())
+        }
+
+
+def save_baseline(path: str, stats: Dict[str, OperationStats]) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({operation: asdict(s) for operation, s in stats.items()}, f, indent=2, sort_keys=True)
+
+
+def load_baseline(path: str) -> Dict[str, OperationStats]:
+    with open(path, encoding="utf-8") as f:
+        return {operation: OperationStats(**s) for operation, s in json.load(f).items()}
+
+
+def find_regressions(
+    stats: Dict[str, OperationStats],
+    baseline: Dict[str, OperationStats],
+    latency_tolerance: float = 0.5,
+    min_latency_ms: float = 1.0
+    ) -> List[str]:
+    """
+    ベースラインと比べて悪化した操作を説明する文字列のリストを返す
+    SQLの件数は環境に依らないため増えたら回帰とし、p95は揺らぎを見込んでlatency_toleranceの割合まで許容する
+    min_latency_ms未満の差は計測誤差として扱う
+    エラーになった操作の件数はまとめて数えたSQLの件数(add_queries)に混ざるため、エラーがあった場合はSQLの件数を比較しない
+    """
+    regressions = []
+    for operation, base in baseline.items():
+        current: Optional[OperationStats] = stats.get(operation)
+        if current is None:
+            continue
+
+        if current.errors > base.errors:
+            regressions.append(f"{operation}: エラーが{base.errors}件から{current.errors}件に増えました")
+
+        if current.errors == 0 and base.errors == 0 and current.queries_per_op > base.queries_per_op + 1e-9:
+            regressions.append(f"{operation}: SQLの件数が{base.queries_per_op:.1f}件から{current.queries_per_op:.1f}件に増えました")
+
+        limit = base.p95 * (1 + latency_tolerance)
+        if current.p95 > limit and current.p95 - base.p95 >= min_latency_ms:
+            regressions.append(f"{operation}: p95が{base.p95:.1f}msから{current.p95:.1f}msに悪化しました")
+
+    return regressions
@@ -0,0 +1,142 @@
+import json
+import re
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from django.conf import settings
+from django.db import connections
+from django.test import Client
+
+from common.ratelimit.token_bucket import rate_limiter
+
+
+def _normalize(sql: str) -> str:
+    """
+    IN句のプレースホルダの数やLIMITの値など、行数によって変わるだけの違いを無視して比較するため
+    """
+    return re.sub(r"\b\d+\b", "N", re.sub(r"\((?:%s, )+%s\)", "(%s, ...)", sql))
+
+
+@dataclass(frozen=True)
+class Measurement:
+    size: int
+    seconds: float
+    # プレースホルダのままのSQL。行数に応じて増えたSQLを示すために使う
+    statements: List[str]
+
+    @property
+    def queries(self) -> int:
+        return len(self.statements)
+
+
+@contextmanager
+def capture_queries() -> Iterator[List[str]]:
+    """
+    ブロックの中で全てのDB接続が実行したSQLを、実行した順に返すリストへ追加する
+    """
+    statements: List[str] = []
+
+    def capture(execute, sql, params, many, context):
+        statements.append(sql)
+        return execute(sql, params, many, context)
+
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(capture))
+
+        yield statements
+
+
+def measure(size: int, run: Callable[[], Any]) -> Measurement:
+    with capture_queries() as statements:
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+
+    return Measurement(size=size, seconds=seconds, statements=list(statements))
+
+
+class QueryCountAssertions(ABC):
+    """
+    データの行数を増やしながら同じ操作を実行し、SQLの件数が変わらないこと(N+1が無いこと)と
+    実行時間がtime_budget秒以内であることを確かめるTestCaseのmixin
+
+    grow_fixturesでfixture_sizesの各行数までデータを増やす。行数は操作の結果に全て含まれる程度にする
+    time_budgetの既定は設定のQUERY_COUNT_TIME_BUDGET
+    """
+    fixture_sizes = (2, 8, 32)
+
+    @property
+    def time_budget(self) -> float:
+        return getattr(settings, "QUERY_COUNT_TIME_BUDGET", 2.0)
+
+
+    @abstractmethod
+    def grow_fixtures(self, size: int) -> None:
+        pass
+
+
+    def assertQueriesIndependentOfSize(self, operations: Dict[str, Callable[[], Callable[[], Any]]]) -> None:
+        """
+        operationsは 操作名 -> 準備(計測しない)をして、計測する関数を返す関数
+        mutationは実行ごとに対象が必要なため、準備で作成してから計測する関数を返す
+        """
+        # ContentTypeのキャッシュなど、プロセスで初回だけ発生するSQLを計測に含めないよう一度実行しておく
+        self.grow_fixtures(self.fixture_sizes[0])
+        for prepare in operations.values():
+            prepare()()
+
+        measurements: Dict[str, List[Measurement]] = {name: [] for name in operations}
+        for size in self.fixture_sizes:
+            self.grow_fixtures(size)
+            for name, prepare in operations.items():
+                measurements[name].append(measure(size, prepare()))
+
+        failures = [failure for name, results in measurements.items() for failure in self.__check(name, results)]
+        if failures:
+            self.fail("\n".join(failures))
+
+
+    def __check(self, name: str, results: List[Measurement]) -> List[str]:
+        failures = []
+        if len({result.queries for result in results}) > 1:
+            counts = ", ".join(f"{result.size}行: {result.queries}件" for result in results)
+            added = Counter(map(_normalize, results[-1].statements)) - Counter(map(_normalize, results[0].statements))
+            failures.append(f"{name}: 行数によってSQLの件数が変わります({counts})")
+            failures.extend(f"    +{count} {sql}" for sql, count in added.most_common(3))
+
+        slowest = max(results, key=lambda result: result.seconds)
+        if slowest.seconds > self.time_budget:
+            failures.append(f"{name}: {slowest.size}行で{slowest.seconds:.3f}秒かかりました(上限{self.time_budget}秒)")
+
+        return failures
+
+
+class GraphQLClient:
+    """
+    /graphqlへリクエストし、エラーが無いことを確かめてdataを返す
+    計測中にレート制限で失敗しないよう、RATE_LIMITSは使用中だけ無効にする
+    """
+    def __init__(self, test_case, user=None) -> None:
+        self.__test_case = test_case
+        self.__client = Client(HTTP_HOST="django")
+        if user is not None:
+            self.force_login(user)
+
+        rates, rate_limiter.rates = rate_limiter.rates, {}
+        test_case.addCleanup(setattr, rate_limiter, "rates", rates)
+
+
+    def force_login(self, user) -> None:
+        self.__client.force_login(user)
+
+
+    def execute(self, query: str, variables: Optional[dict] = None) -> dict:
+        response = self.__client.post("/graphql", json.dumps({"query": query, "variables": variables}), content_type="application/json")
+        content = json.loads(response.content)
+        self.__test_case.assertNotIn("errors", content, content.get("errors"))
+        return content["data"]
@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.files.uploadhandler import StopUpload, TemporaryFileUploadHandler
+
+
+def is_upload_too_large(request) -> bool:
+    """
+    LimitedTemporaryFileUploadHandlerがFILE_UPLOAD_MAX_SIZEを超えたファイルの受信を打ち切ったかどうか
+    request.POSTかrequest.FILESを参照して、本文を読み込んだ後に呼び出す
+    """
+    return getattr(request, "_upload_too_large", False)
+
+
+class LimitedTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    """
+    アップロードされたファイルをチャンクごとに一時ファイルへ書き出しながらサイズを数える
+    FILE_UPLOAD_MAX_SIZEを超えた時点で接続を切って受信を打ち切り、呼び出し側はis_upload_too_largeで判定する
+    メモリ上に保持するのは常に1チャンク分だけになる
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limit = settings.FILE_UPLOAD_MAX_SIZE
+        self.received = 0
+
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.received = 0
+
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > self.limit:
+            # 残りの本文を読み捨てると、上限を超えた分も全て受信することになるため接続を切る
+            self.request._upload_too_large = True
+            raise StopUpload(connection_reset=True)
+
+        return super().receive_data_chunk(raw_data, start)
@@ -1,5 +1,7 @@
 from dataclasses import dataclass
 
+from django.core.exceptions import ValidationError
+from django.core.files.images import get_image_dimensions
 from django.core.validators import BaseValidator
 from django.db import models
 from django.utils.deconstruct import deconstructible
@@ -7,7 +9,7 @@ from django.utils.deconstruct import deconstructible
 
 @deconstructible
 class MaxFileSizeValidator(BaseValidator):
-    message = f"ファイルサイズが上限を超えています"
+    message = "ファイルサイズが上限を超えています"
     code = "max_file_size"
 
     def compare(self, a:int, b:int) -> bool:
@@ -17,6 +19,23 @@ class MaxFileSizeValidator(BaseValidator):
         return x.size
 
 
+@deconstructible
+class MaxPixelsValidator(BaseValidator):
+    message = "画像の画素数が上限を超えています"
+    code = "max_pixels"
+
+    def compare(self, a: int, b: int) -> bool:
+        return a > b
+
+    def clean(self, x: models.fields.files.ImageFieldFile) -> int:
+        """
+        画素データはデコードせず、ヘッダーだけを読んで画素数を求める
+        画像として読み込めない場合はImageAspectRatioValidatorがエラーにする
+        """
+        width, height = get_image_dimensions(x, close=False)
+        return (width or 0) * (height or 0)
+
+
 @deconstructible
 @dataclass
 class WidthHeight:
@@ -26,7 +45,7 @@ class WidthHeight:
 
 @deconstructible
 class ImageAspectRatioValidator(BaseValidator):
-    message = f"画像の縦横比が異なります"
+    message = "画像の縦横比が異なります"
     code = "aspect_ratio"
 
     def compare(self, a: WidthHeight, b: WidthHeight) -> bool:
@@ -36,4 +55,11 @@ class ImageAspectRatioValidator(BaseValidator):
         return a.width * b.height - a.height * b.width > 10
 
     def clean(self, x: models.fields.files.ImageFieldFile) -> WidthHeight:
-        return WidthHeight(width=x.width, height=x.height)
\ No newline at end of file
+        """
+        画素データはデコードせず、ヘッダーだけを読んで縦横のサイズを取得する
+        """
+        width, height = get_image_dimensions(x, close=False)
+        if width is None or height is None:
+            raise ValidationError("画像ファイルとして読み込めません", code="invalid_image")
+
+        return WidthHeight(width=width, height=height)
\ No newline at end of file
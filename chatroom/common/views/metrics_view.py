@@ -0,0 +1,54 @@
+import hmac
+import ipaddress
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.http import require_GET
+
+from common.consumers.outbound_queue import outbound_queue_metrics
+from common.metrics.prometheus import CONTENT_TYPE, CallbackMetric, registry
+
+
+for key, metric_type, documentation in (
+    ("queues", "gauge", "WebSocketの送信キューの数"),
+    ("depth", "gauge", "WebSocketの送信キューに溜まっているフレームの合計"),
+    ("max_depth", "gauge", "WebSocketの送信キューに溜まっているフレームの最大"),
+    ("dropped", "counter", "送信キューが溢れて捨てたフレームの数"),
+    ("coalesced", "counter", "送信キューが溢れてまとめたことで減ったフレームの数"),
+    ("disconnected", "counter", "送信キューが溢れて切断した接続の数"),
+):
+    registry.register(CallbackMetric(
+        f"chat_outbound_queue_{key}" + ("_total" if metric_type == "counter" else ""),
+        documentation,
+        metric_type,
+        lambda key=key: outbound_queue_metrics.snapshot()[key]
+    ))
+
+
+def _is_allowed_address(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+
+    return any(ip in ipaddress.ip_network(network) for network in getattr(settings, "METRICS_ALLOWED_IPS", ["127.0.0.1", "::1"]))
+
+
+@require_GET
+def metrics(request) -> HttpResponse:
+    """
+    Prometheusのテキスト形式でプロセス内のメトリクスを返す
+    METRICS_TOKENを設定した場合は Authorization: Bearer <METRICS_TOKEN> が必要
+    設定していない場合は、接続元がMETRICS_ALLOWED_IPS(既定はループバックのみ)に含まれる場合だけ返す
+    X-Forwarded-Forは偽装できるため、接続元にはREMOTE_ADDRを使う
+    """
+    token = getattr(settings, "METRICS_TOKEN", None)
+    if token:
+        allowed = hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}")
+    else:
+        allowed = _is_allowed_address(request.META.get("REMOTE_ADDR", ""))
+
+    if not allowed:
+        return HttpResponseForbidden()
+
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,142 @@
+import time
+from typing import Final, Optional
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest
+from graphene_django.views import HttpError
+from graphene_file_upload.django import FileUploadGraphQLView
+from graphql.execution import ExecutionResult
+from graphql.language.ast import OperationDefinition
+
+from common.db.routers import use_replica
+from common.graphql.instrumentation import instrument_operation
+from common.graphql.query_cost import QueryCostAnalyzer, QueryCostLimit
+from common.graphql.persisted_queries import PERSISTED_QUERY_NOT_FOUND, PersistedQueryError, persisted_query_store
+from common.uploads.limited_upload_handler import is_upload_too_large
+from common.validators.image import MaxFileSizeValidator
+
+
+PRIMARY_STICKY_COOKIE: Final[str] = "db_primary_until"
+
+
+class ReplicaRoutingGraphQLView(FileUploadGraphQLView):
+    """
+    queryの読み込みはレプリカへ、mutationはdefault(プライマリ)へ振り分ける
+
+    mutationの後DATABASE_READ_AFTER_WRITE_SECONDS秒の間は、同じクライアントのqueryもプライマリから読み込む
+    レプリケーションの遅延で、直前に書き込んだ内容が読めなくなるのを防ぐため
+
+    実行前にクエリの深さとコストを見積もり、GRAPHQL_QUERY_COSTの上限を超える場合は実行しない
+
+    クエリ文字列の代わりにextensions.persistedQuery.sha256Hashでpersisted queryを指定することもできる
+
+    operation名ごとの実行時間とSQLの件数・行数を/metricsで公開する
+
+    FILE_UPLOAD_MAX_SIZEを超えるファイルが送られた場合は、実行せずに413を返す
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        response = super().dispatch(request, *args, **kwargs)
+        if getattr(request, "_db_wrote", False):
+            until = time.time() + getattr(settings, "DATABASE_READ_AFTER_WRITE_SECONDS", 5)
+            response.set_cookie(PRIMARY_STICKY_COOKIE, str(until), max_age=int(until - time.time()) + 1, httponly=True)
+
+        return response
+
+
+    def parse_body(self, request):
+        # multipartの本文はrequest.POSTを参照したときに読み込まれ、上限を超えたファイルはそこで打ち切られる
+        if self.get_content_type(request) == "multipart/form-data" and "operations" in request.POST and is_upload_too_large(request):
+            raise HttpError(HttpResponse(status=413), MaxFileSizeValidator.message)
+
+        return super().parse_body(request)
+
+
+    def get_graphql_params(self, request, data):
+        query, variables, operation_name, id = super().get_graphql_params(request, data)
+        try:
+            query = persisted_query_store.resolve(query, request.GET.get("extensions") or data.get("extensions"))
+        except PersistedQueryError as e:
+            # Apollo Clientはステータスが200の場合にだけ、クエリ文字列を付けて送り直す
+            response = HttpResponse() if str(e) == PERSISTED_QUERY_NOT_FOUND else HttpResponseBadRequest()
+            raise HttpError(response, str(e))
+
+        return query, variables, operation_name, id
+
+
+    def execute_graphql_request(self, request, data, query, variables, operation_name, show_graphiql=False):
+        cost_errors = self.__check_query_cost(request, query, variables, operation_name)
+        if cost_errors:
+            return ExecutionResult(errors=cost_errors, invalid=True)
+
+        operation_type = self.__operation_type(request, query, operation_name)
+        with instrument_operation(self.__operation_label(request, query, operation_name)):
+            if operation_type == "query" and not self.__is_primary_sticky(request):
+                with use_replica():
+                    return super().execute_graphql_request(request, data, query, variables, operation_name, show_graphiql)
+
+            result = super().execute_graphql_request(request, data, query, variables, operation_name, show_graphiql)
+            # 書き込んだ場合だけ期限を延ばす。queryやエラーでも延ばすと、頻繁にpollingするクライアントはレプリカへ戻れなくなる
+            if operation_type == "mutation":
+                request._db_wrote = True
+
+            return result
+
+
+    def __check_query_cost(self, request, query, variables, operation_name) -> list:
+        if not query:
+            return []
+
+        try:
+            document = self.get_backend(request).document_from_string(self.schema, query)
+        except Exception:
+            return []
+
+        analyzer = QueryCostAnalyzer(self.schema, QueryCostLimit.from_settings())
+        return analyzer.check(document.document_ast, variables, operation_name)
+
+
+    def __operation_label(self, request, query, operation_name) -> str:
+        """
+        operationNameが無い場合は、ドキュメントに1つだけ含まれるoperationの名前を使う
+        """
+        if operation_name:
+            return operation_name
+
+        if not query:
+            return "anonymous"
+
+        try:
+            document = self.get_backend(request).document_from_string(self.schema, query)
+        except Exception:
+            return "invalid"
+
+        names = [
+            definition.name.value
+            for definition in document.document_ast.definitions
+            if isinstance(definition, OperationDefinition) and definition.name is not None
+        ]
+        return names[0] if len(names) == 1 else "anonymous"
+
+
+    def __is_primary_sticky(self, request) -> bool:
+        try:
+            return float(request.COOKIES.get(PRIMARY_STICKY_COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+
+    def __operation_type(self, request, query, operation_name) -> Optional[str]:
+        """
+        "query"、"mutation"、"subscription"のいずれか。operationを特定できない場合はNone
+        """
+        if not query:
+            return None
+
+        try:
+            document = self.get_backend(request).document_from_string(self.schema, query)
+        except Exception:
+            # 構文エラーなどはexecute_graphql_requestでエラーとして返す
+            return None
+
+        return document.get_operation_type(operation_name)
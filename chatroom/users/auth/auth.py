@@ -4,6 +4,7 @@ from django.http.request import HttpRequest
 
 from .google_auth import GoogleAuth
 from .my_app_auth import MyAppAuth
+from .identity import Identity, get_cached_identity, cache_identity
 from ..models import UserName
 
 
@@ -13,14 +14,21 @@ class Auth:
 
     
     @property
-    def is_sign_in(self)->bool:
-        if MyAppAuth(self.__request).is_sign_in:
-            return True
+    def identity(self)->Identity:
+        """
+        サインイン中のユーザーと認証方式
+        ユーザーテーブルへの問い合わせはリクエストごとに1回だけ行い、結果をrequestに保持する
+        """
+        identity = get_cached_identity(self.__request)
+        if identity is not None:
+            return identity
 
-        if GoogleAuth(self.__request).is_sign_in:
-            return True
+        return cache_identity(self.__request, self.__resolve_identity())
 
-        return False
+
+    @property
+    def is_sign_in(self)->bool:
+        return self.identity.user is not None
 
 
     def sign_out(self)->NoReturn:
@@ -39,12 +47,16 @@ class Auth:
 
     @property
     def current_user(self)->UserName:
+        return self.identity.user
+
+
+    def __resolve_identity(self)->Identity:
         auth = MyAppAuth(self.__request)
         if auth.is_sign_in:
-            return auth.current_user.username
-        
-        auth = GoogleAuth(self.__request)
-        if auth.is_sign_in:
-            return auth.current_user.username
+            return Identity(user=auth.current_user.username, provider="myapp")
+
+        google_user = GoogleAuth(self.__request).current_user
+        if google_user is not None:
+            return Identity(user=google_user.username, provider="google")
 
-        return None
\ No newline at end of file
+        return Identity(user=None, provider=None)
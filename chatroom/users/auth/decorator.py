@@ -1,7 +1,10 @@
 import functools
+from typing import Optional
 
+from django.conf import settings
 from django.http.request import HttpRequest
 
+from common.ratelimit.token_bucket import rate_limiter
 from users.auth.auth import Auth
 
 def require_sign_in(f):
@@ -13,3 +16,44 @@ def require_sign_in(f):
         return f(request, *args, **kwargs)
 
     return logic
+
+
+def client_key(request) -> str:
+    """
+    サインイン中はユーザー、していない場合は接続元のIPアドレスでレート制限のキーを作る
+    ユーザーはAuthがリクエストごとに1回だけ解決するため、mutationの中で再び参照しても問い合わせは増えない
+    """
+    user = Auth(request).current_user
+    if user is not None:
+        return "user:%s" % user.pk
+
+    if hasattr(request, "scope"):
+        address = (request.scope.get("client") or ("", ))[0]
+    elif getattr(settings, "RATE_LIMIT_USE_FORWARDED_FOR", False) and "HTTP_X_FORWARDED_FOR" in request.META:
+        address = request.META["HTTP_X_FORWARDED_FOR"].split(",")[0].strip()
+    else:
+        address = request.META.get("REMOTE_ADDR", "")
+
+    return "ip:%s" % address
+
+
+def rate_limit(scope: str, room_argument: Optional[str] = None):
+    """
+    GraphQLのmutate(resolver)に付けて、settings.RATE_LIMITSのscopeの頻度を超えた呼び出しを
+    ロジックを実行する前に拒否する。room_argumentを指定した場合はその引数(ルームのID)ごとに数える
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def mutate(*args, **kwargs):
+            # resolverは(root, info)か(cls, root, info)の順に呼び出される
+            info = args[-1]
+            key = client_key(info.context)
+            if room_argument is not None:
+                key += ":room:%s" % kwargs.get(room_argument)
+
+            rate_limiter.check(scope, key)
+            return f(*args, **kwargs)
+
+        return mutate
+
+    return decorator
@@ -6,6 +6,7 @@ from typing import NoReturn
 import google_auth_oauthlib.flow
 from django.http.request import HttpRequest
 
+from .identity import clear_identity
 from ..models import UserOnGoogle
 
 
@@ -51,6 +52,7 @@ class GoogleAuth:
             "id": payload["sub"]
         }
         session.save()
+        clear_identity(self.__request)
         
         return username, payload["sub"], payload["email"]
         
@@ -58,6 +60,7 @@ class GoogleAuth:
     def sign_out(self)->NoReturn:
         if self.is_sign_in:
             del self.__request.session["google-user"]
+            clear_identity(self.__request)
 
 
     @property
@@ -74,7 +77,7 @@ class GoogleAuth:
             return None
 
         try:
-            return UserOnGoogle.objects.get(id=self.user_id)
+            return UserOnGoogle.objects.select_related("username").get(id=self.user_id)
         except UserOnGoogle.DoesNotExist:
             return None
 
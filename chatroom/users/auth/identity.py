@@ -0,0 +1,34 @@
+from dataclasses import dataclass
+from typing import Final, Optional
+
+from ..models import UserName
+
+
+IDENTITY_ATTRIBUTE: Final[str] = "_auth_identity"
+
+
+@dataclass(frozen=True)
+class Identity:
+    """
+    リクエスト(websocketの場合は接続)ごとに1度だけ解決したサインイン中のユーザー
+    providerは"myapp"か"google"で、サインインしていない場合はuserとともにNone
+    """
+    user: Optional[UserName]
+    provider: Optional[str]
+
+
+def get_cached_identity(request) -> Optional[Identity]:
+    return getattr(request, IDENTITY_ATTRIBUTE, None)
+
+
+def cache_identity(request, identity: Identity) -> Identity:
+    setattr(request, IDENTITY_ATTRIBUTE, identity)
+    return identity
+
+
+def clear_identity(request) -> None:
+    """
+    サインイン・サインアウトでユーザーが変わる場合に呼び出す
+    """
+    if hasattr(request, IDENTITY_ATTRIBUTE):
+        delattr(request, IDENTITY_ATTRIBUTE)
@@ -3,6 +3,7 @@ from typing import NoReturn
 from django.http.request import HttpRequest
 from django.contrib.auth import logout, authenticate, login
 
+from .identity import clear_identity
 from ..models import UserOnMyApp
 
 
@@ -15,12 +16,14 @@ class MyAppAuth:
         user = authenticate(self.__request, username=email, password=password)
         if user:
             login(self.__request, user)
+            clear_identity(self.__request)
             
         return user
 
 
     def sign_out(self)->NoReturn:
         logout(self.__request)
+        clear_identity(self.__request)
 
 
     @property
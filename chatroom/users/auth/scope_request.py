@@ -0,0 +1,12 @@
+from django.contrib.sessions.backends.base import SessionBase
+
+
+class ScopeRequest:
+    """
+    websocket接続のscopeをHttpRequestの代わりとしてAuthに渡すためのアダプタ
+    AuthMiddlewareStackが設定したsessionとuserだけを公開する
+    """
+    def __init__(self, scope: dict) -> None:
+        self.scope = scope
+        self.session: SessionBase = scope["session"]
+        self.user = scope["user"]
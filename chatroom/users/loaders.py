@@ -0,0 +1,25 @@
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from .models import UserName
+from common.loaders.request_loader import get_loader
+
+
+class UserNameLoader(DataLoader):
+    """
+    主キーからUserNameをまとめて取得する
+    UserName.userがクエリを発行しないよう、認証方式ごとのユーザーも同時に取得しておく
+    """
+    def batch_load_fn(self, keys):
+        names = UserName.objects.select_related("userongoogle", "useronmyapp").in_bulk(keys)
+        return Promise.resolve([names.get(key) for key in keys])
+
+
+def load_user_name(context, user_id) -> Promise:
+    """
+    一覧の各行から参照されるユーザーを、リクエスト内でまとめて1回のクエリで取得する
+    """
+    if user_id is None:
+        return Promise.resolve(None)
+
+    return get_loader(context, UserNameLoader).load(user_id)
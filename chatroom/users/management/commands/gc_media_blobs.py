@@ -0,0 +1,77 @@
+import os
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from common.images.rendition import RENDITION_DIR, delete_renditions
+from users.models import MediaBlob, UserProfile
+
+
+class Command(BaseCommand):
+    help = "参照されなくなったプロフィール画像と、そのレンディションを削除する"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--recount",
+            action="store_true",
+            help="UserProfileの参照から参照数を数え直してから削除する"
+        )
+        parser.add_argument(
+            "--grace-seconds",
+            type=int,
+            default=3600,
+            help="参照数が0になってからこの秒数が経過した画像だけを削除する"
+        )
+
+    def handle(self, *args, **options):
+        storage = UserProfile._meta.get_field("icon").storage
+        if options["recount"]:
+            self.recount()
+
+        threshold = timezone.now() - timedelta(seconds=options["grace_seconds"])
+        blobs = list(MediaBlob.objects.filter(ref_count__lte=0, update_date__lt=threshold).values_list("pk", "name"))
+        removed = sum(self.delete_blob(storage, pk, name) for pk, name in blobs)
+        orphans = self.delete_orphan_renditions(storage)
+        self.stdout.write(f"画像を{removed}件、元画像の無いレンディションを{orphans}件削除しました")
+
+    def delete_blob(self, storage, pk: int, name: str) -> bool:
+        """
+        取得した後に再び参照された画像は削除しない
+        参照数を確かめながら行を削除して書き込みのロックを取り、ファイルを削除し終えるまで
+        同じ画像のacquire(アップロード)をコミットまで待たせる
+        """
+        with transaction.atomic():
+            deleted, _ = MediaBlob.objects.filter(pk=pk, ref_count__lte=0).delete()
+            if deleted:
+                storage.delete(name)
+                delete_renditions(storage, name)
+
+        return bool(deleted)
+
+    def recount(self):
+        counts = Counter(UserProfile.objects.values_list("icon", flat=True))
+        counts.update(UserProfile.objects.values_list("cover_image", flat=True))
+
+        for blob in MediaBlob.objects.all():
+            MediaBlob.objects.filter(pk=blob.pk).update(ref_count=counts.pop(blob.name, 0))
+
+        for name, count in counts.items():
+            if name.startswith(UserProfile._meta.get_field("icon").storage.BLOB_DIR + "/"):
+                MediaBlob.objects.create(name=name, ref_count=count)
+
+    def delete_orphan_renditions(self, storage) -> int:
+        root = storage.path(RENDITION_DIR)
+        removed = 0
+        for dirpath, _, filenames in os.walk(root):
+            source_name = os.path.relpath(dirpath, root).replace(os.sep, "/")
+            if not filenames or storage.exists(source_name):
+                continue
+
+            for filename in filenames:
+                os.remove(os.path.join(dirpath, filename))
+                removed += 1
+
+        return removed
@@ -0,0 +1,35 @@
+# Generated by Django 3.1.14 on 2026-10-18 10:28
+
+import common.validators.image
+from django.db import migrations, models
+import django.utils.timezone
+import users.storages.content_addressed_storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_userprofile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('ref_count', models.IntegerField(default=0)),
+                ('update_date', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='userprofile',
+            name='cover_image',
+            field=models.ImageField(default='uploads/DefaultCoverImage.png', storage=users.storages.content_addressed_storage.ContentAddressedStorage(), upload_to='uploads/', validators=[common.validators.image.MaxFileSizeValidator(52428800), common.validators.image.ImageAspectRatioValidator(common.validators.image.WidthHeight(height=1, width=3))]),
+        ),
+        migrations.AlterField(
+            model_name='userprofile',
+            name='icon',
+            field=models.ImageField(default='uploads/DefaultIconImage.png', storage=users.storages.content_addressed_storage.ContentAddressedStorage(), upload_to='uploads/', validators=[common.validators.image.MaxFileSizeValidator(52428800), common.validators.image.ImageAspectRatioValidator(common.validators.image.WidthHeight(1, 1))]),
+        ),
+    ]
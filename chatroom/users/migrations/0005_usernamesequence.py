@@ -0,0 +1,21 @@
+# Generated by Django 3.1.14 on 2026-10-18 10:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_auto_20261018_1928'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserNameSequence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('base_name', models.CharField(max_length=30, unique=True)),
+                ('last_number', models.IntegerField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.14 on 2026-10-18 11:16
+
+import common.validators.image
+from django.db import migrations, models
+import users.storages.content_addressed_storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_usernamesequence'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='userprofile',
+            name='cover_image',
+            field=models.ImageField(default='uploads/DefaultCoverImage.png', storage=users.storages.content_addressed_storage.ContentAddressedStorage(), upload_to='uploads/', validators=[common.validators.image.MaxFileSizeValidator(52428800), common.validators.image.MaxPixelsValidator(40000000), common.validators.image.ImageAspectRatioValidator(common.validators.image.WidthHeight(height=1, width=3))]),
+        ),
+        migrations.AlterField(
+            model_name='userprofile',
+            name='icon',
+            field=models.ImageField(default='uploads/DefaultIconImage.png', storage=users.storages.content_addressed_storage.ContentAddressedStorage(), upload_to='uploads/', validators=[common.validators.image.MaxFileSizeValidator(52428800), common.validators.image.MaxPixelsValidator(40000000), common.validators.image.ImageAspectRatioValidator(common.validators.image.WidthHeight(1, 1))]),
+        ),
+    ]
@@ -1,15 +1,19 @@
 from typing import Final
 
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from django.core.validators import EmailValidator
 from django.db import models
+from django.db.models import F
+from django.db.models.functions import Greatest
 from django.contrib.auth.models import AbstractBaseUser, UserManager, PermissionsMixin
 from django.contrib.auth.validators import UnicodeUsernameValidator, ASCIIUsernameValidator
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
 
-from common.validators.image import MaxFileSizeValidator, ImageAspectRatioValidator, WidthHeight
+from common.images.rendition import RENDITION_MAX_PIXELS
+from common.validators.image import MaxFileSizeValidator, MaxPixelsValidator, ImageAspectRatioValidator, WidthHeight
+from .storages.content_addressed_storage import ContentAddressedStorage
 
 
 class FailedAssignSequentialNumber(Exception):
@@ -20,25 +24,40 @@ class FailedAssignSequentialNumber(Exception):
 
 
 class UserNameQuerySet(models.QuerySet):
+    MAX_ASSIGN_RETRY: Final[int] = 10
+
     def create_assign_sequential_number(self, username):
         """
         与えられたusernameに対して連番を付与することでユーザー名の重複をなくす
         重複をなくした上でユーザー名を登録する
+
+        連番はUserNameSequenceで採番するので、既存のユーザー名の数に関わらずクエリの回数は一定になる
+        同時に登録されて一意制約に違反した場合は、次の番号で登録し直す
         """
 
         base_name = get_user_model().normalize_username(username)
-        tmp_name = base_name
-
-        for i in range(200000):
-            if not UserName.objects.filter(username=tmp_name).exists():
-                name = UserName(username=tmp_name)
-                name.save()
-                return name
-            
-            tmp_name = f"{base_name}{i}"
+        try:
+            with transaction.atomic():
+                return self.__create_name(base_name)
+        except IntegrityError:
+            pass
+
+        for retry in range(self.MAX_ASSIGN_RETRY):
+            try:
+                with transaction.atomic():
+                    # 採番の更新も一緒に巻き戻るため、再試行では使われている連番から数え直す
+                    number = UserNameSequence.objects.next_number(base_name, resync=retry > 0)
+                    return self.__create_name(f"{base_name}{number}")
+            except IntegrityError:
+                continue
 
         raise FailedAssignSequentialNumber("連番の付与に失敗しました。ユーザー名%sは使用されすぎています" % username)
 
+    def __create_name(self, username):
+        name = UserName(username=username)
+        name.save()
+        return name
+
     def create(self, **kwargs):
         username: UserName = get_user_model().normalize_username(kwargs["username"])
         username.full_clean()
@@ -81,6 +100,46 @@ class UserName(models.Model):
         return ""
 
 
+class UserNameSequence(models.Model):
+    """
+    create_assign_sequential_numberで付与した連番の最後の番号を、元のユーザー名ごとに記録する
+    """
+    class UserNameSequenceQuerySet(models.QuerySet):
+        def next_number(self, base_name: str, resync: bool = False) -> int:
+            """
+            呼び出し元のトランザクションが終わるまで、同じbase_nameの採番は行ロックで待たされる
+            resyncがTrueの場合は、採番した後に登録されたユーザー名も考慮して番号を決め直す
+            """
+            if resync:
+                last_number = Greatest(F("last_number") + 1, self.__max_used_number(base_name) + 1)
+            else:
+                last_number = F("last_number") + 1
+
+            if not self.filter(base_name=base_name).update(last_number=last_number):
+                # 初めて採番するときだけ、既に使われている連番の最大値から始める
+                self.create(base_name=base_name, last_number=self.__max_used_number(base_name) + 1)
+
+            return self.get(base_name=base_name).last_number
+
+        def __max_used_number(self, base_name: str) -> int:
+            # 数字で始まる接尾辞だけを、username列の索引を使った範囲検索で取り出す("9"の次の文字は":")
+            names = UserName.objects.filter(
+                username__gte=base_name + "0",
+                username__lt=base_name + ":"
+            ).values_list("username", flat=True)
+
+            suffixes = [name[len(base_name):] for name in names]
+            return max((int(suffix) for suffix in suffixes if suffix.isdecimal()), default=-1)
+
+    base_name = models.CharField(max_length=30, unique=True)
+    last_number = models.IntegerField()
+
+    objects = UserNameSequenceQuerySet.as_manager()
+
+    def __str__(self):
+        return f"{self.base_name}{self.last_number}"
+
+
 class CustomUserManager(UserManager):
     use_in_migrations = True
 
@@ -201,23 +260,58 @@ class UserOnGoogle(models.Model):
 class UserProfile(models.Model):
     DEFAULT_ICON_NAME: Final[str] = "uploads/DefaultIconImage.png"
     DEFAULT_COVER_IMAGE_NAME: Final[str] = "uploads/DefaultCoverImage.png"
+    UPLOAD_TO: Final[str] = "uploads/"
 
     user = models.OneToOneField(UserName, on_delete=models.CASCADE)
     self_introduction = models.CharField(max_length=256, blank=True)
     LIMIT_BYTE: Final[int] = 50 * 1024 * 1024
     icon = models.ImageField(
-        upload_to="uploads/", 
+        upload_to=UPLOAD_TO, 
+        storage=ContentAddressedStorage(),
         validators=[
             MaxFileSizeValidator(LIMIT_BYTE),
+            MaxPixelsValidator(RENDITION_MAX_PIXELS),
             ImageAspectRatioValidator(WidthHeight(1, 1))
             ], 
         default=DEFAULT_ICON_NAME
     )
     cover_image = models.ImageField(
-        upload_to="uploads/", 
+        upload_to=UPLOAD_TO, 
+        storage=ContentAddressedStorage(),
         validators=[
             MaxFileSizeValidator(LIMIT_BYTE),
+            MaxPixelsValidator(RENDITION_MAX_PIXELS),
             ImageAspectRatioValidator(WidthHeight(width=3, height=1))
         ], 
         default=DEFAULT_COVER_IMAGE_NAME
-    )
\ No newline at end of file
+    )
+
+
+class MediaBlob(models.Model):
+    """
+    ContentAddressedStorageに保存したファイルと、それを参照しているフィールドの数
+    """
+    class MediaBlobQuerySet(models.QuerySet):
+        def acquire(self, name: str) -> None:
+            """
+            gc_media_blobsが削除している途中の行はコミットまで待ち、削除された場合は作り直す
+            """
+            with transaction.atomic():
+                blob, created = self.select_for_update().get_or_create(name=name, defaults={"ref_count": 1})
+                if not created:
+                    self.filter(pk=blob.pk).update(ref_count=F("ref_count") + 1, update_date=timezone.now())
+
+        def release(self, name: str) -> bool:
+            """
+            管理対象のファイルでなければFalseを返す
+            """
+            return self.filter(name=name).update(ref_count=F("ref_count") - 1, update_date=timezone.now()) > 0
+
+    name = models.CharField(max_length=255, unique=True)
+    ref_count = models.IntegerField(default=0)
+    update_date = models.DateTimeField(default=timezone.now)
+
+    objects = MediaBlobQuerySet.as_manager()
+
+    def __str__(self):
+        return self.name
@@ -1,22 +1,23 @@
-import base64
-import hashlib
-
 from graphql_relay import from_global_id
 from graphene_django import DjangoObjectType
 from graphene_django.filter import DjangoFilterConnectionField
 import graphene
 from django.contrib.auth import get_user_model
-from django.db.models.fields.files import ImageFieldFile
 from graphene_django.fields import DjangoConnectionField
 from graphene_file_upload.scalars import Upload
 from django.core.files.images import ImageFile
+from django.urls import reverse
 
 from .models import UserName, UserProfile
 from .auth.my_app_auth import MyAppAuth
 from .auth.auth import Auth
 from .auth.google_auth import GoogleAuth
+from .auth.decorator import rate_limit
+from .loaders import load_user_name
 from common.errors.graphql_error_decorator import reraise_graphql_error
 from common.nodes.url_safe_encode_node import UrlSafeEncodeNode
+from common.validators.image import MaxFileSizeValidator
+from common.images.rendition import bucket_size
 
 
 class UserNameNode(DjangoObjectType):
@@ -28,10 +29,24 @@ class UserNameNode(DjangoObjectType):
     email = graphene.String()
 
     def resolve_email(self, info):
-        if Auth(info.context).is_same_user(self):
-            return self.email
+        def email(username: UserName):
+            if Auth(info.context).is_same_user(username):
+                return username.email
+
+            return ""
+
+        return load_user_name(info.context, self.pk).then(email)
 
-        return ""
+
+def profile_image_url(request, name: str, size: int = None) -> str:
+    """
+    画像本体ではなく、sizeに近いレンディションを返すURLを返す
+    """
+    url = reverse("profile_image", kwargs={"size": bucket_size(size), "name": name})
+    if hasattr(request, "build_absolute_uri"):
+        return request.build_absolute_uri(url)
+
+    return url
 
 
 class UserProfileNode(DjangoObjectType):
@@ -40,19 +55,17 @@ class UserProfileNode(DjangoObjectType):
         fields = "__all__"
         interfaces = (UrlSafeEncodeNode, )
 
-    def resolve_icon(self: UserProfile, info):
-        image: ImageFieldFile = self.icon
-        names = image.name.split(".")
-        image.open(mode="rb")
-        content = image.read()
-        return f'data:image/{names[len(names)-1]};base64,{base64.b64encode(content).decode("utf-8")}'
+    icon = graphene.String(size=graphene.Int())
+    cover_image = graphene.String(size=graphene.Int())
+
+    def resolve_user(self: UserProfile, info):
+        return load_user_name(info.context, self.user_id)
+
+    def resolve_icon(self: UserProfile, info, size=None):
+        return profile_image_url(info.context, self.icon.name, size)
         
-    def resolve_cover_image(self: UserProfile, info):
-        image: ImageFieldFile = self.cover_image
-        names = image.name.split(".")
-        image.open(mode="rb")
-        content = image.read()
-        return f'data:image/{names[len(names)-1]};base64,{base64.b64encode(content).decode("utf-8")}'
+    def resolve_cover_image(self: UserProfile, info, size=None):
+        return profile_image_url(info.context, self.cover_image.name, size)
     
 
 class Query(graphene.ObjectType):
@@ -74,7 +87,7 @@ class Query(graphene.ObjectType):
     def resolve_current_user(root, info):
         return Auth(info.context).current_user
 
-    def resolve_all_user(root, info):
+    def resolve_all_user(root, info, **kwargs):
         return UserName.objects.all()
 
     def resolve_current_user_profile(root, info):
@@ -110,6 +123,7 @@ class SignUp(graphene.Mutation):
 
     @classmethod
     @reraise_graphql_error
+    @rate_limit("sign_up")
     def mutate(cls, root, info, username, password, email):
         get_user_model().objects.create_user(username=username, password=password, email=email)
         MyAppAuth(info.context).sign_out()
@@ -127,6 +141,7 @@ class SignIn(graphene.Mutation):
 
     @classmethod
     @reraise_graphql_error
+    @rate_limit("sign_in")
     def mutate(cls, root, info, email, password):
         Auth(info.context).sign_out()
         user = MyAppAuth(info.context).sign_in(email, password)
@@ -208,7 +223,13 @@ class EditProfile(graphene.Mutation):
 
     ok = graphene.Boolean()
 
+    @rate_limit("edit_profile")
     def mutate(self, info, **kwargs):
+        # 画像を読み込む前に、アップロード時に数えたサイズで上限超過を弾く
+        for key in ("icon", "cover_image"):
+            if getattr(kwargs.get(key), "size", 0) > UserProfile.LIMIT_BYTE:
+                raise Exception(MaxFileSizeValidator.message)
+
         user = Auth(info.context).current_user
         try:
             profile: UserProfile = UserProfile.objects.get(user=user)
@@ -222,13 +243,15 @@ class EditProfile(graphene.Mutation):
                 profile.user.save()
 
             def save_filename(name, content_type):
-                names = name.split(".")
-                if len(names) > 1:
-                    return hashlib.md5(names[0].encode()).hexdigest() + "." + names[len(names)-1]
+                # 保存先の名前はContentAddressedStorageが内容から決めるので、拡張子だけを補う
+                if "." in name:
+                    return name
 
                 names = content_type.split("/")
                 if len(names) > 1:
-                    return hashlib.md5(name.encode()).hexdigest() + "." + names[1]
+                    return name + "." + names[1]
+
+                return name
 
             if "icon" in kwargs:
                 oldIconPath = profile.icon.name
@@ -243,10 +266,10 @@ class EditProfile(graphene.Mutation):
             profile.full_clean()
             profile.save()
             if oldCoverImagePath and oldCoverImagePath != UserProfile.DEFAULT_COVER_IMAGE_NAME:
-                profile.icon.storage.delete(oldCoverImagePath)
+                profile.cover_image.storage.release(oldCoverImagePath)
 
             if oldIconPath and oldIconPath != UserProfile.DEFAULT_ICON_NAME:
-                profile.icon.storage.delete(oldIconPath)
+                profile.icon.storage.release(oldIconPath)
 
         except UserProfile.DoesNotExist:
             profile = UserProfile(
@@ -261,17 +284,10 @@ class EditProfile(graphene.Mutation):
                 profile.user.full_clean()
                 profile.user.save()
 
-            if profile.icon:
-                names = profile.icon.name.split(".")
-                profile.icon.name = hashlib.md5(names[0].encode()).hexdigest() + "." + names[len(names)-1]
-
-            if profile.cover_image:
-                names = profile.cover_image.name.split(".")
-                profile.cover_image.name = hashlib.md5(names[0].encode()).hexdigest() + "." + names[len(names)-1]
-
             profile.full_clean()
             profile.save() 
 
+        # レンディションは画像が最初に要求されたときにprofile_imageで作成する
         return EditProfile(ok=True)
 
 
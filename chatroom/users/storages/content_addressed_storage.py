@@ -0,0 +1,78 @@
+import hashlib
+import os
+import tempfile
+
+from django.apps import apps
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+from common.images.rendition import RENDITION_DIR
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    ファイル名ではなく内容のSHA-256でファイルを保存するストレージ
+    同じ内容のファイルは1つだけ保存し、MediaBlobで参照数を数える
+    参照されなくなったファイルはgc_media_blobsコマンドでまとめて削除する
+    """
+    BLOB_DIR = "blobs"
+
+    def get_available_name(self, name, max_length=None):
+        if self.__is_derived(name):
+            return super().get_available_name(name, max_length)
+
+        # 保存先の名前は_saveで内容から決めるため、ここでは重複を避ける必要がない
+        return name
+
+
+    def _save(self, name, content):
+        if self.__is_derived(name):
+            return super()._save(name, content)
+
+        blob_dir = self.path(self.BLOB_DIR)
+        os.makedirs(blob_dir, exist_ok=True)
+
+        # 一時ファイルへ書き出しながらハッシュ値を求め、内容を読むのは1回だけにする
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=blob_dir, delete=False) as tmp:
+            for chunk in content.chunks():
+                digest.update(chunk)
+                tmp.write(chunk)
+
+        hexdigest = digest.hexdigest()
+        blob_name = "/".join([self.BLOB_DIR, hexdigest[:2], hexdigest + os.path.splitext(name)[1].lower()])
+        # 参照を増やしてからファイルを置く。gc_media_blobsが同じファイルを削除している途中の場合は、
+        # acquireが削除のコミットまで待たされるため、削除された後に置き直すことになる
+        try:
+            apps.get_model("users", "MediaBlob").objects.acquire(blob_name)
+        except BaseException:
+            os.unlink(tmp.name)
+            raise
+
+        path = self.path(blob_name)
+        if os.path.exists(path):
+            os.unlink(tmp.name)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp.name, path)
+            if self.file_permissions_mode is not None:
+                os.chmod(path, self.file_permissions_mode)
+
+        return blob_name
+
+
+    def release(self, name: str) -> None:
+        """
+        参照を1つ減らす
+        MediaBlobで管理していない(このストレージ導入前に保存された)ファイルはその場で削除する
+        """
+        if not apps.get_model("users", "MediaBlob").objects.release(name):
+            self.delete(name)
+
+
+    def __is_derived(self, name: str) -> bool:
+        """
+        レンディションは元画像の名前から保存先が決まるため、内容で名前を付けない
+        """
+        return name.startswith(RENDITION_DIR + "/")
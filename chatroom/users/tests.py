@@ -1,3 +1,450 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+from itertools import count
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, override_settings
+from PIL import Image
+
+from common.cache import versioned_value
+from common.images.rendition import ensure_rendition, rendition_name
+from common.nodes.url_safe_encode_node import UrlSafeEncodeNode
+from common.ratelimit.token_bucket import CacheBucketStore, LocalBucketStore, Rate, RateLimiter, RateLimitExceeded, rate_limiter
+from common.testing.query_count import GraphQLClient, QueryCountAssertions, capture_queries
+from common.validators.image import MaxFileSizeValidator, MaxPixelsValidator
+from users.auth.auth import Auth
+from users.auth.identity import clear_identity, get_cached_identity
+from users.management.commands.gc_media_blobs import Command as GCMediaBlobsCommand
+from users.models import FailedAssignSequentialNumber, MediaBlob, UserName, UserNameQuerySet, UserNameSequence, UserOnGoogle, UserOnMyApp, UserProfile
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class UserQueryCountTest(QueryCountAssertions, TestCase):
+    """
+    ユーザーとプロフィールを増やしても、各queryとmutationのSQLの件数が変わらないこと
+    singleSignOnはGoogleのクライアントシークレットのファイルが必要なため対象にしない
+    """
+
+    def setUp(self):
+        self.owner = UserOnMyApp.objects.create_user(username="owner", email="owner@example.com", password="password")
+        UserProfile.objects.create(user=self.owner.username, self_introduction="owner")
+        self.owner_id = UrlSafeEncodeNode.to_global_id("UserNameNode", self.owner.username.pk)
+        self.graphql = GraphQLClient(self, self.owner)
+        self.users = 0
+
+    def grow_fixtures(self, size):
+        """
+        emailの解決で認証方式ごとのユーザーを参照するため、自前の認証とGoogleのユーザーを交互に増やす
+        """
+        for i in range(self.users, size):
+            if i % 2 == 0:
+                user = UserOnMyApp.objects.create_user(username=f"member-{i}", email=f"member-{i}@example.com", password="password")
+            else:
+                user = UserOnGoogle.objects.create(username=f"member-{i}", id=f"google-{i}", email=f"member-{i}@example.com")
+
+            UserProfile.objects.create(user=user.username, self_introduction=f"member-{i}")
+
+        self.users = max(self.users, size)
+
+    def query(self, query, **variables):
+        return lambda: lambda: self.graphql.execute(query, variables)
+
+    def mutation(self, graphql, query, variables):
+        """
+        variablesは実行ごとの対象を準備して変数を返す関数
+        """
+        def prepare():
+            values = variables()
+            return lambda: graphql.execute(query, values)
+
+        return prepare
+
+    def test_queries(self):
+        profile_id = UrlSafeEncodeNode.to_global_id("UserProfileNode", self.owner.username.userprofile.pk)
+        profile_fields = "selfIntroduction icon(size: 64) coverImage user { id username email }"
+        self.assertQueriesIndependentOfSize({
+            "user": self.query("query($id: ID!) { user(id: $id) { username email } }", id=self.owner_id),
+            "currentUser": self.query("{ currentUser { id username email } }"),
+            "userProfile": self.query("query($id: ID!) { userProfile(id: $id) { %s } }" % profile_fields, id=profile_id),
+            "userByName": self.query('{ userByName(username: "owner") { id username email } }'),
+            "allUser": self.query("{ allUser(first: 100) { edges { node { id username email } } } }"),
+            "allProfiles": self.query("{ allProfiles(first: 40) { edges { node { %s } } } }" % profile_fields),
+            "currentUserProfile": self.query("{ currentUserProfile { %s } }" % profile_fields),
+            "userProfileByUserId": self.query("query($id: ID) { userProfileByUserId(id: $id) { %s } }" % profile_fields, id=self.owner_id),
+        })
+
+    def test_mutations(self):
+        # サインイン・サインアウトはセッションのユーザーを変えるため、別のクライアントで実行する
+        auth = GraphQLClient(self)
+        serial = count()
+
+        def sign_up():
+            i = next(serial)
+            return {"username": f"new-{i}", "email": f"new-{i}@example.com", "password": "password"}
+
+        def sign_out():
+            auth.force_login(self.owner)
+            return {}
+
+        self.assertQueriesIndependentOfSize({
+            "signUp": self.mutation(
+                auth,
+                "mutation($username: String, $email: String, $password: String) { signUp(username: $username, email: $email, password: $password) { ok user { username email } } }",
+                sign_up
+            ),
+            "signIn": self.mutation(
+                auth,
+                'mutation { signIn(email: "owner@example.com", password: "password") { ok user { username email } } }',
+                lambda: {}
+            ),
+            "signOut": self.mutation(auth, "mutation { signOut { ok } }", sign_out),
+            "renameUserName": self.mutation(
+                self.graphql,
+                "mutation($id: ID, $name: String) { renameUserName(id: $id, newName: $name) { ok userName { username } } }",
+                lambda: {"id": self.owner_id, "name": f"owner-{next(serial)}"}
+            ),
+            "editProfile": self.mutation(
+                self.graphql,
+                "mutation($text: String) { editProfile(selfIntroduction: $text) { ok } }",
+                lambda: {"text": f"introduction {next(serial)}"}
+            ),
+        })
+
+
+class AuthIdentityTest(TestCase):
+    """
+    サインイン中のユーザーはリクエストごとに1度だけ解決し、サインイン・サインアウトで解決し直すこと
+    """
+
+    def setUp(self):
+        self.owner = UserOnMyApp.objects.create_user(username="owner", email="owner@example.com", password="password")
+        self.request = RequestFactory().get("/")
+        self.request.session = {}
+        # UserNameを取得していない状態のユーザーにする
+        self.request.user = UserOnMyApp.objects.get(pk=self.owner.pk)
+
+    def test_resolves_current_user_once_per_request(self):
+        with capture_queries() as statements:
+            users = [Auth(self.request).current_user for _ in range(3)]
+            self.assertTrue(Auth(self.request).is_sign_in)
+
+        self.assertEqual(len(statements), 1)
+        self.assertEqual({user.username for user in users}, {"owner"})
+
+    def test_clear_identity_resolves_again(self):
+        Auth(self.request).current_user
+        clear_identity(self.request)
+        self.request.user = AnonymousUser()
+
+        with capture_queries() as statements:
+            self.assertIsNone(Auth(self.request).current_user)
+
+        self.assertIsNone(get_cached_identity(self.request).user)
+        # Googleのユーザーはセッションから探すため、自前の認証でサインインしていなければSQLは実行しない
+        self.assertEqual(statements, [])
+
+    def test_repeated_current_user_fields_share_one_lookup(self):
+        graphql = GraphQLClient(self, self.owner)
+        graphql.execute("{ currentUser { id } }")
+
+        with capture_queries() as single:
+            graphql.execute("{ currentUser { id } }")
+        with capture_queries() as repeated:
+            graphql.execute("{ a: currentUser { id } b: currentUser { id } c: currentUser { username } }")
+
+        self.assertEqual(len(repeated), len(single))
+
+
+@override_settings(FILE_UPLOAD_MAX_SIZE=1024, FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+class UploadLimitTest(TestCase):
+    """
+    FILE_UPLOAD_MAX_SIZEを超えるファイルは受信を打ち切り、mutationを実行せずにエラーを返すこと
+    """
+
+    def setUp(self):
+        self.user = UserOnMyApp.objects.create_user(username="owner", email="owner@example.com", password="password")
+        UserProfile.objects.create(user=self.user.username, self_introduction="before")
+        self.client = Client(HTTP_HOST="django")
+        self.client.force_login(self.user)
+
+    def edit_profile(self, size):
+        operations = {
+            "query": "mutation($icon: Upload, $text: String) { editProfile(icon: $icon, selfIntroduction: $text) { ok } }",
+            "variables": {"icon": None, "text": "after"},
+        }
+        return self.client.post("/graphql", {
+            "operations": json.dumps(operations),
+            "map": json.dumps({"0": ["variables.icon"]}),
+            "0": SimpleUploadedFile("icon.png", b"\0" * size, content_type="image/png"),
+        })
+
+    def test_rejects_file_over_limit(self):
+        response = self.edit_profile(64 * 1024)
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(json.loads(response.content)["errors"][0]["message"], MaxFileSizeValidator.message)
+        self.assertEqual(UserProfile.objects.get(user=self.user.username).self_introduction, "before")
+
+
+class RenditionTest(SimpleTestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.storage = FileSystemStorage(location=media_root)
+
+    def save_image(self, name, format, size):
+        content = io.BytesIO()
+        Image.new("RGB", size).save(content, format)
+        return self.storage.save(name, ContentFile(content.getvalue()))
+
+    def test_creates_rendition_within_size(self):
+        name = self.save_image("photo.jpg", "JPEG", (1200, 400))
+
+        rendition = ensure_rendition(self.storage, name, 256)
+
+        with self.storage.open(rendition, "rb") as f:
+            self.assertEqual(Image.open(f).size, (256, 85))
+        self.assertEqual(ensure_rendition(self.storage, name, 256), rendition)
+
+    def test_rejects_image_over_max_pixels(self):
+        name = self.save_image("photo.png", "PNG", (20, 20))
+
+        with mock.patch("common.images.rendition.RENDITION_MAX_PIXELS", 100), self.assertRaises(Exception):
+            ensure_rendition(self.storage, name, 64)
+        self.assertFalse(self.storage.exists(rendition_name(name, 64)))
+
+    def test_max_pixels_validator_reads_only_header(self):
+        name = self.save_image("photo.png", "PNG", (20, 20))
+
+        with self.storage.open(name, "rb") as f, self.assertRaises(ValidationError):
+            MaxPixelsValidator(100)(File(f))
+
+
+class TokenBucketTest(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("common.ratelimit.token_bucket.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_parse_rate(self):
+        self.assertEqual(Rate.parse({"RATE": "30/m", "BURST": 10}), Rate(per_second=0.5, burst=10))
+        self.assertEqual(Rate.parse({"RATE": 2.5}), Rate(per_second=2.5, burst=3))
+
+    def test_allows_burst_then_refills(self):
+        limiter = RateLimiter({"send": Rate(per_second=1, burst=2)}, LocalBucketStore())
+        limiter.check("send", "user:1")
+        limiter.check("send", "user:1")
+
+        with self.assertRaises(RateLimitExceeded) as cm:
+            limiter.check("send", "user:1")
+        self.assertAlmostEqual(cm.exception.retry_after, 1)
+
+        self.now += 1
+        limiter.check("send", "user:1")
+
+    def test_keys_and_unknown_scopes_are_independent(self):
+        limiter = RateLimiter({"send": Rate(per_second=1, burst=1)}, LocalBucketStore())
+        limiter.check("send", "user:1")
+        limiter.check("send", "user:2")
+
+        for _ in range(10):
+            limiter.check("other", "user:1")
+
+    def test_evicts_least_recently_used_bucket(self):
+        store = LocalBucketStore(max_keys=2)
+        rate = Rate(per_second=0.001, burst=1)
+        store.consume("a", rate)
+        store.consume("b", rate)
+        # aを使うとbが最も長く使われていないバケットになる
+        self.assertGreater(store.consume("a", rate), 0)
+        store.consume("c", rate)
+
+        self.assertEqual(len(store), 2)
+        self.assertGreater(store.consume("a", rate), 0)
+        self.assertEqual(store.consume("b", rate), 0)
+
+
+class CacheBucketStoreTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_update_retries_after_concurrent_update(self):
+        versioned_value.update("counter", lambda value: 1, 60)
+        seen = []
+
+        def increment(value):
+            seen.append(value)
+            if len(seen) == 1:
+                # 読み込んでから書き込むまでの間に、他のワーカーが更新した場合
+                versioned_value.update("counter", lambda value: value + 10, 60)
+            return value + 1
+
+        self.assertEqual(versioned_value.update("counter", increment, 60), 12)
+        self.assertEqual(seen, [1, 11])
+        self.assertEqual(versioned_value.get("counter"), 12)
+
+    def test_concurrent_consumers_do_not_spend_same_token(self):
+        store = CacheBucketStore()
+        rate = Rate(per_second=0.001, burst=2)
+        refill = Rate.refill
+        interleaved = False
+
+        def refill_after_other_worker(self, tokens, elapsed):
+            # バケットを読み込んでから書き込むまでの間に、他のワーカーがトークンを消費した場合
+            nonlocal interleaved
+            if not interleaved:
+                interleaved = True
+                store.consume("user:1", rate)
+            return refill(self, tokens, elapsed)
+
+        with mock.patch.object(Rate, "refill", refill_after_other_worker):
+            self.assertEqual(store.consume("user:1", rate), 0)
+
+        self.assertGreater(store.consume("user:1", rate), 0)
+
+    async def test_aconsume_runs_outside_event_loop(self):
+        store = CacheBucketStore()
+        rate = Rate(per_second=1, burst=1)
+
+        self.assertEqual(await store.aconsume("user:1", rate), 0)
+        self.assertGreater(await store.aconsume("user:1", rate), 0)
+
+
+class RateLimitMutationTest(TestCase):
+    """
+    頻度を超えたmutationはロジックを実行せず、GraphQLのエラーとして再試行までの秒数を返すこと
+    """
+
+    def setUp(self):
+        UserOnMyApp.objects.create_user(username="owner", email="owner@example.com", password="password")
+        limiter = mock.patch.multiple(rate_limiter, rates={"sign_in": Rate(per_second=0.1, burst=1)}, store=LocalBucketStore())
+        limiter.start()
+        self.addCleanup(limiter.stop)
+        self.client = Client(HTTP_HOST="django")
+
+    def sign_in(self, password):
+        query = 'mutation { signIn(email: "owner@example.com", password: "%s") { ok } }' % password
+        return json.loads(self.client.post("/graphql", json.dumps({"query": query}), content_type="application/json").content)
+
+    def test_rejects_mutation_over_rate(self):
+        # サインインに失敗してもトークンは消費し、パスワードの総当たりを防ぐ
+        self.assertNotIn("リクエストが多すぎます", self.sign_in("wrong")["errors"][0]["message"])
+
+        content = self.sign_in("password")
+
+        self.assertEqual(content["errors"][0]["message"], "リクエストが多すぎます。10秒後にもう一度お試しください")
+        self.assertIsNone(content["data"]["signIn"])
+
+
+class SequentialUserNameTest(TestCase):
+    def test_assigns_base_name_then_numbers(self):
+        names = [UserName.objects.create_assign_sequential_number("alice").username for _ in range(3)]
+
+        self.assertEqual(names, ["alice", "alice0", "alice1"])
+
+    def test_retries_after_name_taken_outside_sequence(self):
+        UserName.objects.create_assign_sequential_number("bob")
+        UserName.objects.create_assign_sequential_number("bob")
+        # 連番を使わずに登録された名前と衝突した場合は、使われている連番から数え直す
+        UserName(username="bob1").save()
+        UserName(username="bob2").save()
+
+        self.assertEqual(UserName.objects.create_assign_sequential_number("bob").username, "bob3")
+        self.assertEqual(UserNameSequence.objects.get(base_name="bob").last_number, 3)
+
+    def test_gives_up_after_max_retries(self):
+        UserName.objects.create_assign_sequential_number("carol")
+        UserName.objects.create_assign_sequential_number("carol")
+        UserName(username="carol1").save()
+
+        with mock.patch.object(UserNameQuerySet, "MAX_ASSIGN_RETRY", 1), self.assertRaises(FailedAssignSequentialNumber):
+            UserName.objects.create_assign_sequential_number("carol")
+
+
+class ContentAddressedStorageTest(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.storage = UserProfile._meta.get_field("icon").storage
+
+    def save_image(self, name, color="red"):
+        content = io.BytesIO()
+        Image.new("RGB", (20, 20), color).save(content, "PNG")
+        return self.storage.save(name, ContentFile(content.getvalue()))
+
+    def gc(self):
+        call_command("gc_media_blobs", grace_seconds=0, stdout=io.StringIO())
+
+    def test_stores_same_content_once(self):
+        first = self.save_image("a.png")
+        second = self.save_image("b.PNG")
+
+        self.assertEqual(first, second)
+        self.assertEqual(MediaBlob.objects.get(name=first).ref_count, 2)
+        self.assertNotEqual(self.save_image("c.png", "blue"), first)
+
+        self.storage.release(first)
+        self.assertEqual(MediaBlob.objects.get(name=first).ref_count, 1)
+
+    def test_gc_deletes_only_unreferenced_blobs(self):
+        released = self.save_image("a.png")
+        referenced = self.save_image("b.png", "blue")
+        ensure_rendition(self.storage, released, 64)
+        self.storage.release(released)
+
+        self.gc()
+
+        self.assertFalse(self.storage.exists(released))
+        self.assertFalse(self.storage.exists(rendition_name(released, 64)))
+        self.assertFalse(MediaBlob.objects.filter(name=released).exists())
+        self.assertTrue(self.storage.exists(referenced))
+
+    def test_gc_keeps_blob_acquired_after_listing(self):
+        name = self.save_image("a.png")
+        self.storage.release(name)
+        delete_blob = GCMediaBlobsCommand.delete_blob
+
+        def upload_then_delete(command, storage, pk, blob_name):
+            # 削除する画像を一覧にした後で、同じ画像がアップロードされた場合
+            self.save_image("b.png")
+            return delete_blob(command, storage, pk, blob_name)
+
+        with mock.patch.object(GCMediaBlobsCommand, "delete_blob", upload_then_delete):
+            self.gc()
+
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(MediaBlob.objects.get(name=name).ref_count, 1)
+
+    def test_upload_after_gc_restores_blob(self):
+        name = self.save_image("a.png")
+        self.storage.release(name)
+        self.gc()
+
+        self.assertEqual(self.save_image("b.png"), name)
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(MediaBlob.objects.get(name=name).ref_count, 1)
+
+    def test_gc_deletes_orphan_renditions(self):
+        name = self.save_image("a.png")
+        rendition = ensure_rendition(self.storage, name, 64)
+        # MediaBlobを経由せずに元画像が消えた場合
+        os.remove(self.storage.path(name))
+
+        self.gc()
+
+        self.assertFalse(self.storage.exists(rendition))
@@ -3,5 +3,6 @@ from django.urls import path
 from . import views
 
 urlpatterns = [
-    path("googleauthcallback/", views.google_auth_callback)
+    path("googleauthcallback/", views.google_auth_callback),
+    path("images/<int:size>/<path:name>", views.profile_image, name="profile_image"),
 ]
\ No newline at end of file
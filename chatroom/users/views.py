@@ -1,15 +1,19 @@
 from typing import Final
 import traceback
 
+from django.http import Http404
 from django.http.request import HttpRequest
-from django.http.response import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.http.response import FileResponse, HttpResponse, HttpResponseRedirect, JsonResponse
 from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from django.views.decorators.http import require_GET
 
-from users.models import UserOnGoogle, UserName
+from users.models import UserOnGoogle, UserName, UserProfile
 
 from .auth.google_auth import GoogleAuth
 from .auth.auth import Auth
+from common.images.rendition import bucket_size, ensure_rendition, RENDITION_CONTENT_TYPE
 
 
 OAUTH_REDIRECT_URL: Final[str] = "https://localhost:8000"
@@ -42,4 +46,28 @@ def google_auth_callback(request:HttpRequest) -> HttpResponse:
         traceback.print_stack()
         return JsonResponse({"isok": False, "errors": [{"message": "authentication failed", "error_type": "auth error"}]})
 
-    return HttpResponseRedirect(OAUTH_REDIRECT_URL)
\ No newline at end of file
+    return HttpResponseRedirect(OAUTH_REDIRECT_URL)
+
+
+@require_GET
+def profile_image(request: HttpRequest, size: int, name: str) -> HttpResponse:
+    """
+    プロフィール画像のレンディションを返す
+    ETag/Last-Modifiedを付与し、変更が無ければ304を返す
+    """
+    storage = UserProfile._meta.get_field("icon").storage
+    if not name.startswith((UserProfile.UPLOAD_TO, storage.BLOB_DIR + "/")) or not storage.exists(name):
+        raise Http404()
+
+    rendition = ensure_rendition(storage, name, bucket_size(size))
+    last_modified = storage.get_modified_time(rendition).timestamp()
+    etag = quote_etag("%x-%x" % (int(last_modified), storage.size(rendition)))
+
+    response = get_conditional_response(request, etag=etag, last_modified=int(last_modified))
+    if response is None:
+        response = FileResponse(storage.open(rendition, "rb"), content_type=RENDITION_CONTENT_TYPE)
+
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = "public, max-age=86400"
+    return response